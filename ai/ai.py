@@ -1,20 +1,32 @@
 import aiohttp
+import io
 import json
 import os
 import logging
 import random
 import tempfile
 import asyncio
-import random
-from typing import List, Dict, Optional, Any
+from contextlib import AsyncExitStack
+from typing import List, Dict, Optional, Any, AsyncIterator, Union, BinaryIO
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
 
+from ai.governor import governor
+from ai.resilience import resilient_call, is_transient_error, get_breaker
+
 load_dotenv()
 
 # Настройка логгера
 logger = logging.getLogger(__name__)
 
+# Схема JSON-ответа объединённого (fused) режима: поле -> ожидаемый тип
+FUSED_RESPONSE_SCHEMA = {
+    "is_correct": bool,
+    "feedback": str,
+    "correct_answer": str,
+    "reply": str,
+}
+
 class OpenAIClient:
     """
     Клиент для работы с OpenAI API (GPT-4, Whisper, TTS).
@@ -30,10 +42,62 @@ class OpenAIClient:
         
         # Инициализируем OpenAI клиент
         if self.api_key:
-            self.client = AsyncOpenAI(api_key=self.api_key)
+            # Повторы выполняет ai/resilience.py, встроенные повторы SDK отключены
+            # OPENAI_BASE_URL позволяет направить запросы на локальный fake_openai сервер
+            self.client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=os.getenv("OPENAI_BASE_URL") or None,
+                max_retries=0
+            )
         else:
             self.client = None
 
+        # Режим генерации ответа на итерации урока:
+        # sequential - сначала проверка ответа, потом ответ учителя (2 запроса подряд)
+        # pipelined - проверка и ответ учителя выполняются параллельно
+        # fused - один запрос возвращает и проверку, и ответ учителя (JSON)
+        self.response_mode = os.getenv("AI_RESPONSE_MODE", "sequential").lower()
+
+        # Сколько секунд ждём проверку ответа после того, как ответ учителя уже готов
+        self.check_deadline = float(os.getenv("AI_CHECK_DEADLINE", "10"))
+
+        # Модель и голос TTS (входят в ключ кэша озвучки)
+        self.tts_model = os.getenv("OPENAI_TTS_MODEL", "tts-1")
+        self.tts_voice = os.getenv("OPENAI_TTS_VOICE", "onyx")  # Мужской басовый голос "onyx" для учителя Marcus
+
+    async def create_chat_completion(self, **kwargs):
+        """
+        Запрос к chat.completions через общий регулятор запросов (ai/governor.py)
+        с повторами временных ошибок и предохранителем (ai/resilience.py).
+        """
+        return await self._request("chat", self.client.chat.completions.create, kwargs)
+
+    async def create_transcription(self, **kwargs):
+        """
+        Запрос к Whisper через общий регулятор запросов.
+        """
+        return await self._request("whisper", self.client.audio.transcriptions.create, kwargs)
+
+    async def create_speech(self, **kwargs):
+        """
+        Запрос к TTS через общий регулятор запросов.
+        """
+        return await self._request("tts", self.client.audio.speech.create, kwargs)
+
+    async def _request(self, endpoint: str, create, kwargs: Dict[str, Any]):
+        """
+        Выполняет запрос к OpenAI: каждая попытка занимает слот регулятора,
+        паузы между повторами - нет.
+        """
+        async def attempt(timeout: float):
+            # Буфер с аудио перечитывается с начала при повторной попытке
+            audio_file = kwargs.get("file")
+            if hasattr(audio_file, "seek"):
+                audio_file.seek(0)
+            async with governor.slot(endpoint):
+                return await create(**{**kwargs, "timeout": timeout})
+
+        return await resilient_call(endpoint, attempt, timeout=kwargs.get("timeout"))
 
     async def generate_intelligent_response(
         self, 
@@ -49,6 +113,26 @@ class OpenAIClient:
             tuple: (ответ_бота, результат_проверки)
         """
         
+        if self.response_mode == "pipelined":
+            # Проверка и ответ идут параллельно, дожидаемся обоих результатов
+            ai_response, feedback_task = await self.generate_pipelined_response(
+                user_message=user_message,
+                conversation_history=conversation_history,
+                current_topic=current_topic
+            )
+            feedback_result = await self.wait_for_feedback(feedback_task, user_message, current_topic)
+            return ai_response, feedback_result
+
+        if self.response_mode == "fused":
+            # Один запрос вместо двух; при невалидном JSON - обычный путь из 2 запросов
+            fused_result = await self.generate_fused_response(
+                user_message=user_message,
+                conversation_history=conversation_history,
+                current_topic=current_topic
+            )
+            if fused_result is not None:
+                return fused_result
+
         # Сначала проверяем ответ пользователя
         feedback_result = await self.check_pronunciation_and_answer(
             user_answer=user_message,
@@ -67,6 +151,178 @@ class OpenAIClient:
         
         return ai_response, feedback_result
 
+    async def generate_pipelined_response(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        current_topic: Optional[Dict] = None
+    ) -> tuple[str, "asyncio.Task[Dict]"]:
+        """
+        Конвейерный режим: проверка ответа ученика запускается в фоне, а ответ учителя
+        сразу генерируется по предварительному промпту (без результата проверки).
+        Так ход урока платит за один запрос к OpenAI, а не за два подряд.
+
+        Returns:
+            tuple: (ответ_бота, задача_проверки) - результат проверки забирается
+            через wait_for_feedback, когда ответ учителя уже отправлен ученику
+        """
+        feedback_task = self.start_feedback_check(user_message, conversation_history, current_topic)
+
+        try:
+            ai_response = await self.send_message_with_feedback(
+                user_message=user_message,
+                conversation_history=conversation_history,
+                current_topic=current_topic,
+                feedback_result=None
+            )
+        except BaseException:
+            feedback_task.cancel()
+            raise
+
+        return ai_response, feedback_task
+
+    def start_feedback_check(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        current_topic: Optional[Dict] = None
+    ) -> "asyncio.Task[Dict]":
+        """
+        Запускает проверку ответа ученика в фоне, не дожидаясь результата
+        """
+        return asyncio.create_task(self.check_pronunciation_and_answer(
+            user_answer=user_message,
+            current_topic=current_topic,
+            context="Intelligent response generation",
+            conversation_history=conversation_history
+        ))
+
+    async def wait_for_feedback(
+        self,
+        feedback_task: "asyncio.Task[Dict]",
+        user_message: str,
+        current_topic: Optional[Dict] = None
+    ) -> Dict:
+        """
+        Дожидается результата проверки, запущенной в generate_pipelined_response.
+        Если проверка не уложилась в check_deadline секунд - отменяем её и
+        возвращаем нейтральный результат "не проверено", чтобы ход урока не зависал:
+        ответ не засчитывается ни правильным, ни ошибочным (is_correct = None).
+        """
+        try:
+            return await asyncio.wait_for(feedback_task, timeout=self.check_deadline)
+        except asyncio.TimeoutError:
+            logger.warning(f"Проверка ответа не уложилась в {self.check_deadline} сек, ответ не проверен")
+        except Exception as e:
+            logger.error(f"Ошибка при проверке ответа в конвейерном режиме: {e}")
+
+        return {
+            "is_correct": None,
+            "checked": False,
+            "feedback": "Спасибо за ответ! 👍 Проверить его сейчас не получилось, продолжаем урок.",
+            "correct_answer": "",
+            "explanation": ""
+        }
+
+    async def generate_fused_response(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        current_topic: Optional[Dict] = None
+    ) -> Optional[tuple[str, Dict]]:
+        """
+        Объединённый режим: один запрос к OpenAI возвращает JSON и с проверкой ответа
+        ученика, и с ответом учителя. История и тема передаются один раз.
+
+        Returns:
+            tuple: (ответ_бота, результат_проверки) или None, если ответ не прошёл
+            проверку по FUSED_RESPONSE_SCHEMA и нужно идти обычным путём из 2 запросов
+        """
+
+        # Без API сразу уходим в обычный путь - там есть свои fallback-ответы
+        if not self.api_key or self.api_key == "your_openai_api_key":
+            return None
+
+        system_prompt = self.create_system_prompt_with_feedback(current_topic, None)
+        system_prompt += """
+
+        Дополнительно проверь последний ответ ученика в контексте диалога:
+        1. Учитывай возможные ошибки транскрибации (yoy вместо you, dont вместо don't и т.д.)
+        2. Если ответ логично продолжает разговор - хвали ученика
+        3. Если есть ошибки - объясни их на русском языке и покажи правильный вариант на английском
+        4. Твой ответ учителя должен быть согласован с результатом проверки
+
+        Формат ответа (строго JSON):
+        {
+            "is_correct": true/false,
+            "feedback": "Обратная связь на русском языке (1-2 предложения)",
+            "correct_answer": "Правильный ответ на Английском языке",
+            "explanation": "Объяснение ошибок (если есть)",
+            "reply": "Ответ учителя на АНГЛИЙСКОМ языке (максимум 2-3 предложения)"
+        }
+        """
+
+        messages = [{"role": "system", "content": system_prompt}]
+
+        for msg in conversation_history[-20:]:
+            role = "assistant" if msg["role"] == "bot" else msg["role"]
+            messages.append({
+                "role": role,
+                "content": msg["content"]
+            })
+
+        messages.append({"role": "user", "content": user_message})
+
+        try:
+            response = await self.create_chat_completion(
+                model="gpt-4o-mini",
+                messages=messages,
+                max_tokens=350,  # Проверка + ответ в одном JSON
+                temperature=0.5,
+                response_format={"type": "json_object"},
+                timeout=30
+            )
+
+            response_text = response.choices[0].message.content.strip()
+
+        except Exception as e:
+            logger.error(f"Ошибка при объединённом запросе к OpenAI: {e}")
+            return None
+
+        try:
+            data = json.loads(response_text)
+        except (TypeError, ValueError):
+            logger.warning("Объединённый режим: не удалось распарсить JSON, переходим на 2 запроса")
+            return None
+
+        if not self._validate_fused_response(data):
+            logger.warning(f"Объединённый режим: ответ не соответствует схеме: {response_text[:200]}")
+            return None
+
+        feedback_result = {
+            "is_correct": data["is_correct"],
+            "feedback": data["feedback"],
+            "correct_answer": data["correct_answer"],
+            "explanation": data.get("explanation") or ""
+        }
+        return data["reply"].strip(), feedback_result
+
+    def _validate_fused_response(self, data: Any) -> bool:
+        """
+        Проверяет JSON объединённого режима по FUSED_RESPONSE_SCHEMA
+        """
+        if not isinstance(data, dict):
+            return False
+
+        for field, field_type in FUSED_RESPONSE_SCHEMA.items():
+            if not isinstance(data.get(field), field_type):
+                return False
+
+        if "explanation" in data and not isinstance(data["explanation"], (str, type(None))):
+            return False
+
+        return bool(data["reply"].strip())
+
 
     async def send_message_with_feedback(
         self, 
@@ -106,7 +362,7 @@ class OpenAIClient:
         messages.append({"role": "user", "content": user_message})
         
         try:
-            response = await self.client.chat.completions.create(
+            response = await self.create_chat_completion(
                 model="gpt-4o-mini",  # Используем GPT-4o-mini для быстрых ответов
                 messages=messages,
                 max_tokens=150,  # Ограничиваем длину ответа
@@ -156,6 +412,93 @@ class OpenAIClient:
             # Режим урока - отвечаем в контексте темы
             return await self._send_lesson_message(user_message, conversation_history, current_topic)
 
+    async def stream_message(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        current_topic: Optional[Dict] = None,
+        feedback_result: Optional[Dict] = None
+    ) -> AsyncIterator[str]:
+        """
+        Потоковый вариант send_message: получает ответ через streaming API OpenAI
+        и отдаёт накопленный текст после каждого фрагмента.
+        
+        Без темы - режим общения с учителем, с темой - ответ урока с учётом
+        результата проверки (как send_message_with_feedback).
+        
+        Yields:
+            Накопленный на текущий момент текст ответа
+        """
+        
+        # Проверяем, доступен ли OpenAI API
+        if not self.api_key or self.api_key == "your_openai_api_key":
+            logger.warning(f"Fallback режим: api_key={bool(self.api_key)}")
+            yield self._get_test_response(user_message, current_topic)
+            return
+        
+        if current_topic is None:
+            system_prompt = self.create_teacher_system_prompt()
+            history = conversation_history[-10:]
+            max_tokens = 200
+            fallback_text = "I'm sorry, there was an error. Please try again later. (Извините, произошла ошибка. Попробуйте позже.)"
+        else:
+            system_prompt = self.create_system_prompt_with_feedback(current_topic, feedback_result)
+            history = conversation_history[-20:]
+            max_tokens = 150
+            fallback_text = self._get_test_response(user_message, current_topic)
+        
+        messages = [{"role": "system", "content": system_prompt}]
+        for msg in history:
+            role = "assistant" if msg["role"] == "bot" else msg["role"]
+            messages.append({
+                "role": role,
+                "content": msg["content"]
+            })
+        messages.append({"role": "user", "content": user_message})
+        
+        async def attempt(timeout: float):
+            # Каждая попытка занимает слот регулятора, паузы между повторами - нет.
+            # Удачная попытка отдаёт слот вместе с потоком: он занят, пока поток читается
+            async with AsyncExitStack() as stack:
+                await stack.enter_async_context(governor.slot("chat"))
+                stream = await self.client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=0.7,
+                    stream=True,
+                    timeout=timeout
+                )
+                return stack.pop_all(), stream
+        
+        text = ""
+        try:
+            slot, stream = await resilient_call("chat", attempt, timeout=30)
+            async with slot:
+                try:
+                    async for chunk in stream:
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            text += delta
+                            yield text
+                except Exception as e:
+                    # Обрыв потока - такой же сбой эндпоинта, как ошибка самого запроса
+                    if is_transient_error(e):
+                        get_breaker("chat").record_failure()
+                    raise
+                    
+        except Exception as e:
+            logger.error(f"Ошибка при потоковом запросе к OpenAI: {e}")
+            # Если ученик ещё ничего не увидел - отдаём fallback-ответ
+            if not text.strip():
+                yield fallback_text
+            return
+        
+        if not text.strip():
+            yield fallback_text
+
     async def _send_teacher_message(self, user_message: str, conversation_history: List[Dict[str, str]]) -> str:
         """
         Отправляет сообщение в режиме общения с учителем
@@ -167,20 +510,7 @@ class OpenAIClient:
         Returns:
             Ответ от учителя на английском языке
         """
-        system_prompt = """
-        Ты - дружелюбный учитель английского языка Marcus. Отвечай на вопросы ученика по английскому языку.
-        
-        Твоя задача:
-        - Отвечать на любые вопросы по английскому языку (грамматика, произношение, значения слов, идиомы и т.д.)
-        - Объяснять понятно и доступно
-        - Давать примеры использования
-        - Быть дружелюбным и поддерживающим
-        - Отвечать на английском языке с русским переводом в скобках
-        - Использовать эмодзи для живости
-        
-        Формат ответа:
-        Английский ответ "Русский перевод в скобках"
-        """
+        system_prompt = self.create_teacher_system_prompt()
         
         messages = [{"role": "system", "content": system_prompt}]
         
@@ -196,7 +526,7 @@ class OpenAIClient:
         messages.append({"role": "user", "content": user_message})
         
         try:
-            response = await self.client.chat.completions.create(
+            response = await self.create_chat_completion(
                 model="gpt-4o-mini",
                 messages=messages,
                 max_tokens=200,
@@ -210,6 +540,25 @@ class OpenAIClient:
             logger.error(f"Ошибка при отправке сообщения учителю: {e}")
             return "I'm sorry, there was an error. Please try again later. (Извините, произошла ошибка. Попробуйте позже.)"
 
+    def create_teacher_system_prompt(self) -> str:
+        """
+        Создаёт системный промпт для режима общения с учителем
+        """
+        return """
+        Ты - дружелюбный учитель английского языка Marcus. Отвечай на вопросы ученика по английскому языку.
+        
+        Твоя задача:
+        - Отвечать на любые вопросы по английскому языку (грамматика, произношение, значения слов, идиомы и т.д.)
+        - Объяснять понятно и доступно
+        - Давать примеры использования
+        - Быть дружелюбным и поддерживающим
+        - Отвечать на английском языке с русским переводом в скобках
+        - Использовать эмодзи для живости
+        
+        Формат ответа:
+        Английский ответ "Русский перевод в скобках"
+        """
+
     async def _send_lesson_message(self, user_message: str, conversation_history: List[Dict[str, str]], current_topic: Dict[str, Any]) -> str:
         """
         Отправляет сообщение в режиме урока
@@ -239,7 +588,7 @@ class OpenAIClient:
         messages.append({"role": "user", "content": user_message})
         
         try:
-            response = await self.client.chat.completions.create(
+            response = await self.create_chat_completion(
                 model="gpt-4o-mini",
                 messages=messages,
                 max_tokens=150,
@@ -254,12 +603,14 @@ class OpenAIClient:
             return self._get_test_response(user_message, current_topic)
 
 
-    async def transcribe_audio(self, audio_path: str) -> str:
+    async def transcribe_audio(self, audio: Union[str, bytes, BinaryIO], filename: str = "voice.ogg") -> str:
         """
-        Транскрибирует аудио файл в текст с помощью OpenAI Whisper.
+        Транскрибирует аудио в текст с помощью OpenAI Whisper.
         
         Args:
-            audio_path: Путь к аудио файлу
+            audio: Путь к аудио файлу, байты аудио или буфер (например, BytesIO)
+            filename: Имя файла для Whisper (по расширению определяется формат),
+                если у буфера нет собственного имени
             
         Returns:
             Транскрибированный текст
@@ -272,8 +623,20 @@ class OpenAIClient:
             return "Hello, teacher! I am ready for the English lesson."
         
         try:
-            with open(audio_path, "rb") as audio_file:
-                response = await self.client.audio.transcriptions.create(
+            if isinstance(audio, str):
+                with open(audio, "rb") as audio_file:
+                    response = await self.create_transcription(
+                        model="whisper-1",
+                        file=audio_file,
+                        language="en"  # Указываем английский язык
+                    )
+            else:
+                # Буфер в памяти: Whisper нужно имя файла, чтобы определить формат
+                audio_file = io.BytesIO(audio) if isinstance(audio, bytes) else audio
+                if not getattr(audio_file, "name", None):
+                    audio_file.name = filename
+                audio_file.seek(0)
+                response = await self.create_transcription(
                     model="whisper-1",
                     file=audio_file,
                     language="en"  # Указываем английский язык
@@ -305,9 +668,9 @@ class OpenAIClient:
             return b""  # Пустые байты для fallback
         
         try:
-            response = await self.client.audio.speech.create(
-                model="tts-1",
-                voice="onyx",  # Используем мужской басовый голос "onyx" для учителя Marcus
+            response = await self.create_speech(
+                model=self.tts_model,
+                voice=self.tts_voice,
                 input=text
             )
             
@@ -441,7 +804,7 @@ class OpenAIClient:
         ]
         
         try:
-            response = await self.client.chat.completions.create(
+            response = await self.create_chat_completion(
                 model="gpt-4o-mini",
                 messages=messages,
                 max_tokens=200,
@@ -628,7 +991,7 @@ class OpenAIClient:
         ]
         
         try:
-            response = await self.client.chat.completions.create(
+            response = await self.create_chat_completion(
                 model="gpt-4o-mini",
                 messages=messages,
                 max_tokens=300,
@@ -788,7 +1151,7 @@ class OpenAIClient:
         ]
         
         try:
-            response = await self.client.chat.completions.create(
+            response = await self.create_chat_completion(
                 model="gpt-4o-mini",
                 messages=messages,
                 max_tokens=500,
@@ -850,7 +1213,7 @@ class OpenAIClient:
         ]
         
         try:
-            response = await self.client.chat.completions.create(
+            response = await self.create_chat_completion(
                 model="gpt-4o-mini",
                 messages=messages,
                 max_tokens=150,
@@ -919,7 +1282,7 @@ class OpenAIClient:
         ]
         
         try:
-            response = await self.client.chat.completions.create(
+            response = await self.create_chat_completion(
                 model="gpt-4o-mini",
                 messages=messages,
                 max_tokens=50,  # Уменьшаем для более коротких заданий
@@ -981,7 +1344,7 @@ class OpenAIClient:
         ]
         
         try:
-            response = await self.client.chat.completions.create(
+            response = await self.create_chat_completion(
                 model="gpt-4o-mini",
                 messages=messages,
                 max_tokens=100,
@@ -0,0 +1,221 @@
+"""
+Общий регулятор запросов к OpenAI.
+
+Все запросы к OpenAI проходят через governor.slot(endpoint):
+1) ограничение одновременных запросов (отдельно для chat, whisper и tts);
+2) ограничение частоты запросов - token bucket (запросов в секунду);
+3) приоритет: запросы из обработчиков (ученик ждёт ответа) обслуживаются раньше,
+   чем запросы из планировщика (рассылки).
+
+Запросы планировщика помечаются декоратором background_job.
+Метрики (глубина очереди, время ожидания) доступны через governor.get_metrics().
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# Классы эндпоинтов OpenAI
+ENDPOINTS = ("chat", "whisper", "tts")
+
+# Ограничения по умолчанию: (одновременных запросов, запросов в секунду, всплеск)
+DEFAULT_LIMITS: Dict[str, Tuple[int, float, int]] = {
+    "chat": (8, 5.0, 10),
+    "whisper": (4, 2.0, 4),
+    "tts": (4, 3.0, 6),
+}
+
+# Приоритет запросов текущей задачи (по умолчанию - интерактивный)
+request_priority: contextvars.ContextVar[str] = contextvars.ContextVar("request_priority", default=INTERACTIVE)
+
+
+def background_job(func):
+    """
+    Декоратор для задач планировщика: все запросы к OpenAI внутри
+    выполняются с фоновым приоритетом.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = request_priority.set(BACKGROUND)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            request_priority.reset(token)
+    return wrapper
+
+
+class TokenBucket:
+    """
+    Ограничение частоты: rate токенов в секунду, не больше capacity в запасе.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class EndpointLimiter:
+    """
+    Ограничение одновременных запросов к одному классу эндпоинтов
+    с двумя очередями ожидания: интерактивной и фоновой.
+    """
+
+    def __init__(self, name: str, concurrency: int, rate: float, burst: int):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.bucket = TokenBucket(rate, burst)
+
+        self._in_flight = 0
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {INTERACTIVE: deque(), BACKGROUND: deque()}
+
+        # Метрики
+        self.completed = 0
+        self.wait_total: Dict[str, float] = {INTERACTIVE: 0.0, BACKGROUND: 0.0}
+        self.wait_max: Dict[str, float] = {INTERACTIVE: 0.0, BACKGROUND: 0.0}
+        self.wait_count: Dict[str, int] = {INTERACTIVE: 0, BACKGROUND: 0}
+
+    async def acquire(self, priority: str) -> None:
+        if self._in_flight < self.concurrency and not any(self._waiters.values()):
+            self._in_flight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter in self._waiters[priority]:
+                self._waiters[priority].remove(waiter)
+            elif not waiter.cancelled():
+                # Слот уже был передан нам - возвращаем его следующему
+                self.release()
+            raise
+
+    def release(self) -> None:
+        # Освободившийся слот сразу передаётся следующему ожидающему:
+        # сначала интерактивным запросам, потом фоновым
+        for priority in (INTERACTIVE, BACKGROUND):
+            waiters = self._waiters[priority]
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self._in_flight -= 1
+
+    def record_wait(self, priority: str, waited: float) -> None:
+        self.wait_count[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+
+    def get_metrics(self) -> Dict:
+        return {
+            "in_flight": self._in_flight,
+            "concurrency": self.concurrency,
+            "queue_depth": {priority: len(waiters) for priority, waiters in self._waiters.items()},
+            "completed": self.completed,
+            "wait_avg": {
+                priority: (self.wait_total[priority] / self.wait_count[priority]) if self.wait_count[priority] else 0.0
+                for priority in self.wait_count
+            },
+            "wait_max": dict(self.wait_max),
+        }
+
+
+class RequestGovernor:
+    """
+    Регулятор запросов ко всем эндпоинтам OpenAI.
+    """
+
+    def __init__(self):
+        self.limiters: Dict[str, EndpointLimiter] = {}
+        for endpoint in ENDPOINTS:
+            concurrency, rate, burst = DEFAULT_LIMITS[endpoint]
+            prefix = f"OPENAI_{endpoint.upper()}"
+            self.limiters[endpoint] = EndpointLimiter(
+                endpoint,
+                concurrency=int(os.getenv(f"{prefix}_CONCURRENCY", str(concurrency))),
+                rate=float(os.getenv(f"{prefix}_RPS", str(rate))),
+                burst=int(os.getenv(f"{prefix}_BURST", str(burst))),
+            )
+
+    @asynccontextmanager
+    async def slot(self, endpoint: str):
+        """
+        Ждёт свободный слот и токен частоты для запроса к эндпоинту.
+
+        Args:
+            endpoint: Класс эндпоинта - chat, whisper или tts
+        """
+        limiter = self.limiters[endpoint]
+        priority = request_priority.get()
+        started = time.monotonic()
+
+        await limiter.acquire(priority)
+        try:
+            await limiter.bucket.acquire()
+            waited = time.monotonic() - started
+            limiter.record_wait(priority, waited)
+            if waited > 1:
+                logger.info(f"Запрос к OpenAI ({endpoint}, {priority}) ждал в очереди {waited:.1f} сек")
+            yield
+        finally:
+            limiter.completed += 1
+            limiter.release()
+
+    def get_metrics(self) -> Dict[str, Dict]:
+        """
+        Возвращает метрики по каждому эндпоинту: запросы в работе,
+        глубина очередей, среднее и максимальное время ожидания.
+        """
+        return {endpoint: limiter.get_metrics() for endpoint, limiter in self.limiters.items()}
+
+    def format_metrics(self) -> str:
+        """
+        Возвращает метрики в виде текста для команды /status.
+        """
+        lines = []
+        for endpoint, metrics in self.get_metrics().items():
+            queue = metrics["queue_depth"]
+            lines.append(
+                f"{endpoint}: в работе {metrics['in_flight']}/{metrics['concurrency']}, "
+                f"очередь {queue[INTERACTIVE]}+{queue[BACKGROUND]}, "
+                f"ожидание ср. {metrics['wait_avg'][INTERACTIVE]:.2f}/{metrics['wait_avg'][BACKGROUND]:.2f} сек, "
+                f"макс. {metrics['wait_max'][INTERACTIVE]:.2f}/{metrics['wait_max'][BACKGROUND]:.2f} сек"
+            )
+        return "\n".join(lines)
+
+
+# Глобальный регулятор запросов
+governor = RequestGovernor()
@@ -0,0 +1,211 @@
+"""
+Повторные попытки и защита от деградации OpenAI.
+
+resilient_call() выполняет запрос:
+1) временные ошибки (429, 5xx, таймауты, обрыв соединения) повторяются
+   с экспоненциальной задержкой и случайным разбросом (jitter);
+2) все попытки укладываются в общий бюджет времени на вызов (OPENAI_LATENCY_BUDGET);
+3) после OPENAI_BREAKER_THRESHOLD временных ошибок подряд размыкается
+   предохранитель (circuit breaker): в течение OPENAI_BREAKER_COOLDOWN секунд
+   запросы к этому эндпоинту сразу завершаются ошибкой CircuitOpenError,
+   и вызывающий код без ожидания переходит на fallback-ответ.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import openai
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Общий бюджет времени на один вызов со всеми повторами (секунды)
+OPENAI_LATENCY_BUDGET = float(os.getenv("OPENAI_LATENCY_BUDGET", "20"))
+
+# Сколько раз повторять запрос после временной ошибки
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+
+# Задержка перед повтором: базовая и максимальная (секунды)
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "8"))
+
+# Предохранитель: сколько ошибок подряд размыкают его и на сколько секунд
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5"))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
+
+# Если от бюджета осталось меньше, новую попытку не начинаем
+MIN_ATTEMPT_SECONDS = 0.5
+
+
+class CircuitOpenError(Exception):
+    """
+    Предохранитель разомкнут: запрос не выполнялся.
+    """
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для одного эндпоинта.
+
+    closed - запросы идут как обычно;
+    open - запросы сразу отклоняются до конца cooldown;
+    half-open - после cooldown пропускается один пробный запрос.
+    """
+
+    def __init__(self, name: str, threshold: int = OPENAI_BREAKER_THRESHOLD, cooldown: float = OPENAI_BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def before_call(self) -> None:
+        state = self.state
+        if state == "open":
+            raise CircuitOpenError(f"OpenAI {self.name}: предохранитель разомкнут")
+        if state == "half-open":
+            if self._probe_in_flight:
+                raise CircuitOpenError(f"OpenAI {self.name}: идёт пробный запрос")
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info(f"OpenAI {self.name}: предохранитель замкнут, запросы снова проходят")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            logger.warning(
+                f"OpenAI {self.name}: {self.failures} ошибок подряд, "
+                f"предохранитель разомкнут на {self.cooldown:.0f} сек"
+            )
+
+    def release_probe(self) -> None:
+        # Пробный запрос завершился не временной ошибкой - отпускаем пробу
+        self._probe_in_flight = False
+
+
+breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    """
+    Возвращает предохранитель эндпоинта (создаёт при первом обращении).
+    """
+    if endpoint not in breakers:
+        breakers[endpoint] = CircuitBreaker(endpoint)
+    return breakers[endpoint]
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Временная ли ошибка (имеет смысл повторить запрос).
+    """
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return False
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    """
+    Задержка из заголовка Retry-After (если OpenAI её прислал).
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Экспоненциальная задержка с полным случайным разбросом (full jitter).
+    """
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * (2 ** attempt)))
+
+
+async def resilient_call(
+    endpoint: str,
+    request: Callable[[float], Awaitable[T]],
+    timeout: Optional[float] = None,
+    budget: float = OPENAI_LATENCY_BUDGET
+) -> T:
+    """
+    Выполняет запрос с повторами, бюджетом времени и предохранителем.
+
+    Args:
+        endpoint: Класс эндпоинта (chat, whisper, tts) - у каждого свой предохранитель
+        request: Функция, выполняющая одну попытку; принимает таймаут попытки в секундах
+        timeout: Максимальный таймаут одной попытки
+        budget: Общий бюджет времени на все попытки
+
+    Raises:
+        CircuitOpenError: Если предохранитель разомкнут
+        Исключение последней попытки, если все попытки неудачны
+    """
+    breaker = get_breaker(endpoint)
+    deadline = time.monotonic() + budget
+    attempt = 0
+
+    while True:
+        breaker.before_call()
+
+        remaining = deadline - time.monotonic()
+        attempt_timeout = min(timeout, remaining) if timeout else remaining
+
+        try:
+            result = await request(attempt_timeout)
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            if not is_transient_error(e):
+                breaker.release_probe()
+                raise
+
+            breaker.record_failure()
+
+            delay = _retry_after(e) or backoff_delay(attempt)
+            remaining = deadline - time.monotonic()
+            if (
+                breaker.state == "open"
+                or attempt >= OPENAI_MAX_RETRIES
+                or remaining - delay < MIN_ATTEMPT_SECONDS
+            ):
+                raise
+
+            attempt += 1
+            logger.warning(
+                f"OpenAI {endpoint}: временная ошибка ({type(e).__name__}), "
+                f"повтор {attempt}/{OPENAI_MAX_RETRIES} через {delay:.1f} сек"
+            )
+            await asyncio.sleep(delay)
+            continue
+
+        breaker.record_success()
+        return result
@@ -8,6 +8,7 @@ from dotenv import load_dotenv
 from aiogram.types import BotCommandScopeAllPrivateChats
 from middlewares.db import DataBaseSession
 from database.engine import create_db, drop_db, session_maker
+from database.topic_catalog import topic_catalog
 from scheduler.lesson_scheduler import LessonScheduler
 
 # Импорты роутеров
@@ -28,6 +29,10 @@ db_url = os.getenv("DB_URL")
 
 bot = CustomBot(token=TOKEN)
 bot.my_admins_list = []
+# Администраторы бота: id через запятую
+for admin_id in os.getenv("ADMIN_IDS", "").split(","):
+    if admin_id.strip().isdigit():
+        bot.add_admin(int(admin_id))
 dp = Dispatcher()
 
 dp.include_router(router_user_private)
@@ -36,7 +41,7 @@ dp.include_router(router_user_private)
 lesson_scheduler = None
 
 
-async def on_startup(bot):
+async def on_startup(bot, dispatcher: Dispatcher):
     # Инициализируем OpenAI клиент (автоматически происходит при импорте ai.ai)
     # Раскоментировать если нужно обновить модели,
     # только закоментировать после 1 загрузки сервера.
@@ -45,10 +50,16 @@ async def on_startup(bot):
 
     await create_db()
     
+    # Загружаем каталог тем в память
+    await topic_catalog.load()
+    
     # Запускаем планировщик
     global lesson_scheduler
     lesson_scheduler = LessonScheduler(bot)
     await lesson_scheduler.start()
+    # Обработчики получают планировщик аргументом lesson_scheduler
+    # (app.py запускается как __main__, импорт из app создал бы второй бот и диспетчер)
+    dispatcher["lesson_scheduler"] = lesson_scheduler
     
     print("Бот запущен!")
 
@@ -1,8 +1,14 @@
 # Файл, ассинхронный движок ORM. Реализуем возможность работать с базой данных через models.
 import os
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+import time
+from typing import Dict, Optional
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-from database.models import Base
+from database.models import Base, MessageHistory
+from database.partitions import create_tables, ensure_message_history_partitions
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -20,13 +26,168 @@ db_url = os.getenv("DB_URL")
 if not db_url:
     raise ValueError("Переменная окружения DB_URL не задана!")
 
-engine = create_async_engine(db_url, echo=True)
+# Настройки пула соединений и драйвера (см. docker/env.example)
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() == "true"  # Логировать каждый SQL-запрос (только для отладки)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # Сколько ждать свободное соединение (сек)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Пересоздавать соединения старше (сек)
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))  # 0 - при работе через pgbouncer
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))  # 0 - без ограничения
+
+# Порог времени ожидания соединения, после которого пишем предупреждение (сек)
+DB_SLOW_CHECKOUT_SECONDS = float(os.getenv("DB_SLOW_CHECKOUT_SECONDS", "0.5"))
+
+
+class PoolDiagnostics:
+    """
+    Статистика пула соединений: время получения соединения и загрузка пула.
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.checkout_time_total = 0.0
+        self.checkout_time_max = 0.0
+        self.slow_checkouts = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+
+    def record_checkout_wait(self, waited: float) -> None:
+        self.checkouts += 1
+        self.checkout_time_total += waited
+        self.checkout_time_max = max(self.checkout_time_max, waited)
+        if waited >= DB_SLOW_CHECKOUT_SECONDS:
+            self.slow_checkouts += 1
+            print(f"⚠️ Соединение с БД получено через {waited:.2f} сек (пул перегружен?)")
+
+    def on_checkout(self, *args) -> None:
+        self.checked_out += 1
+        self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def on_checkin(self, *args) -> None:
+        self.checked_out = max(0, self.checked_out - 1)
+
+    def reset(self) -> None:
+        self.__init__()
+
+
+pool_diagnostics = PoolDiagnostics()
+
+
+class DiagnosticQueuePool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений, который замеряет время получения соединения.
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_diagnostics.record_checkout_wait(time.perf_counter() - started)
+
+
+def create_db_engine(
+    url: Optional[str] = None,
+    echo: bool = DB_ECHO,
+    statement_timeout_ms: int = DB_STATEMENT_TIMEOUT_MS,
+    **engine_kwargs
+) -> AsyncEngine:
+    """
+    Создаёт асинхронный движок с настройками пула и драйвера из переменных окружения.
+
+    Args:
+        url: URL базы данных (по умолчанию DB_URL)
+        echo: Логировать SQL-запросы
+        statement_timeout_ms: Ограничение времени выполнения запроса на стороне PostgreSQL
+            (0 - без ограничения, например для миграций)
+        engine_kwargs: Дополнительные параметры create_async_engine
+            (со своим poolclass настройки пула DB_POOL_* не применяются)
+    """
+    url = make_url(url or db_url)
+    kwargs = {"echo": echo}
+
+    if not url.get_backend_name().startswith("sqlite") and "poolclass" not in engine_kwargs:
+        kwargs.update(
+            poolclass=DiagnosticQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+        )
+
+    if url.get_driver_name() == "asyncpg":
+        # Кэш подготовленных выражений: asyncpg и SQLAlchemy держат свой кэш каждый
+        url = url.update_query_dict({"prepared_statement_cache_size": str(DB_STATEMENT_CACHE_SIZE)})
+        server_settings = {"application_name": "english-bot"}
+        if statement_timeout_ms:
+            server_settings["statement_timeout"] = str(statement_timeout_ms)
+        kwargs["connect_args"] = {
+            "statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+            "server_settings": server_settings,
+        }
+
+    kwargs.update(engine_kwargs)
+    new_engine = create_async_engine(url, **kwargs)
+
+    # Статистика только для пулов с настройками DB_POOL_*
+    if kwargs.get("poolclass") is DiagnosticQueuePool:
+        event.listen(new_engine.sync_engine.pool, "checkout", pool_diagnostics.on_checkout)
+        event.listen(new_engine.sync_engine.pool, "checkin", pool_diagnostics.on_checkin)
+    return new_engine
+
+
+def get_pool_status(target: Optional[AsyncEngine] = None) -> Dict:
+    """
+    Возвращает состояние пула: занятые соединения, загрузка и время ожидания соединения.
+    """
+    pool = (target or engine).sync_engine.pool
+    status = {
+        "checked_out": pool_diagnostics.checked_out,
+        "max_checked_out": pool_diagnostics.max_checked_out,
+        "checkouts": pool_diagnostics.checkouts,
+        "checkout_wait_avg": (
+            pool_diagnostics.checkout_time_total / pool_diagnostics.checkouts if pool_diagnostics.checkouts else 0.0
+        ),
+        "checkout_wait_max": pool_diagnostics.checkout_time_max,
+        "slow_checkouts": pool_diagnostics.slow_checkouts,
+    }
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        capacity = pool.size() + max(0, pool._max_overflow)
+        status["capacity"] = capacity
+        status["saturation"] = pool.checkedout() / capacity if capacity else 0.0
+    return status
+
+
+def format_pool_status() -> str:
+    """
+    Возвращает состояние пула в виде текста для команды /status.
+    """
+    status = get_pool_status()
+    text = (
+        f"занято {status['checked_out']} (макс. {status['max_checked_out']})"
+    )
+    if "capacity" in status:
+        text += f" из {status['capacity']}, загрузка {status['saturation']:.0%}"
+    text += (
+        f", ожидание соединения ср. {status['checkout_wait_avg'] * 1000:.1f} мс, "
+        f"макс. {status['checkout_wait_max'] * 1000:.1f} мс, медленных {status['slow_checkouts']}"
+    )
+    return text
+
+
+engine = create_db_engine()
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
 
 async def create_db():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        # В PostgreSQL message_history создаётся секционированной
+        await conn.run_sync(create_tables, Base.metadata, MessageHistory.__table__)
+        # Секции message_history на текущий и следующие месяцы
+        await ensure_message_history_partitions(conn)
 
 
 async def drop_db():
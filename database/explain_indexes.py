@@ -0,0 +1,199 @@
+# Проверка, что горячие запросы бота используют индексы (EXPLAIN), и замер их времени.
+#
+# Запуск:
+#   python -m database.explain_indexes                  - планы и время на текущих данных
+#   python -m database.explain_indexes --seed 200000    - сначала добавить тестовые строки
+#   python -m database.explain_indexes --force-index    - запретить seq scan (на маленькой
+#                                                          базе планировщик предпочитает его)
+#
+# Тестовые строки создаются для пользователей с отрицательными id и удаляются после проверки.
+import argparse
+import asyncio
+import json
+import random
+import sys
+import os
+import time
+from datetime import datetime, timedelta
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import select, delete, insert, text
+from sqlalchemy.dialects import postgresql
+
+from database.engine import engine, session_maker
+from database.models import User, Topic, MessageHistory, Homework
+from handlers.sending_data import user_messages_between
+
+# Тестовые пользователи - отрицательные id, чтобы не пересекаться с Telegram
+SEED_USERS = 1000
+
+
+def hot_queries(user_id: int):
+    """
+    Запросы из обработчиков и планировщика, которые должны идти по индексам:
+    (название, запрос, ожидаемый индекс)
+    """
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    return [
+        (
+            "История пользователя (handle_voice_message, get_lesson_dialogs)",
+            select(MessageHistory)
+            .where(MessageHistory.user_id == user_id)
+            .order_by(MessageHistory.timestamp.desc())
+            .limit(20),
+            "ix_message_history_user_id_timestamp",
+        ),
+        (
+            "Сообщения за период (_get_weekly_topic_for_user)",
+            user_messages_between(user_id, today, today + timedelta(days=1))
+            .order_by(MessageHistory.timestamp.desc()),
+            "ix_message_history_user_id_timestamp",
+        ),
+        (
+            "Последнее непроверенное ДЗ (update_homework_answer)",
+            select(Homework)
+            .where(Homework.user_id == user_id, Homework.is_checked == False)
+            .order_by(Homework.date_assigned.desc())
+            .limit(1),
+            "ix_homeworks_user_id_is_checked_date_assigned",
+        ),
+    ]
+
+
+def compile_query(query) -> str:
+    return str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+def plan_uses_index(plan: dict, index_names: set) -> bool:
+    if plan.get("Index Name") in index_names:
+        return True
+    return any(plan_uses_index(child, index_names) for child in plan.get("Plans", []))
+
+
+async def index_with_partitions(conn, index_name: str) -> set:
+    """
+    Имя индекса и имена его индексов на секциях (для секционированной message_history
+    в плане указываются индексы секций).
+    """
+    result = await conn.execute(
+        text(
+            "SELECT c.relname FROM pg_partition_tree(CAST(:name AS regclass)) t "
+            "JOIN pg_class c ON c.oid = t.relid"
+        ),
+        {"name": index_name}
+    )
+    return {index_name, *result.scalars().all()}
+
+
+async def seed(rows: int):
+    """
+    Добавляет тестовые сообщения и ДЗ для SEED_USERS пользователей.
+    """
+    print(f"🔄 Добавление {rows} тестовых сообщений...")
+    async with session_maker() as session:
+        topic_id = (await session.execute(select(Topic.id).limit(1))).scalar_one_or_none()
+        user_ids = [-(i + 1) for i in range(SEED_USERS)]
+        await session.execute(insert(User), [{"id": user_id, "progress": "[]"} for user_id in user_ids])
+
+        now = datetime.utcnow()
+        batch = []
+        for i in range(rows):
+            batch.append({
+                "user_id": random.choice(user_ids),
+                "role": "user" if i % 2 == 0 else "bot",
+                "content": "seed message",
+                "timestamp": now - timedelta(minutes=random.randint(0, 60 * 24 * 90)),
+            })
+            if len(batch) == 5000:
+                await session.execute(insert(MessageHistory), batch)
+                batch = []
+        if batch:
+            await session.execute(insert(MessageHistory), batch)
+
+        if topic_id is not None:
+            await session.execute(insert(Homework), [
+                {
+                    "user_id": random.choice(user_ids),
+                    "topic_id": topic_id,
+                    "task_text": "seed homework",
+                    "is_checked": random.random() < 0.8,
+                    "date_assigned": now - timedelta(days=random.randint(0, 90)),
+                }
+                for _ in range(rows // 10)
+            ])
+        await session.commit()
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("ANALYZE message_history"))
+        await conn.execute(text("ANALYZE homeworks"))
+
+
+async def cleanup():
+    async with session_maker() as session:
+        await session.execute(delete(Homework).where(Homework.user_id < 0))
+        await session.execute(delete(MessageHistory).where(MessageHistory.user_id < 0))
+        await session.execute(delete(User).where(User.id < 0))
+        await session.commit()
+    print("🗑️ Тестовые строки удалены")
+
+
+async def check(force_index: bool, repeat: int) -> bool:
+    async with session_maker() as session:
+        user_id = (await session.execute(
+            select(MessageHistory.user_id).order_by(MessageHistory.id.desc()).limit(1)
+        )).scalar_one_or_none()
+    if user_id is None:
+        print("⚠️ В message_history нет данных, используйте --seed")
+        return False
+
+    all_ok = True
+    async with engine.connect() as conn:
+        if force_index:
+            await conn.execute(text("SET enable_seqscan = off"))
+
+        for title, query, index_name in hot_queries(user_id):
+            sql = compile_query(query)
+            result = await conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}"))
+            plan_json = result.scalar_one()
+            if isinstance(plan_json, str):
+                plan_json = json.loads(plan_json)
+            plan = plan_json[0]["Plan"]
+            uses_index = plan_uses_index(plan, await index_with_partitions(conn, index_name))
+            all_ok = all_ok and uses_index
+
+            started = time.perf_counter()
+            for _ in range(repeat):
+                await conn.execute(text(sql))
+            avg_ms = (time.perf_counter() - started) / repeat * 1000
+
+            print(f"\n{'✅' if uses_index else '❌'} {title}")
+            print(f"   Индекс {index_name}: {'используется' if uses_index else 'НЕ используется'}")
+            print(f"   План: {plan['Node Type']}, время выполнения {plan_json[0]['Execution Time']:.2f} мс")
+            print(f"   Среднее время с клиента ({repeat} запросов): {avg_ms:.2f} мс")
+
+    return all_ok
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Проверка индексов горячих запросов через EXPLAIN")
+    parser.add_argument("--seed", type=int, default=0, help="Добавить столько тестовых сообщений")
+    parser.add_argument("--force-index", action="store_true", help="Запретить seq scan")
+    parser.add_argument("--repeat", type=int, default=100, help="Сколько раз выполнить каждый запрос")
+    args = parser.parse_args()
+
+    try:
+        if args.seed:
+            await seed(args.seed)
+        all_ok = await check(args.force_index, args.repeat)
+    finally:
+        if args.seed:
+            await cleanup()
+        await engine.dispose()
+
+    print("\n✅ Все запросы используют индексы" if all_ok else "\n❌ Не все запросы используют индексы")
+    sys.exit(0 if all_ok else 1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -6,6 +6,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from database.engine import engine, session_maker
 from database.models import Topic, Base
+from database.topic_catalog import topic_catalog
 
 # Список тем из школьной программы
 topics = [
@@ -116,6 +117,9 @@ async def load_topics():
             )
             session.add(t)
         await session.commit()
+    # Каталог тем в этом процессе перечитается при следующем обращении,
+    # запущенный бот подхватит темы по TOPIC_CACHE_TTL или команде /reload_topics
+    topic_catalog.invalidate()
     print("Темы успешно загружены!")
 
 if __name__ == "__main__":
@@ -0,0 +1,426 @@
+# Миграции существующей базы PostgreSQL без остановки бота.
+# create_db (Base.metadata.create_all) создаёт только отсутствующие таблицы,
+# поэтому изменения уже существующих таблиц применяются отсюда.
+#
+# Запуск:
+#   python -m database.migrations            - все миграции по порядку
+#   python -m database.migrations indexes    - только указанная миграция
+import asyncio
+import json
+import sys
+import os
+from datetime import datetime
+from typing import List, Optional
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Index, text
+
+from database.engine import create_db_engine
+from database.models import Base, MessageHistory, MessageKind, UserTopicProgress
+from database.partitions import (
+    is_partitioned, month_start, ensure_message_history_partitions, partitioned_message_history_table
+)
+
+# Отдельный движок без statement_timeout: построение индексов и перенос данных идут долго
+engine = create_db_engine(statement_timeout_ms=0)
+
+
+async def create_index_concurrently(index: Index):
+    """
+    Создаёт индекс без блокировки записи в таблицу (CREATE INDEX CONCURRENTLY).
+    Такой индекс нельзя строить внутри транзакции, поэтому используется AUTOCOMMIT.
+    Если прошлая попытка построения прервалась, невалидный индекс пересоздаётся.
+    """
+    table_name = index.table.name
+    columns = ", ".join(f'"{column.name}"' for column in index.columns)
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+
+        result = await conn.execute(
+            text(
+                "SELECT i.indisvalid FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name"
+            ),
+            {"name": index.name}
+        )
+        is_valid = result.scalar_one_or_none()
+
+        if is_valid is True:
+            print(f"✅ Индекс {index.name} уже существует")
+            return
+
+        if await is_partitioned(conn, table_name):
+            await create_partitioned_index(conn, index, columns)
+            return
+
+        if is_valid is False:
+            print(f"⚠️ Индекс {index.name} невалиден (прерванное построение), пересоздаём")
+            await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+
+        print(f"🔄 Создание индекса {index.name} на {table_name} ({columns})...")
+        await conn.execute(
+            text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{index.name}" ON "{table_name}" ({columns})')
+        )
+        print(f"✅ Индекс {index.name} создан")
+
+
+async def create_partitioned_index(conn, index: Index, columns: str):
+    """
+    CONCURRENTLY нельзя применить к секционированной таблице, поэтому индекс создаётся
+    только на родительской таблице (ON ONLY), на каждой секции строится отдельно
+    без блокировки записи и подключается к родительскому. Пока подключены не все
+    секции, родительский индекс невалиден, поэтому прерванную миграцию можно повторить.
+    """
+    table_name = index.table.name
+    await conn.execute(text(f'CREATE INDEX IF NOT EXISTS "{index.name}" ON ONLY "{table_name}" ({columns})'))
+
+    result = await conn.execute(
+        text(
+            "SELECT child.relname FROM pg_inherits i "
+            "JOIN pg_class parent ON parent.oid = i.inhparent "
+            "JOIN pg_class child ON child.oid = i.inhrelid "
+            "WHERE parent.relname = :name ORDER BY child.relname"
+        ),
+        {"name": table_name}
+    )
+    for partition in result.scalars().all():
+        partition_index = f"{partition}_{index.name[len('ix_'):]}"[:63]
+        print(f"🔄 Создание индекса {partition_index} на секции {partition}...")
+        await conn.execute(
+            text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{partition_index}" ON "{partition}" ({columns})')
+        )
+        try:
+            await conn.execute(text(f'ALTER INDEX "{index.name}" ATTACH PARTITION "{partition_index}"'))
+        except Exception as e:
+            # Секция уже подключена к этому индексу другим своим индексом
+            if "already" not in str(e):
+                raise
+    print(f"✅ Индекс {index.name} создан на всех секциях {table_name}")
+
+
+async def migrate_indexes():
+    """
+    Создаёт все индексы, объявленные в моделях.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            await create_index_concurrently(index)
+
+
+# Размер пачки строк при обновлении больших таблиц (короткие транзакции и блокировки)
+BATCH_SIZE = 5000
+
+# Признаки типов сообщений в старых строках (до появления колонки kind)
+REINFORCEMENT_QUESTION_PREFIX = "💭 Вопрос на закрепление материала:"
+ENDING_MARKERS = ("пора закончить разговор", "всегда можешь вернуться", "🏁")
+
+
+async def add_column(table_name: str, column_sql: str):
+    """
+    Добавляет колонку, если её ещё нет. В PostgreSQL 11+ колонка с константным
+    DEFAULT добавляется без перезаписи таблицы.
+    """
+    async with engine.begin() as conn:
+        await conn.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN IF NOT EXISTS {column_sql}'))
+    print(f"✅ Колонка {table_name}.{column_sql.split()[0]} на месте")
+
+
+async def update_in_batches(description: str, sql: str, params: dict = None):
+    """
+    Выполняет UPDATE пачками по диапазонам id (в sql должны быть :start и :end).
+    """
+    async with engine.connect() as conn:
+        max_id = (await conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM message_history"))).scalar_one()
+
+    updated = 0
+    for start in range(0, max_id + 1, BATCH_SIZE):
+        async with engine.begin() as conn:
+            result = await conn.execute(text(sql), {**(params or {}), "start": start, "end": start + BATCH_SIZE})
+            updated += result.rowcount
+    print(f"✅ {description}: обновлено строк {updated}")
+
+
+async def backfill_message_kind():
+    """
+    Определяет тип (kind) у старых сообщений по их тексту и извлекает
+    текст вопросов на закрепление. Повторный запуск безопасен.
+    """
+    await update_in_batches(
+        "Вопросы на закрепление",
+        "UPDATE message_history "
+        "SET kind = :kind, "
+        "    question_text = btrim(split_part(substr(content, length(:prefix) + 1), 'Отправьте текстовый ответ!', 1)) "
+        "WHERE id >= :start AND id < :end AND kind = :lesson AND content LIKE :pattern",
+        {
+            "kind": MessageKind.REINFORCEMENT_QUESTION,
+            "lesson": MessageKind.LESSON,
+            "prefix": REINFORCEMENT_QUESTION_PREFIX,
+            "pattern": f"{REINFORCEMENT_QUESTION_PREFIX}%",
+        }
+    )
+
+    ending_condition = " OR ".join(f"content ILIKE :ending{i}" for i in range(len(ENDING_MARKERS)))
+    await update_in_batches(
+        "Завершения урока",
+        "UPDATE message_history SET kind = :kind "
+        f"WHERE id >= :start AND id < :end AND kind = :lesson AND role = 'bot' AND ({ending_condition})",
+        {
+            "kind": MessageKind.ENDING,
+            "lesson": MessageKind.LESSON,
+            **{f"ending{i}": f"%{marker}%" for i, marker in enumerate(ENDING_MARKERS)},
+        }
+    )
+
+
+    # Ответы на закрепление сохранялись парой: ответ ученика + "Reinforcement feedback"
+    await update_in_batches(
+        "Обратная связь по закреплению",
+        "UPDATE message_history SET kind = :kind "
+        "WHERE id >= :start AND id < :end AND kind = :lesson AND role = 'bot' "
+        "AND content = 'Reinforcement feedback'",
+        {"kind": MessageKind.FEEDBACK, "lesson": MessageKind.LESSON}
+    )
+    await update_in_batches(
+        "Ответы на закрепление",
+        "UPDATE message_history AS answer SET kind = :kind "
+        "FROM message_history AS feedback "
+        "WHERE answer.id >= :start AND answer.id < :end AND answer.kind = :lesson "
+        "AND answer.role = 'user' AND feedback.id = answer.id + 1 "
+        "AND feedback.user_id = answer.user_id AND feedback.kind = :feedback",
+        {"kind": MessageKind.REINFORCEMENT_ANSWER, "lesson": MessageKind.LESSON, "feedback": MessageKind.FEEDBACK}
+    )
+
+
+async def migrate_message_kind():
+    """
+    Добавляет в message_history тип сообщения и текст вопроса, строит индекс
+    и заполняет тип у существующих строк.
+    """
+    await add_column("message_history", f"kind VARCHAR(32) NOT NULL DEFAULT '{MessageKind.LESSON}'")
+    await add_column("message_history", "question_text TEXT")
+    await create_model_index("ix_message_history_user_id_kind_timestamp")
+    await backfill_message_kind()
+
+
+def parse_progress(progress: Optional[str]) -> Optional[List[int]]:
+    """
+    Возвращает id пройденных тем из значения users.progress (JSON-массив).
+    Пустое значение - пустой список; повреждённый JSON или не массив - None.
+    """
+    if not progress or not progress.strip():
+        return []
+    try:
+        completed = json.loads(progress)
+    except ValueError:
+        return None
+    if not isinstance(completed, list):
+        return None
+    topic_ids = []
+    for item in completed:
+        if isinstance(item, bool):
+            continue
+        if isinstance(item, int) or (isinstance(item, str) and item.strip().isdigit()):
+            topic_ids.append(int(item))
+    return topic_ids
+
+
+async def migrate_user_topic_progress():
+    """
+    Создаёт таблицу user_topic_progress и переносит в неё пройденные темы
+    из JSON-поля users.progress. Дата прохождения старых тем неизвестна,
+    поэтому берётся дата последнего урока. JSON разбирается в Python пачками
+    учеников: повреждённое значение одного ученика не прерывает миграцию,
+    такие ученики перечисляются в выводе. Повторный запуск безопасен.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[UserTopicProgress.__table__])
+
+    migrated = 0
+    broken = []
+    last_id = None
+    while True:
+        async with engine.begin() as conn:
+            result = await conn.execute(
+                text(
+                    "SELECT id, progress, COALESCE(last_lesson_date, created_at, CURRENT_TIMESTAMP) FROM users "
+                    "WHERE (CAST(:last_id AS BIGINT) IS NULL OR id > :last_id) ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": last_id, "limit": BATCH_SIZE}
+            )
+            users = result.all()
+            if not users:
+                break
+            last_id = users[-1][0]
+
+            rows = []
+            for user_id, progress, completed_at in users:
+                topic_ids = parse_progress(progress)
+                if topic_ids is None:
+                    broken.append(user_id)
+                    continue
+                rows.extend(
+                    {"user_id": user_id, "topic_id": topic_id, "completed_at": completed_at}
+                    for topic_id in set(topic_ids)
+                )
+            if rows:
+                result = await conn.execute(
+                    text(
+                        "INSERT INTO user_topic_progress (user_id, topic_id, completed_at) "
+                        "SELECT :user_id, t.id, :completed_at FROM topics t WHERE t.id = :topic_id "
+                        "ON CONFLICT (user_id, topic_id) DO NOTHING"
+                    ),
+                    rows
+                )
+                migrated += max(result.rowcount, 0)
+
+    print(f"✅ Перенесено пройденных тем из users.progress: {migrated}")
+    if broken:
+        print(f"⚠️ Не удалось разобрать users.progress у учеников ({len(broken)}): {broken[:20]}")
+
+
+async def migrate_scheduled_runs_shard():
+    """
+    Добавляет в scheduled_runs номер шарда: запуск рассылки учитывается по каждому шарду отдельно.
+    """
+    async with engine.connect() as conn:
+        exists = (await conn.execute(text("SELECT to_regclass('scheduled_runs')"))).scalar_one()
+    if exists is None:
+        print("✅ Таблицы scheduled_runs ещё нет, она будет создана при запуске бота")
+        return
+
+    await add_column("scheduled_runs", "shard INTEGER NOT NULL DEFAULT 0")
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "ALTER TABLE scheduled_runs DROP CONSTRAINT IF EXISTS uq_scheduled_runs_job_id_scheduled_for"
+        ))
+        result = await conn.execute(text(
+            "SELECT 1 FROM pg_constraint WHERE conname = 'uq_scheduled_runs_job_id_scheduled_for_shard'"
+        ))
+        if result.scalar_one_or_none() is None:
+            await conn.execute(text(
+                "ALTER TABLE scheduled_runs ADD CONSTRAINT uq_scheduled_runs_job_id_scheduled_for_shard "
+                "UNIQUE (job_id, scheduled_for, shard)"
+            ))
+    print("✅ scheduled_runs учитывает шарды")
+
+
+async def migrate_partition_message_history():
+    """
+    Переводит message_history на секционирование по месяцам без переписывания данных:
+    старая таблица становится секцией message_history_legacy (все строки до начала
+    следующего месяца), новые месяцы идут в отдельные секции.
+
+    Долгие шаги (индексы и проверка CHECK-ограничения) выполняются без блокировки записи,
+    исключительная блокировка берётся только на короткую финальную транзакцию
+    с переименованиями и ATTACH PARTITION. ATTACH не строит индексы заново, только если
+    у старой таблицы уже есть подходящий индекс для каждого индекса новой: для первичного
+    ключа (id, timestamp) - уникальное ограничение, для остальных - такие же индексы.
+    """
+    async with engine.connect() as conn:
+        if await is_partitioned(conn):
+            print("✅ message_history уже секционирована")
+            return
+
+    boundary = month_start(datetime.utcnow(), 1)
+    bound_literal = f"'{boundary:%Y-%m-%d}'"
+    table = MessageHistory.__table__
+    legacy = f"{table.name}_legacy"
+
+    # 1. Ограничение, совпадающее с границами будущей секции: с ним ATTACH не сканирует таблицу
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            'UPDATE message_history SET "timestamp" = now() AT TIME ZONE \'utc\' WHERE "timestamp" IS NULL'
+        ))
+        await conn.execute(text(
+            "ALTER TABLE message_history DROP CONSTRAINT IF EXISTS message_history_legacy_bound"
+        ))
+        await conn.execute(text(
+            "ALTER TABLE message_history ADD CONSTRAINT message_history_legacy_bound "
+            f'CHECK ("timestamp" IS NOT NULL AND "timestamp" < {bound_literal}) NOT VALID'
+        ))
+    async with engine.begin() as conn:
+        await conn.execute(text("ALTER TABLE message_history VALIDATE CONSTRAINT message_history_legacy_bound"))
+    print(f"✅ Ограничение message_history_legacy_bound (до {boundary:%Y-%m-%d}) проверено")
+
+    # 2. Индексы под индексы секционированной таблицы: уникальный под составной первичный ключ
+    # и индексы моделей (обычно уже созданы миграцией indexes)
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text(
+            'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS message_history_legacy_id_timestamp_key '
+            'ON message_history (id, "timestamp")'
+        ))
+    print("✅ Индекс message_history_legacy_id_timestamp_key создан")
+    for index in sorted(table.indexes, key=lambda i: i.name):
+        await create_index_concurrently(index)
+
+    # 3. Короткая транзакция: старая таблица -> секция новой
+    async with engine.begin() as conn:
+        await conn.execute(text("LOCK TABLE message_history IN ACCESS EXCLUSIVE MODE"))
+        # NOT NULL не сканирует таблицу благодаря проверенному CHECK-ограничению
+        await conn.execute(text('ALTER TABLE message_history ALTER COLUMN "timestamp" SET NOT NULL'))
+        await conn.execute(text(f'ALTER TABLE message_history RENAME TO "{legacy}"'))
+        await conn.execute(text(f'ALTER TABLE "{legacy}" RENAME CONSTRAINT message_history_pkey TO "{legacy}_pkey"'))
+        await conn.execute(text(f'ALTER SEQUENCE IF EXISTS message_history_id_seq RENAME TO "{legacy}_id_seq"'))
+        for index in table.indexes:
+            await conn.execute(text(f'ALTER INDEX IF EXISTS "{index.name}" RENAME TO "{index.name}_legacy"'))
+        # Первичный ключ секционированной таблицы подключается только к индексу ограничения:
+        # обычный уникальный индекс ATTACH не использовал бы и построил новый под блокировкой
+        await conn.execute(text(
+            f'ALTER TABLE "{legacy}" ADD CONSTRAINT message_history_legacy_id_timestamp_key '
+            "UNIQUE USING INDEX message_history_legacy_id_timestamp_key"
+        ))
+
+        # Пустая секционированная таблица создаётся вместе с индексами мгновенно
+        await conn.run_sync(partitioned_message_history_table(table).create)
+        await conn.execute(text(
+            f"SELECT setval('message_history_id_seq', (SELECT COALESCE(MAX(id), 0) + 1 FROM \"{legacy}\"), false)"
+        ))
+        # Подходящие индексы старой таблицы подключаются к индексам новой без перестроения
+        await conn.execute(text(
+            f'ALTER TABLE message_history ATTACH PARTITION "{legacy}" FOR VALUES FROM (MINVALUE) TO ({bound_literal})'
+        ))
+        partitions = await ensure_message_history_partitions(conn)
+    print(f"✅ message_history секционирована, созданы секции: {', '.join(partitions)}")
+
+
+def get_model_index(name: str) -> Index:
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(f"Индекс {name} не объявлен в моделях")
+
+
+async def create_model_index(name: str):
+    """
+    Создаёт один индекс, объявленный в моделях.
+    """
+    await create_index_concurrently(get_model_index(name))
+
+
+# Миграции в порядке применения: сначала изменения колонок, затем все индексы моделей,
+# в конце - секционирование (готовые индексы старой таблицы подключаются без перестроения)
+MIGRATIONS = {
+    "message_kind": migrate_message_kind,
+    "user_topic_progress": migrate_user_topic_progress,
+    "scheduled_runs_shard": migrate_scheduled_runs_shard,
+    "indexes": migrate_indexes,
+    "partition_message_history": migrate_partition_message_history,
+}
+
+
+async def main(names=None):
+    for name in names or MIGRATIONS:
+        if name not in MIGRATIONS:
+            print(f"❌ Неизвестная миграция: {name}. Доступны: {', '.join(MIGRATIONS)}")
+            return
+        print(f"🚀 Миграция: {name}")
+        await MIGRATIONS[name]()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
@@ -1,4 +1,7 @@
-from sqlalchemy import Column, Integer, String, Boolean, Text, DateTime, ForeignKey, BigInteger
+from sqlalchemy import (
+    Column, Integer, String, Boolean, Text, Date, DateTime, ForeignKey, BigInteger, Index, LargeBinary,
+    UniqueConstraint
+)
 from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime
 from sqlalchemy import func
@@ -28,27 +31,72 @@ class User(Base):
     id = Column(BigInteger, primary_key=True)  # Telegram user id
     current_topic_id = Column(Integer, ForeignKey("topics.id"), nullable=True)  # Текущая тема
     last_lesson_date = Column(DateTime, nullable=True)  # Дата последнего урока
-    progress = Column(Text, default="[]")  # JSON: список id пройденных тем
+    progress = Column(Text, default="[]")  # Устарело: JSON со списком id пройденных тем (см. UserTopicProgress)
     created_at = Column(DateTime, default=datetime.utcnow)  # Дата регистрации
 
     # Связи с другими таблицами
     topic = relationship("Topic", foreign_keys=[current_topic_id])
+    topic_progress = relationship("UserTopicProgress", back_populates="user")
     messages = relationship("MessageHistory", back_populates="user")
     homeworks = relationship("Homework", back_populates="user")
 
 
+class UserTopicProgress(Base):
+    """
+    Модель для хранения пройденных пользователем тем.
+    """
+    __tablename__ = "user_topic_progress"
+
+    user_id = Column(BigInteger, ForeignKey("users.id"), primary_key=True)  # ID пользователя
+    topic_id = Column(Integer, ForeignKey("topics.id"), primary_key=True)  # ID пройденной темы
+    completed_at = Column(DateTime, default=datetime.utcnow)  # Дата прохождения темы
+
+    # Связи с другими таблицами
+    user = relationship("User", back_populates="topic_progress")
+    topic = relationship("Topic")
+
+
+class MessageKind:
+    """
+    Тип сообщения в истории (колонка MessageHistory.kind).
+    Домашние задания и ответы на них хранятся в Homework, а не в истории.
+    """
+    LESSON = "lesson"  # Диалог урока и общение с учителем
+    REINFORCEMENT_QUESTION = "reinforcement_question"  # Вопрос на закрепление от планировщика
+    REINFORCEMENT_ANSWER = "reinforcement_answer"  # Ответ ученика на вопрос на закрепление
+    FEEDBACK = "feedback"  # Обратная связь по ответу на закрепление
+    ENDING = "ending"  # Завершение урока (ученик перестал отвечать)
+
+    ALL = (LESSON, REINFORCEMENT_QUESTION, REINFORCEMENT_ANSWER, FEEDBACK, ENDING)
+
+    # Служебные сообщения бота, которые не означают, что ученик занимался
+    SERVICE = (REINFORCEMENT_QUESTION, ENDING)
+
+
 class MessageHistory(Base):
     """
-    Модель для хранения истории сообщений (20 последних для каждого пользователя).
+    Модель для хранения истории сообщений. Здесь хранятся последние итерации
+    каждого пользователя, более старые сообщения задача очистки (database/retention.py)
+    переносит в message_history_archive.
     """
     __tablename__ = "message_history"
-
+    __table_args__ = (
+        # История пользователя всегда читается по user_id с сортировкой по времени
+        Index("ix_message_history_user_id_timestamp", "user_id", "timestamp"),
+        # Поиск сообщений определённого типа (вопросы на закрепление, завершения урока)
+        Index("ix_message_history_user_id_kind_timestamp", "user_id", "kind", "timestamp"),
+    )
+
+    # В PostgreSQL таблица секционирована по месяцам, и первичный ключ в БД составной
+    # (id, timestamp) - см. database/partitions.py. Для ORM достаточно id из последовательности
     id = Column(Integer, primary_key=True)
     user_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)  # ID пользователя
     role = Column(String(10), nullable=False)  # "bot" или "user"
     content = Column(Text, nullable=False)  # Текст сообщения
     voice_file_id = Column(String(255), nullable=True)  # ID голосового файла в Telegram
     timestamp = Column(DateTime, default=datetime.utcnow)  # Время отправки
+    kind = Column(String(32), nullable=False, default=MessageKind.LESSON, server_default=MessageKind.LESSON)  # Тип сообщения (MessageKind)
+    question_text = Column(Text, nullable=True)  # Текст вопроса на закрепление без оформления
 
     # Связь с пользователем
     user = relationship("User", back_populates="messages")
@@ -59,6 +107,10 @@ class Homework(Base):
     Модель для хранения домашних заданий.
     """
     __tablename__ = "homeworks"
+    __table_args__ = (
+        # Поиск последнего непроверенного ДЗ пользователя
+        Index("ix_homeworks_user_id_is_checked_date_assigned", "user_id", "is_checked", "date_assigned"),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)  # ID пользователя
@@ -72,4 +124,84 @@ class Homework(Base):
 
     # Связи с другими таблицами
     user = relationship("User", back_populates="homeworks")
-    topic = relationship("Topic")
\ No newline at end of file
+    topic = relationship("Topic")
+
+class VoiceUpload(Base):
+    """
+    Реестр загруженных в Telegram голосовых: хэш содержимого аудио -> file_id.
+    Повторяющееся аудио (урок дня, фразы из кэша озвучки) отправляется по file_id
+    без повторной загрузки файла. Записи старше VOICE_UPLOAD_KEEP_DAYS удаляются.
+    """
+    __tablename__ = "voice_uploads"
+
+    audio_hash = Column(String(64), primary_key=True)  # sha256 байтов аудио
+    file_id = Column(String(255), nullable=False)  # file_id голосового в Telegram
+    created_at = Column(DateTime, default=datetime.utcnow)  # Дата загрузки
+
+
+class DailyLessonContent(Base):
+    """
+    Урок дня для темы, подготовленный заранее до рассылки: приветствие,
+    задание и озвучка приветствия. Общий для всех учеников на этой теме.
+    """
+    __tablename__ = "daily_lesson_content"
+
+    topic_id = Column(Integer, ForeignKey("topics.id"), primary_key=True)  # ID темы
+    lesson_date = Column(Date, primary_key=True)  # День урока (в часовом поясе планировщика)
+    lesson_text = Column(Text, nullable=False)  # Приветствие урока
+    task_text = Column(Text, nullable=False)  # Задание урока
+    audio = Column(LargeBinary, nullable=True)  # Озвучка приветствия (mp3)
+    created_at = Column(DateTime, default=datetime.utcnow)  # Дата подготовки
+
+
+class MessageHistoryArchive(Base):
+    """
+    Архив старых сообщений из message_history. Сообщения одного пользователя
+    за один месяц хранятся пачками в виде сжатого (zlib) JSON.
+    """
+    __tablename__ = "message_history_archive"
+    __table_args__ = (
+        Index("ix_message_history_archive_user_id_period_start", "user_id", "period_start"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)  # ID пользователя
+    period_start = Column(DateTime, nullable=False)  # Первое число месяца, к которому относятся сообщения
+    first_timestamp = Column(DateTime, nullable=False)  # Время самого раннего сообщения в пачке
+    last_timestamp = Column(DateTime, nullable=False)  # Время самого позднего сообщения в пачке
+    messages_count = Column(Integer, nullable=False)  # Количество сообщений в пачке
+    payload = Column(LargeBinary, nullable=False)  # Сообщения: zlib(JSON-список)
+    created_at = Column(DateTime, default=datetime.utcnow)  # Дата архивации
+
+
+class ScheduledRun(Base):
+    """
+    Запуск задачи планировщика на конкретное время по расписанию для одного шарда учеников.
+    Позволяет после перезапуска бота понять, какие рассылки не были доведены до конца.
+    """
+    __tablename__ = "scheduled_runs"
+    __table_args__ = (
+        UniqueConstraint("job_id", "scheduled_for", "shard", name="uq_scheduled_runs_job_id_scheduled_for_shard"),
+    )
+
+    id = Column(Integer, primary_key=True)  # run_id
+    job_id = Column(String(64), nullable=False)  # ID задачи планировщика (daily_lesson и т.д.)
+    scheduled_for = Column(DateTime, nullable=False)  # Время запуска по расписанию (UTC)
+    shard = Column(Integer, nullable=False, default=0)  # Шард учеников (user_id % SCHEDULER_SHARDS)
+    status = Column(String(16), nullable=False, default="running")  # running / completed
+    started_at = Column(DateTime, default=datetime.utcnow)  # Время первого старта
+    finished_at = Column(DateTime, nullable=True)  # Время завершения
+    summary = Column(Text, nullable=True)  # Итоги рассылки
+
+
+class BroadcastDelivery(Base):
+    """
+    Журнал рассылки: результат обработки каждого ученика в запуске задачи.
+    """
+    __tablename__ = "broadcast_ledger"
+
+    run_id = Column(Integer, ForeignKey("scheduled_runs.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)  # ID ученика (чат)
+    status = Column(String(16), nullable=False)  # sent / skipped / blocked / failed
+    error = Column(Text, nullable=True)  # Текст ошибки
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
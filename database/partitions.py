@@ -0,0 +1,138 @@
+# Секционирование message_history по месяцам (PostgreSQL, PARTITION BY RANGE ("timestamp")).
+# Ключ секционирования должен входить в первичный ключ, поэтому в PostgreSQL таблица
+# создаётся с составным ключом (id, timestamp) по partitioned_message_history_table();
+# в модели ключ остаётся простым (id), и в других СУБД (SQLite для отладки) таблица обычная.
+# Секция месяца называется message_history_yYYYYmMM. Секции создаются заранее:
+# при create_db и ежедневной задачей планировщика на MESSAGE_HISTORY_PARTITIONS_AHEAD
+# месяцев вперёд. Секция по умолчанию (message_history_default) страхует вставку,
+# если секция месяца почему-то не создана.
+#
+# Существующая несекционированная таблица переводится миграцией:
+#   python -m database.migrations partition_message_history
+import os
+from datetime import datetime
+from typing import List
+
+from dotenv import load_dotenv
+from sqlalchemy import MetaData, PrimaryKeyConstraint, Table, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+load_dotenv()
+
+# На сколько месяцев вперёд создавать секции (кроме текущего)
+MESSAGE_HISTORY_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_HISTORY_PARTITIONS_AHEAD", "2"))
+
+PARENT_TABLE = "message_history"
+DEFAULT_PARTITION = f"{PARENT_TABLE}_default"
+
+
+def month_start(moment: datetime, months_ahead: int = 0) -> datetime:
+    """
+    Первое число месяца, отстоящего от moment на months_ahead месяцев.
+    """
+    month_index = moment.year * 12 + moment.month - 1 + months_ahead
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"{PARENT_TABLE}_y{month.year:04d}m{month.month:02d}"
+
+
+def partitioned_message_history_table(table: Table) -> Table:
+    """
+    Копия таблицы модели MessageHistory для PostgreSQL: PARTITION BY RANGE ("timestamp")
+    и составной первичный ключ (id, timestamp), индексы те же.
+    """
+    metadata = MetaData()
+    # Таблицы, на которые ссылаются внешние ключи, нужны в той же MetaData
+    for foreign_key in table.foreign_keys:
+        foreign_key.column.table.to_metadata(metadata)
+    partitioned = table.to_metadata(metadata)
+    partitioned.c.id.autoincrement = True
+    partitioned.c["timestamp"].primary_key = True
+    partitioned.c["timestamp"].nullable = False
+    partitioned.append_constraint(PrimaryKeyConstraint(partitioned.c.id, partitioned.c["timestamp"]))
+    partitioned.dialect_options["postgresql"]["partition_by"] = 'RANGE ("timestamp")'
+    return partitioned
+
+
+def create_tables(sync_conn, metadata: MetaData, table: Table) -> None:
+    """
+    create_all для run_sync: в PostgreSQL таблица table (message_history)
+    создаётся секционированной.
+    """
+    if sync_conn.dialect.name != "postgresql":
+        metadata.create_all(sync_conn)
+        return
+    metadata.create_all(sync_conn, tables=[t for t in metadata.sorted_tables if t is not table])
+    partitioned_message_history_table(table).create(sync_conn, checkfirst=True)
+
+
+async def is_partitioned(conn: AsyncConnection, table_name: str = PARENT_TABLE) -> bool:
+    """
+    Проверяет, что таблица секционирована (в других СУБД всегда False).
+    """
+    if conn.dialect.name != "postgresql":
+        return False
+    result = await conn.execute(
+        text(
+            "SELECT 1 FROM pg_partitioned_table p "
+            "JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relname = :name AND pg_table_is_visible(c.oid)"
+        ),
+        {"name": table_name}
+    )
+    return result.scalar_one_or_none() is not None
+
+
+async def create_month_partition(conn: AsyncConnection, month: datetime) -> bool:
+    """
+    Создаёт секцию месяца, если её ещё нет. Индексы родительской таблицы
+    PostgreSQL создаёт на новой секции автоматически.
+
+    Returns:
+        False, если месяц уже покрыт другой секцией (например, старой таблицей
+        message_history_legacy после миграции)
+    """
+    month = month_start(month)
+    next_month = month_start(month, 1)
+    try:
+        async with conn.begin_nested():
+            await conn.execute(text(
+                f'CREATE TABLE IF NOT EXISTS "{partition_name(month)}" PARTITION OF "{PARENT_TABLE}" '
+                f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month:%Y-%m-%d}')"
+            ))
+    except DBAPIError as e:
+        if "overlap" not in str(e):
+            raise
+        return False
+    return True
+
+
+async def ensure_message_history_partitions(
+    conn: AsyncConnection,
+    months_ahead: int = MESSAGE_HISTORY_PARTITIONS_AHEAD,
+    now: datetime = None
+) -> List[str]:
+    """
+    Создаёт секции текущего месяца и months_ahead следующих, а также секцию по умолчанию.
+    Если таблица не секционирована, ничего не делает.
+
+    Returns:
+        Имена месячных секций на текущий и следующие месяцы
+    """
+    if not await is_partitioned(conn):
+        return []
+
+    now = now or datetime.utcnow()
+    names = []
+    for offset in range(months_ahead + 1):
+        month = month_start(now, offset)
+        if await create_month_partition(conn, month):
+            names.append(partition_name(month))
+
+    await conn.execute(text(
+        f'CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION}" PARTITION OF "{PARENT_TABLE}" DEFAULT'
+    ))
+    return names
@@ -0,0 +1,203 @@
+# Очистка message_history: у каждого пользователя в таблице остаются последние
+# MESSAGE_RETENTION_KEEP_TURNS итераций, более старые сообщения переносятся
+# в message_history_archive (сжатый JSON по месяцам) и удаляются из горячей таблицы.
+#
+# Удаление идёт небольшими пачками, каждая пачка - отдельная короткая транзакция
+# (DELETE ... RETURNING + INSERT в архив), поэтому таблица не блокируется надолго.
+#
+# Запускается задачей планировщика раз в сутки или вручную:
+#   python -m database.retention
+import asyncio
+import json
+import os
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from sqlalchemy import select, delete, insert, func
+
+from database.engine import engine, session_maker, create_db
+from database.models import MessageHistory, MessageHistoryArchive
+
+load_dotenv()
+
+MESSAGE_RETENTION_ENABLED = os.getenv("MESSAGE_RETENTION_ENABLED", "true").lower() == "true"
+# Сколько последних итераций (сообщение ученика + ответ бота) оставлять в message_history
+MESSAGE_RETENTION_KEEP_TURNS = int(os.getenv("MESSAGE_RETENTION_KEEP_TURNS", "20"))
+# Сообщения моложе стольких дней не архивируются (по ним ищется тема недели)
+MESSAGE_RETENTION_MIN_AGE_DAYS = int(os.getenv("MESSAGE_RETENTION_MIN_AGE_DAYS", "8"))
+# Сколько строк удалять за одну транзакцию и пауза между транзакциями (сек)
+MESSAGE_RETENTION_BATCH_SIZE = int(os.getenv("MESSAGE_RETENTION_BATCH_SIZE", "500"))
+MESSAGE_RETENTION_PAUSE = float(os.getenv("MESSAGE_RETENTION_PAUSE", "0.05"))
+# Время ежедневного запуска (в часовом поясе планировщика)
+MESSAGE_RETENTION_TIME = os.getenv("MESSAGE_RETENTION_TIME", "03:30")
+
+ARCHIVED_COLUMNS = (
+    MessageHistory.id,
+    MessageHistory.role,
+    MessageHistory.content,
+    MessageHistory.voice_file_id,
+    MessageHistory.timestamp,
+    MessageHistory.kind,
+    MessageHistory.question_text,
+)
+
+
+def pack_messages(rows: List[Dict]) -> bytes:
+    """
+    Сжимает список сообщений для архива.
+    """
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+def unpack_messages(payload: bytes) -> List[Dict]:
+    """
+    Распаковывает сообщения из архива.
+    """
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+def _month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1)
+
+
+async def _users_over_limit(keep_messages: int) -> List[int]:
+    """
+    Пользователи, у которых в message_history больше сообщений, чем нужно хранить.
+    """
+    async with session_maker() as session:
+        result = await session.execute(
+            select(MessageHistory.user_id)
+            .group_by(MessageHistory.user_id)
+            .having(func.count() > keep_messages)
+        )
+        return list(result.scalars().all())
+
+
+async def _archive_boundary(user_id: int, keep_messages: int, cutoff: datetime) -> Optional[datetime]:
+    """
+    Время, раньше которого сообщения пользователя можно архивировать:
+    самое раннее из последних keep_messages сообщений, но не позже cutoff.
+    """
+    async with session_maker() as session:
+        result = await session.execute(
+            select(MessageHistory.timestamp)
+            .where(MessageHistory.user_id == user_id)
+            .order_by(MessageHistory.timestamp.desc())
+            .offset(keep_messages - 1)
+            .limit(1)
+        )
+        oldest_kept = result.scalar_one_or_none()
+    if oldest_kept is None:
+        return None
+    return min(oldest_kept, cutoff)
+
+
+async def _archive_batch(user_id: int, boundary: datetime, batch_size: int) -> int:
+    """
+    Переносит в архив одну пачку самых старых сообщений пользователя.
+    Возвращает количество перенесённых сообщений.
+    """
+    async with session_maker() as session:
+        batch_ids = (
+            select(MessageHistory.id)
+            .where(MessageHistory.user_id == user_id, MessageHistory.timestamp < boundary)
+            .order_by(MessageHistory.timestamp)
+            .limit(batch_size)
+            .scalar_subquery()
+        )
+        result = await session.execute(
+            delete(MessageHistory)
+            # Граница по времени позволяет не заглядывать в свежие секции message_history
+            .where(MessageHistory.id.in_(batch_ids), MessageHistory.timestamp < boundary)
+            .returning(*ARCHIVED_COLUMNS)
+        )
+        rows = [dict(row._mapping) for row in result]
+        if not rows:
+            return 0
+
+        # Одна запись архива на каждый месяц, попавший в пачку
+        months: Dict[datetime, List[Dict]] = {}
+        for row in sorted(rows, key=lambda r: (r["timestamp"], r["id"])):
+            months.setdefault(_month_start(row["timestamp"]), []).append(row)
+
+        await session.execute(insert(MessageHistoryArchive), [
+            {
+                "user_id": user_id,
+                "period_start": period_start,
+                "first_timestamp": month_rows[0]["timestamp"],
+                "last_timestamp": month_rows[-1]["timestamp"],
+                "messages_count": len(month_rows),
+                "payload": pack_messages(month_rows),
+            }
+            for period_start, month_rows in months.items()
+        ])
+        await session.commit()
+        return len(rows)
+
+
+async def compact_message_history(
+    keep_turns: int = MESSAGE_RETENTION_KEEP_TURNS,
+    min_age_days: int = MESSAGE_RETENTION_MIN_AGE_DAYS,
+    batch_size: int = MESSAGE_RETENTION_BATCH_SIZE,
+) -> Tuple[int, int]:
+    """
+    Архивирует старые сообщения всех пользователей.
+
+    Returns:
+        (количество обработанных пользователей, количество перенесённых сообщений)
+    """
+    keep_messages = max(1, keep_turns * 2)
+    cutoff = datetime.utcnow() - timedelta(days=min_age_days)
+
+    user_ids = await _users_over_limit(keep_messages)
+    archived_total = 0
+
+    for user_id in user_ids:
+        try:
+            boundary = await _archive_boundary(user_id, keep_messages, cutoff)
+            if boundary is None:
+                continue
+
+            while True:
+                archived = await _archive_batch(user_id, boundary, batch_size)
+                archived_total += archived
+                if archived < batch_size:
+                    break
+                # Даём обработчикам бота поработать между транзакциями
+                await asyncio.sleep(MESSAGE_RETENTION_PAUSE)
+        except Exception as e:
+            print(f"❌ Ошибка при архивации истории пользователя {user_id}: {e}")
+
+    return len(user_ids), archived_total
+
+
+async def get_archived_messages(session, user_id: int, since: Optional[datetime] = None) -> List[Dict]:
+    """
+    Возвращает архивные сообщения пользователя в хронологическом порядке.
+    """
+    query = select(MessageHistoryArchive).where(MessageHistoryArchive.user_id == user_id)
+    if since is not None:
+        query = query.where(MessageHistoryArchive.last_timestamp >= since)
+    result = await session.execute(query.order_by(MessageHistoryArchive.first_timestamp))
+
+    messages = []
+    for archive in result.scalars().all():
+        messages.extend(unpack_messages(archive.payload))
+    return messages
+
+
+async def main():
+    await create_db()
+    started = time.monotonic()
+    users, archived = await compact_message_history()
+    print(f"✅ Пользователей: {users}, перенесено в архив сообщений: {archived} за {time.monotonic() - started:.1f} сек")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,143 @@
+# Каталог тем в памяти процесса. Темы меняются только через database/load_topics.py,
+# поэтому обработчики и планировщик берут их отсюда, а не из БД на каждое сообщение.
+#
+# Каталог загружается при запуске бота и перечитывается:
+# - по команде администратора /reload_topics;
+# - после load_topics (в том же процессе);
+# - по истечении TOPIC_CACHE_TTL секунд (темы, загруженные другим процессом);
+# - если запрошена тема, которой нет в каталоге.
+import asyncio
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import select
+
+from database.engine import session_maker
+from database.models import Topic
+
+load_dotenv()
+
+# Через сколько секунд перечитывать темы из БД (0 - только по команде)
+TOPIC_CACHE_TTL = int(os.getenv("TOPIC_CACHE_TTL", "600"))
+# Не чаще раза в столько секунд перечитывать темы из-за запроса отсутствующей темы
+TOPIC_MISS_RELOAD_INTERVAL = 30
+
+
+class CachedTopic:
+    """
+    Тема из каталога: те же поля, что у модели Topic, и разобранный список заданий.
+    """
+
+    __slots__ = ("id", "title", "description", "tasks", "task_list", "is_completed")
+
+    def __init__(self, topic: Topic):
+        self.id = topic.id
+        self.title = topic.title
+        self.description = topic.description
+        self.tasks = topic.tasks  # JSON-строка, как в БД
+        self.is_completed = topic.is_completed
+        try:
+            self.task_list: List[str] = json.loads(topic.tasks) if topic.tasks else []
+        except (TypeError, ValueError):
+            print(f"⚠️ Некорректный JSON заданий у темы {topic.id}")
+            self.task_list = []
+
+    def as_dict(self) -> Dict:
+        """
+        Тема в формате для запросов к OpenAI.
+        """
+        return {
+            "title": str(self.title),
+            "description": str(self.description),
+            "tasks": list(self.task_list),
+        }
+
+
+class TopicCatalog:
+    """
+    Все темы, упорядоченные по id (в этом порядке ученики их проходят).
+    """
+
+    def __init__(self, ttl: int = TOPIC_CACHE_TTL):
+        self.ttl = ttl
+        self._topics: Dict[int, CachedTopic] = {}
+        self._ordered: List[CachedTopic] = []
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_stale(self) -> bool:
+        if self._loaded_at is None:
+            return True
+        return bool(self.ttl) and time.monotonic() - self._loaded_at > self.ttl
+
+    async def load(self) -> int:
+        """
+        Перечитывает все темы из БД. Возвращает количество тем.
+        """
+        async with session_maker() as session:
+            result = await session.execute(select(Topic).order_by(Topic.id))
+            topics = [CachedTopic(topic) for topic in result.scalars().all()]
+
+        self._ordered = topics
+        self._topics = {topic.id: topic for topic in topics}
+        self._loaded_at = time.monotonic()
+        return len(topics)
+
+    def invalidate(self) -> None:
+        """
+        Помечает каталог устаревшим: при следующем обращении темы перечитываются.
+        """
+        self._loaded_at = None
+
+    async def _ensure_loaded(self, force: bool = False) -> None:
+        if not force and not self.is_stale:
+            return
+        loaded_at = self._loaded_at
+        async with self._lock:
+            # Пока ждали блокировку, каталог мог перечитать другой обработчик
+            if self._loaded_at != loaded_at and not self.is_stale:
+                return
+            try:
+                count = await self.load()
+                print(f"📚 Каталог тем загружен: {count} тем")
+            except Exception as e:
+                # Оставляем прежние темы, если они были
+                print(f"❌ Ошибка при загрузке каталога тем: {e}")
+                if not self._topics:
+                    raise
+
+    async def get(self, topic_id: Optional[int]) -> Optional[CachedTopic]:
+        """
+        Возвращает тему по id или None.
+        """
+        if topic_id is None:
+            return None
+        await self._ensure_loaded()
+        topic = self._topics.get(topic_id)
+        if topic is None and (self._loaded_at is None or time.monotonic() - self._loaded_at > TOPIC_MISS_RELOAD_INTERVAL):
+            # Возможно, тема добавлена после загрузки каталога
+            await self._ensure_loaded(force=True)
+            topic = self._topics.get(topic_id)
+        return topic
+
+    async def all(self) -> List[CachedTopic]:
+        await self._ensure_loaded()
+        return list(self._ordered)
+
+    async def first_not_in(self, completed_ids: Iterable[int]) -> Optional[CachedTopic]:
+        """
+        Первая по порядку тема, id которой нет среди completed_ids.
+        """
+        completed_ids = set(completed_ids)
+        for topic in await self.all():
+            if topic.id not in completed_ids:
+                return topic
+        return None
+
+
+# Глобальный каталог тем
+topic_catalog = TopicCatalog()
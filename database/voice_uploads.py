@@ -0,0 +1,97 @@
+# Реестр загруженных голосовых: хэш аудио -> file_id Telegram.
+# Ежедневная рассылка отправляет всем ученикам одной темы одно и то же аудио,
+# поэтому файл загружается один раз, а дальше отправляется по file_id.
+# В реестр попадает только повторяющееся аудио (урок дня, фразы из кэша озвучки):
+# уникальные ответы ученикам регистрировать бессмысленно.
+#
+# Два уровня, оба ограничены: в памяти процесса - LRU на VOICE_UPLOAD_MEMORY_ITEMS
+# записей, в таблице voice_uploads записи старше VOICE_UPLOAD_KEEP_DAYS дней
+# удаляются при сохранении новых.
+import hashlib
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import delete
+
+from database.engine import session_maker
+from database.models import VoiceUpload
+
+load_dotenv()
+
+# Сколько file_id держать в памяти процесса
+VOICE_UPLOAD_MEMORY_ITEMS = int(os.getenv("VOICE_UPLOAD_MEMORY_ITEMS", "1024"))
+# Сколько дней хранить file_id в БД
+VOICE_UPLOAD_KEEP_DAYS = int(os.getenv("VOICE_UPLOAD_KEEP_DAYS", "30"))
+
+# Копия реестра в памяти процесса, чтобы не ходить в БД на каждую отправку
+_file_ids: "OrderedDict[str, str]" = OrderedDict()
+
+
+def hash_audio(audio_bytes: bytes) -> str:
+    """
+    Возвращает хэш содержимого аудио (ключ реестра).
+    """
+    return hashlib.sha256(audio_bytes).hexdigest()
+
+
+def _remember(audio_hash: str, file_id: str) -> None:
+    _file_ids[audio_hash] = file_id
+    _file_ids.move_to_end(audio_hash)
+    while len(_file_ids) > VOICE_UPLOAD_MEMORY_ITEMS:
+        _file_ids.popitem(last=False)
+
+
+async def get_voice_file_id(audio_hash: str) -> Optional[str]:
+    """
+    Ищет file_id для аудио с заданным хэшем: сначала в памяти, затем в БД.
+    """
+    file_id = _file_ids.get(audio_hash)
+    if file_id:
+        _file_ids.move_to_end(audio_hash)
+        return file_id
+
+    try:
+        async with session_maker() as session:
+            upload = await session.get(VoiceUpload, audio_hash)
+    except Exception as e:
+        print(f"⚠️ Ошибка при чтении реестра голосовых: {e}")
+        return None
+
+    if upload:
+        _remember(audio_hash, upload.file_id)
+        return upload.file_id
+    return None
+
+
+async def save_voice_file_id(audio_hash: str, file_id: str) -> None:
+    """
+    Сохраняет file_id, который Telegram вернул после загрузки аудио,
+    и удаляет устаревшие записи реестра.
+    """
+    _remember(audio_hash, file_id)
+
+    stale_before = datetime.utcnow() - timedelta(days=VOICE_UPLOAD_KEEP_DAYS)
+    try:
+        async with session_maker() as session:
+            await session.merge(VoiceUpload(audio_hash=audio_hash, file_id=file_id, created_at=datetime.utcnow()))
+            await session.execute(delete(VoiceUpload).where(VoiceUpload.created_at < stale_before))
+            await session.commit()
+    except Exception as e:
+        print(f"⚠️ Ошибка при сохранении file_id в реестр голосовых: {e}")
+
+
+async def forget_voice_file_id(audio_hash: str) -> None:
+    """
+    Удаляет file_id из реестра (например, если Telegram перестал его принимать).
+    """
+    _file_ids.pop(audio_hash, None)
+
+    try:
+        async with session_maker() as session:
+            await session.execute(delete(VoiceUpload).where(VoiceUpload.audio_hash == audio_hash))
+            await session.commit()
+    except Exception as e:
+        print(f"⚠️ Ошибка при удалении file_id из реестра голосовых: {e}")
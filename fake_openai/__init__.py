@@ -0,0 +1 @@
+# Fake OpenAI package
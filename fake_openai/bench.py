@@ -0,0 +1,117 @@
+"""
+Бенчмарк бота против локального fake_openai сервера.
+
+Сценарии:
+- turns: ученики параллельно проходят итерации урока
+  (Whisper -> проверка ответа и ответ учителя -> TTS), как в handle_voice_message;
+- broadcast: рассылка урока N ученикам (ответ учителя + TTS) с фоновым приоритетом,
+  как send_lesson_reminder в планировщике.
+
+Запуск (сервер должен быть запущен, OPENAI_BASE_URL указывает на него):
+    python -m fake_openai.bench turns --users 50 --turns 3
+    python -m fake_openai.bench broadcast --users 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import urllib.request
+from typing import List
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Бенчмарк работает только против локального сервера
+os.environ.setdefault("OPENAI_BASE_URL", "http://127.0.0.1:8089/v1")
+os.environ.setdefault("OPENAI_API_KEY", "fake-key")
+
+from ai.ai import openai_client  # noqa: E402
+from ai.governor import governor, background_job  # noqa: E402
+from speech.whisper_engine import generate_speech, TTS_CACHE_ENABLED  # noqa: E402
+
+TOPIC = {
+    "title": "Досуг и увлечения",
+    "description": "Изучение хобби и увлечений современного подростка.",
+    "tasks": ["Расскажи о своих увлечениях"],
+}
+
+# Несколько килобайт "аудио" для Whisper
+FAKE_VOICE_BYTES = b"OggS" + bytes(8 * 1024)
+
+
+def percentile(values: List[float], p: int) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run_turn(user_index: int, turn: int) -> float:
+    started = time.monotonic()
+    user_text = await openai_client.transcribe_audio(FAKE_VOICE_BYTES)
+    ai_response, _feedback = await openai_client.generate_intelligent_response(
+        user_text, [{"role": "bot", "content": "What do you like to do in your free time?"}], TOPIC
+    )
+    # Уникальный суффикс, чтобы кэш озвучки не исказил результат
+    await generate_speech(f"{ai_response} ({user_index}.{turn})")
+    return time.monotonic() - started
+
+
+async def run_user(user_index: int, turns: int, latencies: List[float]) -> None:
+    for turn in range(turns):
+        latencies.append(await run_turn(user_index, turn))
+
+
+@background_job
+async def run_broadcast_user(user_index: int) -> float:
+    started = time.monotonic()
+    lesson_text = await openai_client.generate_lesson_start_message(TOPIC["title"], TOPIC["description"])
+    await generate_speech(lesson_text)
+    return time.monotonic() - started
+
+
+def fetch_server_stats(path: str = "/stats", method: str = "GET") -> dict:
+    base_url = os.environ["OPENAI_BASE_URL"].rstrip("/")
+    if base_url.endswith("/v1"):
+        base_url = base_url[:-3]
+    request = urllib.request.Request(f"{base_url}{path}", method=method)
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.loads(response.read())
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк бота против fake_openai")
+    parser.add_argument("scenario", choices=["turns", "broadcast"])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=3)
+    args = parser.parse_args()
+
+    fetch_server_stats("/stats/reset", method="POST")
+    print(f"⚙️ Режим ответа: {openai_client.response_mode}, кэш TTS: {TTS_CACHE_ENABLED}")
+
+    started = time.monotonic()
+    latencies: List[float] = []
+
+    if args.scenario == "turns":
+        await asyncio.gather(*(run_user(i, args.turns, latencies) for i in range(args.users)))
+        total = args.users * args.turns
+        label = "итераций урока"
+    else:
+        latencies = list(await asyncio.gather(*(run_broadcast_user(i) for i in range(args.users))))
+        total = args.users
+        label = "учеников в рассылке"
+
+    elapsed = time.monotonic() - started
+    print(f"✅ {total} {label} за {elapsed:.1f} сек ({total / elapsed:.2f} в секунду)")
+    print(
+        f"⏱️ Длительность: p50 {percentile(latencies, 50):.2f} сек, "
+        f"p95 {percentile(latencies, 95):.2f} сек, p99 {percentile(latencies, 99):.2f} сек"
+    )
+    print(f"📊 Регулятор запросов:\n{governor.format_metrics()}")
+    print(f"🧪 Статистика сервера:\n{json.dumps(fetch_server_stats(), indent=2, ensure_ascii=False)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,314 @@
+"""
+Локальный сервер, совместимый с OpenAI API, для нагрузочного тестирования без сети.
+
+Поддерживает эндпоинты, которые использует бот:
+- POST /v1/chat/completions (в том числе stream=True и response_format=json_object)
+- POST /v1/audio/transcriptions
+- POST /v1/audio/speech
+- GET  /stats - счётчики запросов, ошибок, токенов и перцентили задержки
+- POST /stats/reset - обнуление счётчиков
+
+Запуск:
+    python -m fake_openai.server --port 8089
+
+Бот направляется на сервер через .env:
+    OPENAI_BASE_URL=http://localhost:8089/v1
+    OPENAI_API_KEY=fake-key
+
+Задержка и ошибки настраиваются для каждого эндпоинта (CHAT, WHISPER, TTS):
+    FAKE_OPENAI_CHAT_LATENCY=lognormal:0.8:0.4   # распределение задержки (сек)
+    FAKE_OPENAI_CHAT_ERROR_RATE=0.05             # доля ответов с ошибкой 429/500
+    FAKE_OPENAI_STREAM_CHUNK_DELAY=0.02          # пауза между фрагментами потока (сек)
+
+Распределения задержки: const:<сек>, uniform:<мин>:<макс>,
+normal:<среднее>:<отклонение>, lognormal:<медиана>:<sigma>.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+import uuid
+from typing import Callable, Dict, List
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ENDPOINTS = ("chat", "whisper", "tts")
+
+# Задержка и доля ошибок по умолчанию - примерно как у реального API
+DEFAULT_LATENCY = {
+    "chat": "lognormal:0.8:0.4",
+    "whisper": "lognormal:0.6:0.3",
+    "tts": "lognormal:0.9:0.3",
+}
+
+# Тихий кадр MPEG-1 Layer III (128 кбит/с, 44.1 кГц, ~26 мс звука)
+SILENT_MP3_FRAME = bytes.fromhex("fffb9004") + bytes(413)
+
+FAKE_REPLIES = [
+    "Great job! Let's keep practising. Can you tell me more about it?",
+    "Well done! Now try to answer with a full sentence, please.",
+    "Nice try! Remember to use the past simple here. What did you do yesterday?",
+    "Excellent! Your answer is correct. Let's move on to the next question.",
+]
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """
+    Превращает описание распределения в функцию, возвращающую задержку в секундах.
+    """
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+
+    if kind == "const":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка количества токенов (~4 символа на токен).
+    """
+    return max(1, len(text) // 4)
+
+
+class FakeOpenAIServer:
+    """
+    Поддельный OpenAI API со статистикой по каждому эндпоинту.
+    """
+
+    def __init__(self):
+        self.latency: Dict[str, Callable[[], float]] = {}
+        self.error_rate: Dict[str, float] = {}
+        for endpoint in ENDPOINTS:
+            prefix = f"FAKE_OPENAI_{endpoint.upper()}"
+            self.latency[endpoint] = parse_latency(os.getenv(f"{prefix}_LATENCY", DEFAULT_LATENCY[endpoint]))
+            self.error_rate[endpoint] = float(os.getenv(f"{prefix}_ERROR_RATE", "0"))
+        self.stream_chunk_delay = float(os.getenv("FAKE_OPENAI_STREAM_CHUNK_DELAY", "0.02"))
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        self.started_at = time.monotonic()
+        self.stats = {
+            endpoint: {
+                "requests": 0,
+                "errors": 0,
+                "in_flight": 0,
+                "max_in_flight": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "characters": 0,
+                "audio_bytes": 0,
+                "latencies": [],
+            }
+            for endpoint in ENDPOINTS
+        }
+
+    def create_app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/audio/transcriptions", self.transcriptions)
+        app.router.add_post("/v1/audio/speech", self.speech)
+        app.router.add_get("/stats", self.get_stats)
+        app.router.add_post("/stats/reset", self.post_stats_reset)
+        return app
+
+    async def _begin(self, endpoint: str):
+        """
+        Учитывает запрос, выдерживает задержку и, возможно, возвращает ошибку.
+        """
+        stats = self.stats[endpoint]
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        started = time.monotonic()
+
+        try:
+            await asyncio.sleep(self.latency[endpoint]())
+        finally:
+            stats["in_flight"] -= 1
+            stats["latencies"].append(time.monotonic() - started)
+
+        if random.random() < self.error_rate[endpoint]:
+            stats["errors"] += 1
+            status = random.choice([429, 500, 503])
+            error_type = "rate_limit_exceeded" if status == 429 else "server_error"
+            headers = {"retry-after": "1"} if status == 429 else {}
+            return web.json_response(
+                {"error": {"message": f"Fake {status}", "type": error_type, "code": error_type}},
+                status=status,
+                headers=headers
+            )
+        return None
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        error = await self._begin("chat")
+        if error:
+            return error
+
+        messages = body.get("messages", [])
+        prompt_tokens = sum(estimate_tokens(str(m.get("content", ""))) for m in messages)
+
+        if (body.get("response_format") or {}).get("type") == "json_object":
+            content = self._fake_json_reply(messages)
+        else:
+            content = random.choice(FAKE_REPLIES)
+
+        completion_tokens = estimate_tokens(content)
+        stats = self.stats["chat"]
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        model = body.get("model", "gpt-4o-mini")
+        created = int(time.time())
+
+        if body.get("stream"):
+            return await self._stream_chat(request, completion_id, model, created, content)
+
+        return web.json_response({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    async def _stream_chat(self, request: web.Request, completion_id: str, model: str, created: int, content: str):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            delta = word if i == 0 else f" {word}"
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.stream_chunk_delay)
+
+        final_chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        await response.write(f"data: {json.dumps(final_chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _fake_json_reply(self, messages: List[Dict]) -> str:
+        """
+        Ответ в формате объединённого режима (проверка + ответ учителя).
+        """
+        is_correct = random.random() < 0.7
+        return json.dumps({
+            "is_correct": is_correct,
+            "feedback": "Correct!" if is_correct else "Almost! Check the verb tense.",
+            "correct_answer": "" if is_correct else "I went to school yesterday.",
+            "reply": random.choice(FAKE_REPLIES),
+        })
+
+    async def transcriptions(self, request: web.Request) -> web.Response:
+        audio_size = 0
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name == "file":
+                while True:
+                    chunk = await part.read_chunk()
+                    if not chunk:
+                        break
+                    audio_size += len(chunk)
+            else:
+                await part.release()
+
+        error = await self._begin("whisper")
+        if error:
+            return error
+
+        self.stats["whisper"]["audio_bytes"] += audio_size
+        return web.json_response({"text": "Hello, teacher! I went to school yesterday."})
+
+    async def speech(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        error = await self._begin("tts")
+        if error:
+            return error
+
+        text = body.get("input", "")
+        # Примерно 15 символов текста на секунду речи, ~38 кадров mp3 на секунду
+        frames = max(1, int(len(text) / 15 * 38))
+        audio_bytes = SILENT_MP3_FRAME * frames
+
+        stats = self.stats["tts"]
+        stats["characters"] += len(text)
+        stats["audio_bytes"] += len(audio_bytes)
+        return web.Response(body=audio_bytes, content_type="audio/mpeg")
+
+    def summary(self) -> Dict:
+        """
+        Сводная статистика: запросы, ошибки, токены, перцентили задержки.
+        """
+        elapsed = time.monotonic() - self.started_at
+        result = {"elapsed_seconds": round(elapsed, 1)}
+        for endpoint, stats in self.stats.items():
+            latencies = sorted(stats["latencies"])
+            summary = {key: value for key, value in stats.items() if key != "latencies"}
+            summary["requests_per_second"] = round(stats["requests"] / elapsed, 2) if elapsed else 0.0
+            for percentile in (50, 95, 99):
+                if latencies:
+                    index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+                    summary[f"latency_p{percentile}"] = round(latencies[index], 3)
+                else:
+                    summary[f"latency_p{percentile}"] = None
+            result[endpoint] = summary
+        return result
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.summary())
+
+    async def post_stats_reset(self, request: web.Request) -> web.Response:
+        self.reset_stats()
+        return web.json_response({"status": "ok"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный сервер, совместимый с OpenAI API")
+    parser.add_argument("--host", default=os.getenv("FAKE_OPENAI_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("FAKE_OPENAI_PORT", "8089")))
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer()
+    print(f"🧪 Fake OpenAI API: http://{args.host}:{args.port}/v1")
+    web.run_app(server.create_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,23 @@
-from aiogram.types import Message
+from aiogram.types import Message, BufferedInputFile
 import os
 import asyncio
+from typing import Dict, List, Optional, Set
 from dotenv import load_dotenv
 from datetime import datetime
 from aiogram import Bot, types
-from database.models import MessageHistory, Homework
+from database.models import User, MessageHistory, MessageKind, Homework, UserTopicProgress
+from database.topic_catalog import topic_catalog, CachedTopic
 from aiogram import exceptions as tg_exceptions
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, insert, update
+from database.voice_uploads import (
+    hash_audio, get_voice_file_id, save_voice_file_id, forget_voice_file_id
+)
+from speech.whisper_engine import (
+    generate_speech, create_speech_pipeline,
+    SpeechPipeline, TTS_VOICE_SEND_MODE, TTS_CACHE_ENABLED,
+    tts_cache, get_tts_cache_key
+)
 
 load_dotenv()
 
@@ -23,38 +33,268 @@ else:
         GROUP_ID = None
 
 
-async def save_lesson_dialog(session: AsyncSession, user_id: int, user_message: str, ai_response: str, voice_file_id: str = None):
+async def save_lesson_turn(
+    session: AsyncSession,
+    user_id: int,
+    user_message: str,
+    ai_response: str,
+    voice_file_id: str = None,
+    user_kind: str = MessageKind.LESSON,
+    bot_kind: str = MessageKind.LESSON,
+    touch_last_lesson: bool = True,
+    returning: bool = False
+):
     """
-    Сохраняет диалог урока в базу данных.
+    Сохраняет итерацию урока одной транзакцией: сообщение ученика и ответ бота
+    одним INSERT на две строки и (по умолчанию) дату последнего урока пользователя.
+
+    Args:
+        touch_last_lesson: Обновить users.last_lesson_date
+        returning: Вернуть id сохранённых сообщений (INSERT ... RETURNING)
+
+    Returns:
+        (id сообщения ученика, id ответа бота) при returning=True, иначе True;
+        False при ошибке
     """
     try:
-        new_message = MessageHistory(
-            user_id=user_id,
-            role="user",
-            content=user_message,
-            voice_file_id=voice_file_id,
-            timestamp=datetime.utcnow()
-        )
-        session.add(new_message)
+        statement = insert(MessageHistory).values([
+            {
+                "user_id": user_id,
+                "role": "user",
+                "content": user_message,
+                "voice_file_id": voice_file_id,
+                "timestamp": datetime.utcnow(),
+                "kind": user_kind,
+            },
+            {
+                # Ответ ассистента сохраняем отдельной строкой
+                "user_id": user_id,
+                "role": "bot",
+                "content": ai_response,
+                "voice_file_id": None,
+                "timestamp": datetime.utcnow(),
+                "kind": bot_kind,
+            },
+        ])
+        if returning:
+            statement = statement.returning(MessageHistory.id)
+        result = await session.execute(statement)
+        message_ids = tuple(sorted(result.scalars().all())) if returning else None
+        
+        if touch_last_lesson:
+            await session.execute(
+                update(User)
+                .where(User.id == user_id)
+                .values(last_lesson_date=datetime.utcnow())
+            )
         
-        # Сохраняем ответ ассистента отдельно
-        ai_message = MessageHistory(
+        await session.commit()
+        print(f"✅ Диалог урока сохранен для пользователя {user_id}")
+        return message_ids if returning else True
+    except Exception as e:
+        await session.rollback()
+        print(f"❌ Ошибка при сохранении диалога: {e}")
+        return False
+
+
+async def save_lesson_dialog(
+    session: AsyncSession,
+    user_id: int,
+    user_message: str,
+    ai_response: str,
+    voice_file_id: str = None,
+    user_kind: str = MessageKind.LESSON,
+    bot_kind: str = MessageKind.LESSON
+):
+    """
+    Сохраняет диалог урока в базу данных (без обновления даты последнего урока).
+    """
+    return await save_lesson_turn(
+        session=session,
+        user_id=user_id,
+        user_message=user_message,
+        ai_response=ai_response,
+        voice_file_id=voice_file_id,
+        user_kind=user_kind,
+        bot_kind=bot_kind,
+        touch_last_lesson=False
+    )
+
+
+async def save_bot_message(session: AsyncSession, user_id: int, content: str, kind: str, question_text: str = None):
+    """
+    Сохраняет служебное сообщение бота (вопрос на закрепление, завершение урока).
+    """
+    try:
+        session.add(MessageHistory(
             user_id=user_id,
             role="bot",
-            content=ai_response,
+            content=content,
             voice_file_id=None,
-            timestamp=datetime.utcnow()
-        )
-        session.add(ai_message)
+            timestamp=datetime.utcnow(),
+            kind=kind,
+            question_text=question_text
+        ))
         await session.commit()
-        print(f"✅ Диалог урока сохранен для пользователя {user_id}")
         return True
     except Exception as e:
         await session.rollback()
-        print(f"❌ Ошибка при сохранении диалога: {e}")
+        print(f"❌ Ошибка при сохранении сообщения бота: {e}")
         return False
 
 
+async def get_last_reinforcement_question(session: AsyncSession, user_id: int):
+    """
+    Возвращает текст последнего вопроса на закрепление, отправленного пользователю.
+    """
+    result = await session.execute(
+        select(MessageHistory.question_text)
+        .where(
+            MessageHistory.user_id == user_id,
+            MessageHistory.kind == MessageKind.REINFORCEMENT_QUESTION
+        )
+        .order_by(MessageHistory.timestamp.desc())
+        .limit(1)
+    )
+    return result.scalar_one_or_none()
+
+
+async def send_voice_reply(
+    bot: Bot,
+    chat_id: int,
+    text: str,
+    caption: Optional[str] = None,
+    speech_pipeline: Optional[SpeechPipeline] = None,
+    audio: Optional[bytes] = None
+) -> bool:
+    """
+    Озвучивает текст и отправляет его голосовым сообщением.
+    
+    При озвучивании по предложениям (TTS_CHUNKED) фрагменты синтезируются параллельно.
+    В режиме TTS_VOICE_SEND_MODE=multi каждый фрагмент уходит отдельным голосовым,
+    как только он готов; подпись ставится только на первое.
+    
+    Повторяющееся аудио (готовый урок дня, фраза из кэша озвучки) отправляется
+    через реестр голосовых: загружается в Telegram один раз, дальше - по file_id.
+    Уникальные ответы ученикам загружаются без реестра.
+    
+    Args:
+        bot: Экземпляр бота
+        chat_id: ID чата
+        text: Текст для озвучивания
+        caption: Подпись к голосовому сообщению
+        speech_pipeline: Конвейер, который уже озвучивает текст по мере генерации
+        audio: Готовая озвучка текста (например, подготовленный заранее урок дня)
+        
+    Returns:
+        True если отправлено хотя бы одно голосовое сообщение
+    """
+    if audio:
+        # Готовая озвучка (урок дня) уходит многим ученикам
+        return await _send_voice_bytes(bot, chat_id, audio, caption, reusable=True)
+    
+    if speech_pipeline is None:
+        speech_pipeline = create_speech_pipeline()
+    
+    if speech_pipeline is not None and TTS_VOICE_SEND_MODE == "multi":
+        voice_sent = False
+        async for audio_bytes in speech_pipeline.iter_audio(text):
+            if await _send_voice_bytes(bot, chat_id, audio_bytes, None if voice_sent else caption):
+                voice_sent = True
+        return voice_sent
+    
+    # Фраза уже озвучивалась - берём аудио из кэша, синтез не нужен
+    cache_key = get_tts_cache_key(text) if TTS_CACHE_ENABLED else None
+    cached_audio = tts_cache.get(cache_key) if cache_key else None
+    if cached_audio:
+        if speech_pipeline is not None:
+            speech_pipeline.cancel()
+        return await _send_voice_bytes(bot, chat_id, cached_audio, caption, reusable=True)
+    
+    if speech_pipeline is not None:
+        audio_bytes = b"".join(await speech_pipeline.finish(text))
+        if cache_key and audio_bytes:
+            tts_cache.put(cache_key, audio_bytes)
+    else:
+        audio_bytes = await generate_speech(text)
+    
+    if not audio_bytes:
+        return False
+    
+    return await _send_voice_bytes(bot, chat_id, audio_bytes, caption)
+
+
+# Аудио, которые сейчас загружаются в Telegram: хэш -> блокировка загрузки
+_upload_locks: Dict[str, asyncio.Lock] = {}
+
+
+async def _send_registered_voice(bot: Bot, chat_id: int, audio_hash: str, caption: Optional[str] = None) -> bool:
+    """
+    Отправляет голосовое по file_id из реестра голосовых.
+    
+    Returns:
+        False, если file_id нет или Telegram его больше не принимает
+    """
+    file_id = await get_voice_file_id(audio_hash)
+    if not file_id:
+        return False
+    try:
+        await bot.send_voice(chat_id=chat_id, voice=file_id, caption=caption)
+        return True
+    except tg_exceptions.TelegramBadRequest as e:
+        # file_id больше не принимается - забываем его и загружаем аудио заново
+        print(f"⚠️ Telegram не принял file_id из реестра голосовых: {e}")
+        await forget_voice_file_id(audio_hash)
+        return False
+
+
+async def _send_voice_bytes(
+    bot: Bot,
+    chat_id: int,
+    audio_bytes: bytes,
+    caption: Optional[str] = None,
+    reusable: bool = False
+) -> bool:
+    """
+    Отправляет аудио байты голосовым сообщением (файл загружается прямо из памяти).
+    
+    Повторяющееся аудио (reusable) отправляется по file_id из реестра голосовых,
+    а file_id загруженного файла сохраняется в реестр.
+    """
+    if reusable:
+        audio_hash = hash_audio(audio_bytes)
+        if await _send_registered_voice(bot, chat_id, audio_hash, caption):
+            return True
+        
+        # Одно и то же аудио (рассылка урока многим ученикам) загружает только одна
+        # отправка; остальные ждут её и отправляют по полученному file_id
+        upload_lock = _upload_locks.setdefault(audio_hash, asyncio.Lock())
+        try:
+            async with upload_lock:
+                # Пока ждали блокировку, аудио могла загрузить другая отправка
+                if await get_voice_file_id(audio_hash) is None:
+                    sent = await bot.send_voice(
+                        chat_id=chat_id,
+                        voice=BufferedInputFile(audio_bytes, filename=f"voice_{chat_id}.mp3"),
+                        caption=caption
+                    )
+                    if sent.voice:
+                        await save_voice_file_id(audio_hash, sent.voice.file_id)
+                    return True
+        finally:
+            if _upload_locks.get(audio_hash) is upload_lock:
+                del _upload_locks[audio_hash]
+        if await _send_registered_voice(bot, chat_id, audio_hash, caption):
+            return True
+    
+    await bot.send_voice(
+        chat_id=chat_id,
+        voice=BufferedInputFile(audio_bytes, filename=f"voice_{chat_id}.mp3"),
+        caption=caption
+    )
+    return True
+
+
 async def save_homework(session: AsyncSession, user_id: int, topic_id: int, homework_text: str):
     """
     Сохраняет домашнее задание в базу данных.
@@ -221,6 +461,38 @@ async def get_lesson_dialogs(session: AsyncSession, user_id: int, limit: int = 1
         return []
 
 
+async def load_conversation_history(session: AsyncSession, user_id: int, limit: int = 20) -> list:
+    """
+    Получает последние сообщения пользователя в хронологическом порядке
+    в формате для OpenAI ({"role", "content"}).
+    """
+    result = await session.execute(
+        select(MessageHistory)
+        .where(MessageHistory.user_id == user_id)
+        .order_by(MessageHistory.timestamp.desc())
+        .limit(limit)
+    )
+    history_messages = result.scalars().all()
+    
+    return [
+        {"role": str(msg.role), "content": str(msg.content)}
+        for msg in reversed(history_messages)  # В хронологическом порядке
+    ]
+
+
+def user_messages_between(user_id: int, since: datetime, until: datetime):
+    """
+    Запрос сообщений пользователя за период [since, until). Запросы по времени
+    всегда передают обе границы: по ним PostgreSQL читает только месячные
+    секции message_history за этот период.
+    """
+    return select(MessageHistory).where(
+        MessageHistory.user_id == user_id,
+        MessageHistory.timestamp >= since,
+        MessageHistory.timestamp < until
+    )
+
+
 async def update_homework_answer(session: AsyncSession, user_id: int, answer_text: str):
     """
     Обновляет ответ пользователя на домашнее задание.
@@ -254,4 +526,55 @@ async def update_homework_answer(session: AsyncSession, user_id: int, answer_tex
     except Exception as e:
         await session.rollback()
         print(f"❌ Ошибка при обновлении ответа на ДЗ: {e}")
-        return None 
\ No newline at end of file
+        return None
+
+
+async def get_completed_topic_ids(session: AsyncSession, user_id: int) -> Set[int]:
+    """
+    Возвращает id тем, пройденных пользователем.
+    """
+    result = await session.execute(
+        select(UserTopicProgress.topic_id).where(UserTopicProgress.user_id == user_id)
+    )
+    return set(result.scalars().all())
+
+
+async def get_next_topic_for_user(session: AsyncSession, user_id: int) -> Optional[CachedTopic]:
+    """
+    Получает первую непройденную тему пользователя.
+    """
+    return await topic_catalog.first_not_in(await get_completed_topic_ids(session, user_id))
+
+
+async def get_next_topics_for_users(session: AsyncSession, user_ids: List[int]) -> Dict[int, CachedTopic]:
+    """
+    Получает первую непройденную тему сразу для всех пользователей (для рассылок).
+    
+    Returns:
+        Словарь {user_id: тема}; пользователей, прошедших все темы, в нём нет
+    """
+    if not user_ids:
+        return {}
+    
+    result = await session.execute(
+        select(UserTopicProgress.user_id, UserTopicProgress.topic_id)
+        .where(UserTopicProgress.user_id.in_(user_ids))
+    )
+    completed: Dict[int, Set[int]] = {}
+    for user_id, topic_id in result.all():
+        completed.setdefault(user_id, set()).add(topic_id)
+    
+    next_topics = {}
+    for user_id in user_ids:
+        topic = await topic_catalog.first_not_in(completed.get(user_id, ()))
+        if topic:
+            next_topics[user_id] = topic
+    return next_topics
+
+
+async def mark_topic_completed(session: AsyncSession, user_id: int, topic_id: int):
+    """
+    Отмечает тему как пройденную (без commit - фиксирует вызывающий код).
+    """
+    if await session.get(UserTopicProgress, (user_id, topic_id)) is None:
+        session.add(UserTopicProgress(user_id=user_id, topic_id=topic_id, completed_at=datetime.utcnow()))
@@ -0,0 +1,116 @@
+"""
+Потоковая отправка ответов учителя в Telegram.
+
+Бот отправляет сообщение-заглушку и по мере генерации ответа редактирует его,
+подставляя накопленный текст. Частота правок ограничена STREAM_EDIT_INTERVAL,
+чтобы не упираться в лимиты Telegram на редактирование (примерно 1 правка в секунду на чат).
+"""
+import os
+import time
+import asyncio
+from typing import AsyncIterator
+from aiogram import Bot
+from aiogram import exceptions as tg_exceptions
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Включает потоковую отправку ответов учителя
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "false").lower() == "true"
+
+# Минимальный интервал между правками одного сообщения (секунды)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# Текст сообщения-заглушки, пока ответ ещё генерируется
+STREAM_PLACEHOLDER_TEXT = "✍️ ..."
+
+# Ограничение Telegram на длину текста сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+async def _edit_text(bot: Bot, chat_id: int, message_id: int, text: str) -> bool:
+    """
+    Редактирует сообщение, не прерывая поток из-за ошибок Telegram.
+
+    Returns:
+        True если правка принята, False если её нужно повторить позже
+    """
+    try:
+        await bot.edit_message_text(
+            text=text[:TELEGRAM_MESSAGE_LIMIT],
+            chat_id=chat_id,
+            message_id=message_id,
+            parse_mode=None
+        )
+        return True
+    except tg_exceptions.TelegramRetryAfter as e:
+        # Telegram просит подождать - пропускаем правку, следующая придёт позже
+        print(f"⚠️ Telegram ограничил правки сообщения, ждём {e.retry_after} сек")
+        await asyncio.sleep(e.retry_after)
+        return False
+    except tg_exceptions.TelegramBadRequest as e:
+        # "message is not modified" - текст не изменился, это не ошибка
+        if "not modified" in str(e).lower():
+            return True
+        print(f"❌ Ошибка Telegram при редактировании сообщения: {e}")
+        return False
+
+
+async def _delete_message(bot: Bot, chat_id: int, message_id: int) -> None:
+    """
+    Удаляет сообщение-заглушку, если ответ так и не появился.
+    """
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except tg_exceptions.TelegramAPIError as e:
+        print(f"❌ Ошибка Telegram при удалении сообщения: {e}")
+
+
+async def stream_reply(bot: Bot, chat_id: int, text_stream: AsyncIterator[str]) -> str:
+    """
+    Показывает ответ учителя по мере генерации, редактируя одно сообщение.
+
+    Args:
+        bot: Экземпляр бота
+        chat_id: ID чата
+        text_stream: Поток накопленного текста (например, openai_client.stream_message)
+
+    Если поток оборвался, ученик видит уже показанную часть ответа; если показать
+    нечего, заглушка удаляется и ошибка передаётся дальше (вызывающий код отправит
+    fallback-ответ отдельным сообщением).
+
+    Returns:
+        Итоговый текст ответа
+    """
+    placeholder = await bot.send_message(chat_id=chat_id, text=STREAM_PLACEHOLDER_TEXT)
+
+    text = ""
+    shown_text = ""
+    last_edit = 0.0
+
+    try:
+        async for text in text_stream:
+            now = time.monotonic()
+            if now - last_edit < STREAM_EDIT_INTERVAL or not text.strip():
+                continue
+
+            if await _edit_text(bot, chat_id, placeholder.message_id, text):
+                shown_text = text
+            last_edit = time.monotonic()
+    except Exception as e:
+        print(f"❌ Ошибка при потоковой отправке ответа: {e}")
+        if not text.strip():
+            await _delete_message(bot, chat_id, placeholder.message_id)
+            raise
+
+    text = text.strip()
+    if not text:
+        await _delete_message(bot, chat_id, placeholder.message_id)
+        return text
+
+    # Финальная правка с полным текстом ответа
+    if text != shown_text.strip():
+        if not await _edit_text(bot, chat_id, placeholder.message_id, text):
+            await _edit_text(bot, chat_id, placeholder.message_id, text)
+
+    return text
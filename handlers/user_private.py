@@ -1,4 +1,3 @@
-import json
 import asyncio
 import os
 from aiogram.types import FSInputFile, InputMediaAudio
@@ -18,13 +17,17 @@ from text.text import (
     buttons_info_text
 )
 
-from database.models import User, Topic, MessageHistory, Homework
+from database.models import User, MessageHistory, MessageKind, Homework
+from database.topic_catalog import topic_catalog, CachedTopic
 from ai.ai import openai_client
-from speech.whisper_engine import transcribe_audio, generate_speech, save_audio_to_file
+from speech.whisper_engine import transcribe_audio, create_speech_pipeline
 from handlers.sending_data import (
-    save_lesson_dialog, save_homework, send_lesson_summary_to_group,
-    send_homework_response_to_group, get_lesson_dialogs, update_homework_answer
+    save_lesson_dialog, save_lesson_turn, save_homework, send_lesson_summary_to_group,
+    send_homework_response_to_group, get_lesson_dialogs, update_homework_answer,
+    send_voice_reply, save_bot_message, get_last_reinforcement_question,
+    get_next_topic_for_user, mark_topic_completed, load_conversation_history
 )
+from handlers.streaming import STREAM_REPLIES, stream_reply
 from kbds.inline import get_lesson_buttons_keyboard
 
 router_user_private = Router()
@@ -89,6 +92,9 @@ async def handle_voice_message(message: Message, state: FSMContext, session: Asy
     # Получаем данные состояния
     data = await state.get_data()
     lesson_iteration = data.get("lesson_iteration", 1)
+    chat_mode = data.get("chat_mode", "lesson")
+    
+    # Фаза 1: чтение из БД (пользователь, тема, история)
     
     # Получаем или создаём пользователя
     result = await session.execute(
@@ -100,47 +106,8 @@ async def handle_voice_message(message: Message, state: FSMContext, session: Asy
         await message.answer(start_first_text)
         return
     
-    # Скачиваем голосовое сообщение
-    try:
-        file = await message.bot.get_file(voice.file_id)
-        file_path = file.file_path
-        
-        # Создаём временный файл для сохранения голосового сообщения
-        import tempfile
-        import os
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.ogg') as temp_file:
-            temp_path = temp_file.name
-        
-        # Скачиваем файл
-        await message.bot.download_file(file_path, temp_path)
-        
-        # Транскрибируем голосовое сообщение в текст с помощью OpenAI Whisper
-        try:
-            user_text = await transcribe_audio(temp_path)
-            if not user_text.strip():
-                user_text = "Hello, teacher!"  # Fallback если Whisper не распознал
-        except Exception as e:
-            print(f"Ошибка при транскрибации OpenAI Whisper: {e}")
-            user_text = "Hello, teacher!"  # Fallback
-        
-        # Удаляем временный файл
-        try:
-            os.unlink(temp_path)
-        except:
-            pass
-            
-    except Exception as e:
-        print(f"Ошибка при скачивании голосового сообщения: {e}")
-        user_text = "Hello, teacher!"  # Fallback
-    
-    # Получаем текущую тему
-    current_topic = None
-    if user and user.current_topic_id:
-        topic_result = await session.execute(
-            select(Topic).where(Topic.id == user.current_topic_id)
-        )
-        current_topic = topic_result.scalar_one_or_none()
+    # Получаем текущую тему из каталога тем
+    current_topic = await topic_catalog.get(user.current_topic_id)
     
     # Если нет текущей темы, выбираем следующую непройденную
     if not current_topic:
@@ -159,26 +126,30 @@ async def handle_voice_message(message: Message, state: FSMContext, session: Asy
         await state.clear()
         return
     
-    # Получаем историю сообщений (последние 20)
-    history_result = await session.execute(
-        select(MessageHistory)
-        .where(MessageHistory.user_id == user_id)
-        .order_by(MessageHistory.timestamp.desc())
-        .limit(20)
-    )
-    history_messages = history_result.scalars().all()
+    # Получаем историю сообщений (последние 20) в формате для OpenAI
+    conversation_history = await load_conversation_history(session, user_id, limit=20)
     
-    # Преобразуем в формат для OpenAI
-    conversation_history = []
-    for msg in reversed(history_messages):  # В хронологическом порядке
-        conversation_history.append({
-            "role": str(msg.role),
-            "content": str(msg.content)
-        })
+    # Фаза 2: Whisper, OpenAI и TTS - соединение с БД на это время возвращается в пул.
+    # Фаза 3 (запись диалога) выполняется короткой транзакцией в конце итерации.
+    await session.release()
     
-    # Получаем режим чата
-    data = await state.get_data()
-    chat_mode = data.get("chat_mode", "lesson")
+    # Скачиваем голосовое сообщение в память (без временных файлов)
+    try:
+        voice_buffer = await message.bot.download(voice)
+        voice_buffer.name = "voice.ogg"  # По расширению Whisper определяет формат
+        
+        # Транскрибируем голосовое сообщение в текст с помощью OpenAI Whisper
+        try:
+            user_text = await transcribe_audio(voice_buffer)
+            if not user_text.strip():
+                user_text = "Hello, teacher!"  # Fallback если Whisper не распознал
+        except Exception as e:
+            print(f"Ошибка при транскрибации OpenAI Whisper: {e}")
+            user_text = "Hello, teacher!"  # Fallback
+            
+    except Exception as e:
+        print(f"Ошибка при скачивании голосового сообщения: {e}")
+        user_text = "Hello, teacher!"  # Fallback
     
     # Обрабатываем голосовое сообщение (убираем ограничение на 2 итерации)
     if chat_mode == "teacher":
@@ -189,65 +160,95 @@ async def handle_voice_message(message: Message, state: FSMContext, session: Asy
         await handle_lesson_iteration(message, state, session, user_id, user_text, current_topic, conversation_history, voice.file_id, lesson_iteration)
 
 
-async def handle_lesson_iteration(message: Message, state: FSMContext, session: AsyncSession, user_id: int, user_text: str, current_topic: Topic, conversation_history: list, voice_file_id: str, iteration: int):
+async def handle_lesson_iteration(message: Message, state: FSMContext, session: AsyncSession, user_id: int, user_text: str, current_topic: CachedTopic, conversation_history: list, voice_file_id: str, iteration: int):
     """
     Обрабатывает любую итерацию урока (убираем ограничение на 2 итерации)
     """
+    topic_data = current_topic.as_dict()
+    fallback_feedback = {
+        "is_correct": True,
+        "feedback": "Отлично! 👍",
+        "correct_answer": user_text,
+        "explanation": ""
+    }
+
     # Генерируем интеллектуальный ответ с проверкой
+    # В конвейерном режиме проверка ещё идёт, пока отправляется голосовой ответ
+    feedback = None
+    feedback_task = None
+    text_sent = False
+    speech_pipeline = create_speech_pipeline()
     try:
-        ai_response, feedback = await openai_client.generate_intelligent_response(
-            user_message=user_text,
-            conversation_history=conversation_history,
-            current_topic={
-                "title": str(current_topic.title),
-                "description": str(current_topic.description),
-                "tasks": json.loads(str(current_topic.tasks))
-            }
-        )
+        if STREAM_REPLIES and openai_client.response_mode != "fused":
+            # Потоковый режим: текст ответа появляется у ученика по мере генерации
+            if openai_client.response_mode == "pipelined":
+                feedback_task = openai_client.start_feedback_check(user_text, conversation_history, topic_data)
+            else:
+                feedback = await openai_client.check_pronunciation_and_answer(
+                    user_answer=user_text,
+                    current_topic=topic_data,
+                    context="Intelligent response generation",
+                    conversation_history=conversation_history
+                )
+            text_stream = openai_client.stream_message(
+                user_message=user_text,
+                conversation_history=conversation_history,
+                current_topic=topic_data,
+                feedback_result=feedback
+            )
+            if speech_pipeline is not None:
+                # Озвучиваем предложения, не дожидаясь конца ответа
+                text_stream = speech_pipeline.follow(text_stream)
+            ai_response = await stream_reply(message.bot, user_id, text_stream)
+            text_sent = True
+        elif openai_client.response_mode == "pipelined":
+            ai_response, feedback_task = await openai_client.generate_pipelined_response(
+                user_message=user_text,
+                conversation_history=conversation_history,
+                current_topic=topic_data
+            )
+        else:
+            ai_response, feedback = await openai_client.generate_intelligent_response(
+                user_message=user_text,
+                conversation_history=conversation_history,
+                current_topic=topic_data
+            )
     except Exception as e:
         print(f"Ошибка при работе с OpenAI: {e}")
         ai_response = "I'm sorry, there was an error. Please try again later."
-        feedback = {
-            "is_correct": True,
-            "feedback": "Отлично! 👍",
-            "correct_answer": user_text,
-            "explanation": ""
-        }
-    
-    # Формируем ответ с обратной связью
-    response_text = f"💡 Обратная связь (итерация {iteration})\n\n{feedback.get('feedback', '')}\n\n"
-    if not feedback.get('is_correct', True):
-        response_text += f"Правильный ответ: {feedback.get('correct_answer', '')}\n\n"
-        response_text += f"Объяснение: {feedback.get('explanation', '')}\n\n"
-    
+        feedback = fallback_feedback
+
     # Генерируем голосовое сообщение от учителя
+    # Если текст уже показан потоком - голос отправляем без подписи
     try:
-        audio_bytes = await generate_speech(ai_response)
-        if audio_bytes:
-            # Сохраняем аудио в файл
-            audio_path = await save_audio_to_file(audio_bytes, f"teacher_response_{user_id}.mp3")
-            if audio_path:
-                # Отправляем голосовое сообщение
-                await message.bot.send_voice(
-                    chat_id=user_id,
-                    voice=FSInputFile(audio_path),
-                    caption=ai_response
-                )
-                # Удаляем временный файл
-                try:
-                    os.unlink(audio_path)
-                except:
-                    pass
-            else:
-                # Если не удалось сохранить аудио, отправляем только текст
-                await message.answer(ai_response)
-        else:
-            # Если не удалось сгенерировать аудио, отправляем только текст
-            await message.answer(ai_response)
+        voice_sent = await send_voice_reply(
+            message.bot,
+            user_id,
+            ai_response,
+            caption=None if text_sent else ai_response,
+            speech_pipeline=speech_pipeline
+        )
     except Exception as e:
         print(f"Ошибка при генерации голосового сообщения: {e}")
-        await message.answer(ai_response)
+        voice_sent = False
     
+    if not voice_sent and not text_sent:
+        # Если не удалось сгенерировать аудио, отправляем только текст
+        await message.answer(ai_response)
+
+    # Забираем результат проверки, если она шла параллельно с ответом
+    if feedback_task is not None:
+        feedback = await openai_client.wait_for_feedback(feedback_task, user_text, topic_data)
+    if not feedback:
+        feedback = fallback_feedback
+
+    # Формируем ответ с обратной связью
+    response_text = f"💡 Обратная связь (итерация {iteration})\n\n{feedback.get('feedback', '')}\n\n"
+    # is_correct = None - ответ не проверен, исправлений не показываем
+    if feedback.get('is_correct', True) is False:
+        response_text += f"Правильный ответ: {feedback.get('correct_answer', '')}\n\n"
+        response_text += f"Объяснение: {feedback.get('explanation', '')}\n\n"
+
     # Отправляем обратную связь
     await message.answer(response_text)
     
@@ -255,8 +256,9 @@ async def handle_lesson_iteration(message: Message, state: FSMContext, session:
     keyboard = get_lesson_buttons_keyboard()
     await message.answer(buttons_info_text, reply_markup=keyboard)
     
-    # Сохраняем диалог в базу данных
-    await save_lesson_dialog(
+    # Фаза 3: запись диалога и даты последнего урока одной транзакцией
+    # (соединение берётся из пула только сейчас)
+    await save_lesson_turn(
         session=session,
         user_id=user_id,
         user_message=user_text,
@@ -264,15 +266,6 @@ async def handle_lesson_iteration(message: Message, state: FSMContext, session:
         voice_file_id=voice_file_id
     )
     
-    # Обновляем дату последнего урока
-    await session.execute(
-        update(User)
-        .where(User.id == user_id)
-        .values(last_lesson_date=datetime.utcnow())
-    )
-    
-    await session.commit()
-    
     # Увеличиваем счетчик итераций
     await state.update_data(lesson_iteration=iteration + 1)
     
@@ -284,50 +277,56 @@ async def handle_teacher_chat(message: Message, state: FSMContext, session: Asyn
     Обрабатывает общение с учителем (вопросы по английскому языку)
     """
     # Генерируем ответ на вопрос ученика
+    text_sent = False
+    speech_pipeline = create_speech_pipeline()
     try:
-        ai_response = await openai_client.send_message(
-            user_message=user_text,
-            conversation_history=conversation_history,
-            current_topic=None  # Не привязываем к конкретной теме
-        )
+        if STREAM_REPLIES:
+            # Потоковый режим: текст ответа появляется у ученика по мере генерации
+            text_stream = openai_client.stream_message(
+                user_message=user_text,
+                conversation_history=conversation_history,
+                current_topic=None  # Не привязываем к конкретной теме
+            )
+            if speech_pipeline is not None:
+                # Озвучиваем предложения, не дожидаясь конца ответа
+                text_stream = speech_pipeline.follow(text_stream)
+            ai_response = await stream_reply(message.bot, user_id, text_stream)
+            text_sent = True
+        else:
+            ai_response = await openai_client.send_message(
+                user_message=user_text,
+                conversation_history=conversation_history,
+                current_topic=None  # Не привязываем к конкретной теме
+            )
     except Exception as e:
         print(f"Ошибка при работе с OpenAI: {e}")
         ai_response = "I'm sorry, there was an error. Please try again later."
     
     # Генерируем голосовое сообщение от учителя
+    # Если текст уже показан потоком - голос отправляем без подписи
     try:
-        audio_bytes = await generate_speech(ai_response)
-        if audio_bytes:
-            # Сохраняем аудио в файл
-            audio_path = await save_audio_to_file(audio_bytes, f"teacher_chat_{user_id}.mp3")
-            if audio_path:
-                # Отправляем голосовое сообщение
-                await message.bot.send_voice(
-                    chat_id=user_id,
-                    voice=FSInputFile(audio_path),
-                    caption=ai_response
-                )
-                # Удаляем временный файл
-                try:
-                    os.unlink(audio_path)
-                except:
-                    pass
-            else:
-                # Если не удалось сохранить аудио, отправляем только текст
-                await message.answer(ai_response)
-        else:
-            # Если не удалось сгенерировать аудио, отправляем только текст
-            await message.answer(ai_response)
+        voice_sent = await send_voice_reply(
+            message.bot,
+            user_id,
+            ai_response,
+            caption=None if text_sent else ai_response,
+            speech_pipeline=speech_pipeline
+        )
     except Exception as e:
         print(f"Ошибка при генерации голосового сообщения: {e}")
+        voice_sent = False
+    
+    if not voice_sent and not text_sent:
+        # Если не удалось сгенерировать аудио, отправляем только текст
         await message.answer(ai_response)
     
     # Создаём inline кнопки для урока
     keyboard = get_lesson_buttons_keyboard()
     await message.answer(buttons_info_text, reply_markup=keyboard)
     
-    # Сохраняем диалог в базу данных
-    await save_lesson_dialog(
+    # Фаза 3: запись диалога и даты последнего урока одной транзакцией
+    # (соединение берётся из пула только сейчас)
+    await save_lesson_turn(
         session=session,
         user_id=user_id,
         user_message=user_text,
@@ -335,15 +334,6 @@ async def handle_teacher_chat(message: Message, state: FSMContext, session: Asyn
         voice_file_id=voice_file_id
     )
     
-    # Обновляем дату последнего урока
-    await session.execute(
-        update(User)
-        .where(User.id == user_id)
-        .values(last_lesson_date=datetime.utcnow())
-    )
-    
-    await session.commit()
-    
     # Устанавливаем таймер ожидания (3 минуты)
     await set_waiting_timer(message, user_id, 3, "first_reminder", session)
 
@@ -472,38 +462,31 @@ async def finish_lesson_early(message: Message, user_id: int, session: AsyncSess
     except Exception as e:
         print(f"Ошибка при завершении урока: {e}")
         # Fallback сообщение
+        end_message = "Привет! Ты хорошо говоришь по-английски. Продолжай практиковаться, и ты станешь еще лучше! 😊"
         await message.bot.send_message(
             chat_id=user_id,
-            text="Привет! Ты хорошо говоришь по-английски. Продолжай практиковаться, и ты станешь еще лучше! 😊"
+            text=end_message
         )
+    
+    # Отмечаем завершение урока, чтобы планировщик не считал ученика занятым
+    await save_bot_message(session, user_id, end_message, MessageKind.ENDING)
 
 async def get_next_topic(session: AsyncSession, user: User):
     """
     Получает следующую непройденную тему
     """
-    # Получаем список пройденных тем
     if not user:
         return None
     
-    progress_str = str(user.progress) if user.progress else "[]"
-    completed_topics = json.loads(progress_str)
-    
     # Ищем непройденную тему
-    result = await session.execute(
-        select(Topic)
-        .where(Topic.id.notin_(completed_topics))
-        .order_by(Topic.id)
-        .limit(1)
-    )
-    
-    return result.scalar_one_or_none()
+    return await get_next_topic_for_user(session, user.id)
 
 async def finish_lesson_without_homework(
     message: Message, 
     state: FSMContext,
     session: AsyncSession, 
     user_id: int, 
-    current_topic: Topic, 
+    current_topic: CachedTopic, 
     conversation_history: list
 ):
     """
@@ -518,19 +501,13 @@ async def finish_lesson_without_homework(
         
         if user and user.id:
             # Отмечаем тему как пройденную
-            progress_str = str(user.progress) if user.progress else "[]"
-            completed_topics = json.loads(progress_str)
-            completed_topics.append(current_topic.id)
-            new_progress = json.dumps(completed_topics)
+            await mark_topic_completed(session, user_id, current_topic.id)
             
             # Обновляем пользователя
             await session.execute(
                 update(User)
                 .where(User.id == user_id)
-                .values(
-                    progress=new_progress,
-                    current_topic_id=None
-                )
+                .values(current_topic_id=None)
             )
         
         await session.commit()
@@ -574,7 +551,7 @@ async def give_homework(
     state: FSMContext,
     session: AsyncSession, 
     user_id: int, 
-    current_topic: Topic, 
+    current_topic: CachedTopic, 
     conversation_history: list
 ):
     """
@@ -583,11 +560,7 @@ async def give_homework(
     try:
         # Генерируем домашнее задание
         homework_text = await openai_client.generate_homework(
-            current_topic={
-                "title": str(current_topic.title),
-                "description": str(current_topic.description),
-                "tasks": json.loads(str(current_topic.tasks))
-            },
+            current_topic=current_topic.as_dict(),
             conversation_history=conversation_history
         )
         
@@ -607,19 +580,13 @@ async def give_homework(
         
         if user and user.id:
             # Отмечаем тему как пройденную
-            progress_str = str(user.progress) if user.progress else "[]"
-            completed_topics = json.loads(progress_str)
-            completed_topics.append(current_topic.id)
-            new_progress = json.dumps(completed_topics)
+            await mark_topic_completed(session, user_id, current_topic.id)
             
             # Обновляем пользователя
             await session.execute(
                 update(User)
                 .where(User.id == user_id)
-                .values(
-                    progress=new_progress,
-                    current_topic_id=None
-                )
+                .values(current_topic_id=None)
             )
         
         await session.commit()
@@ -648,14 +615,12 @@ async def give_homework(
         await message.answer("Извините, произошла ошибка при выдаче домашнего задания.")
 
 @router_user_private.message(Command("test_scheduler"))
-async def cmd_test_scheduler(message: Message):
+async def cmd_test_scheduler(message: Message, lesson_scheduler=None):
     """
     Тестирование планировщика
+    (lesson_scheduler передаётся из данных диспетчера, см. on_startup в app.py)
     """
     try:
-        # Импортируем планировщик
-        from app import lesson_scheduler
-        
         if lesson_scheduler:
             await lesson_scheduler.send_test_message(message.from_user.id)
             await message.answer("✅ Тестовое сообщение от планировщика отправлено!")
@@ -693,8 +658,22 @@ async def cmd_dev_mode(message: Message):
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
+@router_user_private.message(Command("reload_topics"))
+async def cmd_reload_topics(message: Message):
+    """
+    Перечитывает каталог тем из БД (после изменения тем). Только для администраторов.
+    """
+    if not await message.bot.is_admin(message.from_user.id):
+        return
+    
+    try:
+        count = await topic_catalog.load()
+        await message.answer(f"✅ Каталог тем обновлён: {count} тем")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка при обновлении каталога тем: {e}")
+
 @router_user_private.message(Command("status"))
-async def cmd_status(message: Message):
+async def cmd_status(message: Message, lesson_scheduler=None):
     """
     Проверка статуса бота и настроек
     """
@@ -720,6 +699,22 @@ async def cmd_status(message: Message):
 
 """
         
+        # Очереди запросов к OpenAI (ai/governor.py)
+        from ai.governor import governor
+        status_text += f"📊 Запросы к OpenAI:\n{governor.format_metrics()}\n"
+        
+        # Пул соединений с БД
+        from database.engine import format_pool_status
+        status_text += f"\n🗄️ Пул соединений БД: {format_pool_status()}\n"
+        
+        # Последние рассылки планировщика
+        from scheduler.fanout import format_last_summaries
+        status_text += f"\n📬 Рассылки:\n{format_last_summaries()}\n"
+        
+        # Шарды учеников этого процесса бота
+        if lesson_scheduler:
+            status_text += f"🔀 Шарды: {lesson_scheduler.shards.format()}\n"
+        
         if not all([token_exists, openai_key_exists, group_id_exists, db_url_exists]):
             status_text += "\n⚠️ Внимание: Не все переменные окружения настроены!\nСм. SETUP_PRODUCTION.md"
         
@@ -766,10 +761,7 @@ async def handle_homework_response(message: Message, state: FSMContext, session:
     Обрабатывает ответ на домашнее задание
     """
     # Получаем информацию о теме для контекста
-    topic_result = await session.execute(
-        select(Topic).where(Topic.id == homework.topic_id)
-    )
-    topic = topic_result.scalar_one_or_none()
+    topic = await topic_catalog.get(homework.topic_id)
     topic_title = topic.title if topic else "английскому языку"
     
     # Проверяем домашнее задание через OpenAI
@@ -855,19 +847,17 @@ async def handle_reinforcement_response(message: Message, state: FSMContext, ses
             return
         
         # Получаем текущую тему пользователя
-        current_topic = None
-        if user.current_topic_id:
-            topic_result = await session.execute(
-                select(Topic).where(Topic.id == user.current_topic_id)
-            )
-            current_topic = topic_result.scalar_one_or_none()
+        current_topic = await topic_catalog.get(user.current_topic_id)
+        
+        # Последний вопрос на закрепление - контекст для проверки ответа
+        question_text = await get_last_reinforcement_question(session, user_id)
         
         # Проверяем ответ через OpenAI
         try:
             feedback_result = await openai_client.check_pronunciation_and_answer(
                 user_answer=text_content,
-                current_topic=current_topic,
-                context="Reinforcement question response",
+                current_topic=current_topic.as_dict() if current_topic else None,
+                context=f"Reinforcement question: {question_text}" if question_text else "Reinforcement question response",
                 conversation_history=[]
             )
             
@@ -889,11 +879,11 @@ async def handle_reinforcement_response(message: Message, state: FSMContext, ses
             user_id=user_id,
             user_message=text_content,
             ai_response="Reinforcement feedback",
-            voice_file_id=None
+            voice_file_id=None,
+            user_kind=MessageKind.REINFORCEMENT_ANSWER,
+            bot_kind=MessageKind.FEEDBACK
         )
         
-        await session.commit()
-        
     except Exception as e:
         print(f"Ошибка при обработке ответа на закрепление: {e}")
         await message.answer("🎤 Отправьте голосовое сообщение, чтобы начать урок!")
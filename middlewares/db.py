@@ -1,21 +1,67 @@
 """
 Этот файл создаёт Middleware слой, который автоматически передаёт сессию базы данных в каждый хендлер.
 Что делает Middleware: 1)Перехватывает событие до обработки хендлером.
-2) Создаёт новую асинхронную сессию базы данных. 3) Добавляет её в data['session'],
+2) Создаёт ленивую сессию базы данных (LazySession). 3) Добавляет её в data['session'],
 чтобы она была доступна в хендлерах. 4) Вызывает хендлер, передавая ему event и data.
 
 Теперь любой хендлер, принимающий data, может работать с data['session'], то есть с базой данных.
+
+Сессия создаётся только при первом обращении к ней, поэтому хендлеры, которые
+не работают с БД (например, нажатия кнопок), не занимают соединение из пула.
+Перед долгими запросами к OpenAI/TTS хендлер вызывает session.release(),
+чтобы вернуть соединение в пул на время ожидания.
 """
-from typing import Dict, Awaitable, Callable, Any
+from typing import Dict, Awaitable, Callable, Any, Optional
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class LazySession:
+    """
+    Прокси для AsyncSession: сессия создаётся при первом обращении,
+    все атрибуты и методы передаются настоящей сессии.
+    """
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self._session_pool = session_pool
+        self._session: Optional[AsyncSession] = None
+
+    @property
+    def session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._session_pool()
+        return self._session
+
+    @property
+    def is_created(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.session, name)
+
+    async def release(self) -> None:
+        """
+        Завершает текущую транзакцию (изменения фиксируются) и возвращает
+        соединение в пул. Загруженные объекты остаются доступными
+        (expire_on_commit=False), следующий запрос возьмёт соединение заново.
+        """
+        if self._session is not None and self._session.in_transaction():
+            await self._session.commit()
+
+    async def rollback(self) -> None:
+        if self._session is not None:
+            await self._session.rollback()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
 class DataBaseSession(BaseMiddleware):
     def __init__(self, session_pool: async_sessionmaker):
         self.session_pool = session_pool
@@ -26,17 +72,17 @@ class DataBaseSession(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any],
     ) -> Any:
-        async with self.session_pool() as session:
-            data['session'] = session
-            try:
-                return await handler(event, data)
-            except SQLAlchemyError as e:
-                logger.error(f"Database error: {e}")
-                await session.rollback()
-                raise
-            except Exception as e:
-                logger.error(f"Unexpected error: {e}")
-                await session.rollback()
-                raise
-            finally:
-                await session.close()
\ No newline at end of file
+        session = LazySession(self.session_pool)
+        data['session'] = session
+        try:
+            return await handler(event, data)
+        except SQLAlchemyError as e:
+            logger.error(f"Database error: {e}")
+            await session.rollback()
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
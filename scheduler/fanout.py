@@ -0,0 +1,213 @@
+"""
+Параллельная рассылка по ученикам для задач планировщика.
+
+fan_out() обрабатывает учеников пулом из BROADCAST_CONCURRENCY воркеров и возвращает
+сводку (отправлено / пропущено / ученик заблокировал бота / ошибка).
+
+Лимиты Telegram соблюдает BroadcastRateLimiter - middleware сессии бота: запросы,
+сделанные внутри рассылки, проходят через общий лимит (TELEGRAM_BROADCAST_RPS сообщений
+в секунду на бота) и лимит на чат (не чаще раза в TELEGRAM_CHAT_INTERVAL секунд).
+Ответы ученикам вне рассылки не ограничиваются. На 429 (RetryAfter) рассылка
+приостанавливается на указанное Telegram время и запрос повторяется.
+
+Если передан запуск рассылки (scheduler/run_state.py), результат каждого ученика
+записывается в журнал, а ученики, обработанные до перезапуска бота, пропускаются.
+"""
+import asyncio
+import os
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from dotenv import load_dotenv
+
+from ai.governor import TokenBucket
+
+load_dotenv()
+
+# Сколько учеников обрабатывается одновременно
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+# Общий лимит Telegram - около 30 сообщений в секунду на бота
+TELEGRAM_BROADCAST_RPS = float(os.getenv("TELEGRAM_BROADCAST_RPS", "25"))
+# Лимит Telegram на один чат - около 1 сообщения в секунду
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1.0"))
+# Сколько раз повторять запрос после RetryAfter
+TELEGRAM_RETRY_AFTER_ATTEMPTS = 3
+
+# Чат, которому идёт рассылка в текущей задаче (None - обычный ответ ученику)
+broadcast_chat: ContextVar[Optional[int]] = ContextVar("broadcast_chat", default=None)
+
+
+class BroadcastStatus:
+    """
+    Результат обработки одного ученика.
+    """
+    SENT = "sent"
+    SKIPPED = "skipped"
+    BLOCKED = "blocked"
+    FAILED = "failed"
+
+
+class BroadcastRateLimiter(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: ограничивает частоту запросов рассылки.
+    """
+
+    def __init__(self, rps: float = TELEGRAM_BROADCAST_RPS, chat_interval: float = TELEGRAM_CHAT_INTERVAL):
+        self.bucket = TokenBucket(rps, max(1, int(rps)))
+        self.chat_interval = chat_interval
+        self._chat_next_send: Dict[int, float] = {}
+        self._paused_until = 0.0
+
+    async def _wait_chat(self, chat_id: int) -> None:
+        now = time.monotonic()
+        # Время следующей отправки резервируется сразу, чтобы параллельные запросы в чат шли по очереди
+        send_at = max(now, self._chat_next_send.get(chat_id, 0.0))
+        self._chat_next_send[chat_id] = send_at + self.chat_interval
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+        # Не даём словарю расти бесконечно
+        if len(self._chat_next_send) > 10000:
+            self._chat_next_send = {
+                chat: moment for chat, moment in self._chat_next_send.items() if moment > now
+            }
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = broadcast_chat.get()
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        for attempt in range(TELEGRAM_RETRY_AFTER_ATTEMPTS + 1):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self._wait_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == TELEGRAM_RETRY_AFTER_ATTEMPTS:
+                    raise
+                # Telegram просит подождать - приостанавливаем всю рассылку
+                print(f"⏳ Telegram RetryAfter {e.retry_after} сек (чат {chat_id})")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+
+
+class FanOutSummary:
+    """
+    Итоги рассылки.
+    """
+
+    def __init__(self, name: str, total: int):
+        self.name = name
+        self.total = total
+        self.counts: Dict[str, int] = {
+            BroadcastStatus.SENT: 0,
+            BroadcastStatus.SKIPPED: 0,
+            BroadcastStatus.BLOCKED: 0,
+            BroadcastStatus.FAILED: 0,
+        }
+        self.errors: Dict[Any, str] = {}
+        # Обработаны в прошлый раз, до перезапуска бота
+        self.done_earlier = 0
+        self.started_at = datetime.now()
+        self._started = time.monotonic()
+        self.duration = 0.0
+
+    def record(self, key: Any, status: str, error: Optional[BaseException] = None) -> None:
+        self.counts[status] += 1
+        if error is not None:
+            self.errors[key] = str(error)
+
+    def finish(self) -> None:
+        self.duration = time.monotonic() - self._started
+
+    def format(self) -> str:
+        return (
+            f"{self.name}: учеников {self.total}, отправлено {self.counts[BroadcastStatus.SENT]}, "
+            f"пропущено {self.counts[BroadcastStatus.SKIPPED]}, "
+            f"заблокировали бота {self.counts[BroadcastStatus.BLOCKED]}, "
+            f"ошибок {self.counts[BroadcastStatus.FAILED]}, за {self.duration:.1f} сек"
+            + (f", обработано до перезапуска {self.done_earlier}" if self.done_earlier else "")
+        )
+
+
+# Последние итоги каждой рассылки (для /status)
+last_summaries: Dict[str, FanOutSummary] = {}
+
+
+async def fan_out(
+    name: str,
+    items: Iterable[Any],
+    worker: Callable[[Any], Awaitable[Optional[str]]],
+    chat_id: Callable[[Any], int] = lambda item: item.id,
+    concurrency: int = BROADCAST_CONCURRENCY,
+    run=None,
+) -> FanOutSummary:
+    """
+    Обрабатывает items пулом воркеров.
+
+    Args:
+        name: Название рассылки (для логов и сводки)
+        items: Ученики (или другие элементы рассылки)
+        worker: Обработка одного элемента; возвращает BroadcastStatus
+            (None считается SENT), исключение - ошибка
+        chat_id: Чат Telegram для элемента (для лимита на чат)
+        concurrency: Сколько элементов обрабатывается одновременно
+        run: Запуск рассылки (BroadcastRun) для журнала и возобновления
+    """
+    items: List[Any] = list(items)
+    summary = FanOutSummary(name, len(items))
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in items:
+        if run is not None and chat_id(item) in run.done:
+            summary.done_earlier += 1
+            continue
+        queue.put_nowait(item)
+    if summary.done_earlier:
+        print(f"↩️ {name}: возобновление, {summary.done_earlier} учеников уже обработаны")
+
+    async def run_worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            key = chat_id(item)
+            token = broadcast_chat.set(key)
+            error = None
+            try:
+                status = await worker(item) or BroadcastStatus.SENT
+            except TelegramForbiddenError as e:
+                # Ученик заблокировал бота или удалил чат
+                status = BroadcastStatus.BLOCKED
+                print(f"🚫 {name}: пользователь {key} недоступен ({e})")
+            except Exception as e:
+                status, error = BroadcastStatus.FAILED, e
+                print(f"❌ {name}: ошибка для пользователя {key}: {e}")
+            finally:
+                broadcast_chat.reset(token)
+            summary.record(key, status, error)
+            if run is not None:
+                await run.record(key, status, error)
+
+    await asyncio.gather(*(run_worker() for _ in range(max(1, min(concurrency, queue.qsize())))))
+    summary.finish()
+    last_summaries[name] = summary
+    print(f"📊 {summary.format()}")
+    return summary
+
+
+def format_last_summaries() -> str:
+    """
+    Итоги последних рассылок в виде текста для команды /status.
+    """
+    if not last_summaries:
+        return "рассылок ещё не было"
+    return "\n".join(
+        f"• {summary.started_at:%d.%m %H:%M} {summary.format()}" for summary in last_summaries.values()
+    )
@@ -0,0 +1,155 @@
+"""
+Урок дня, подготовленный заранее.
+
+Приветствие и задание урока зависят только от темы, поэтому они генерируются
+один раз на (тему, день) за LESSON_PREGENERATE_LEAD_MINUTES минут до рассылки
+daily_lesson вместе с озвучкой приветствия и сохраняются в daily_lesson_content.
+Рассылка берёт готовый урок и только отправляет его: число запросов к OpenAI
+зависит от числа тем, а не учеников.
+
+Если урок для темы не подготовлен (бот перезапускался, тема сменилась после
+подготовки), он генерируется при первой отправке - один раз для всех учеников.
+"""
+import asyncio
+import os
+from datetime import date, timedelta
+from typing import Dict, Iterable, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import delete
+
+from ai.ai import openai_client
+from database.engine import session_maker
+from database.models import DailyLessonContent
+from database.topic_catalog import CachedTopic
+from speech.whisper_engine import generate_speech
+
+load_dotenv()
+
+LESSON_PREGENERATE_ENABLED = os.getenv("LESSON_PREGENERATE_ENABLED", "true").lower() == "true"
+# За сколько минут до урока готовить его содержимое
+LESSON_PREGENERATE_LEAD_MINUTES = int(os.getenv("LESSON_PREGENERATE_LEAD_MINUTES", "30"))
+# Сколько дней хранить подготовленные уроки
+LESSON_CONTENT_KEEP_DAYS = 7
+
+# Уроки, уже прочитанные или подготовленные в этом процессе
+_lessons: Dict[Tuple[int, date], DailyLessonContent] = {}
+_locks: Dict[Tuple[int, date], asyncio.Lock] = {}
+
+
+async def _generate_lesson(topic: CachedTopic, lesson_date: date) -> Tuple[DailyLessonContent, bool]:
+    """
+    Генерирует урок для темы.
+
+    Returns:
+        (урок, сгенерирован ли он полностью без запасных текстов)
+    """
+    complete = True
+
+    # Генерируем персонализированное сообщение через OpenAI
+    try:
+        lesson_text = await openai_client.generate_lesson_start_message(
+            topic_title=topic.title,
+            topic_description=topic.description
+        )
+    except Exception as e:
+        print(f"Ошибка при генерации сообщения через OpenAI: {e}")
+        # Fallback сообщение
+        lesson_text = f"Hello! 👋 My name is Marcus. Ready to learn about {topic.title}? Let's start our English lesson! (Привет! Готов изучать тему '{topic.title}'? Начинаем урок английского!)"
+        complete = False
+
+    # Генерируем задание для урока
+    topic_tasks = list(topic.task_list)
+    try:
+        task_text = await openai_client.generate_lesson_task(
+            topic_title=topic.title,
+            topic_description=topic.description,
+            topic_tasks=topic_tasks
+        )
+    except Exception as e:
+        print(f"Ошибка при генерации задания через OpenAI: {e}")
+        # Fallback задание
+        if topic_tasks:
+            task_text = topic_tasks[0]
+        else:
+            task_text = f"Расскажи о теме '{topic.title}' на английском языке"
+        complete = False
+
+    try:
+        audio = await generate_speech(lesson_text) or None
+    except Exception as e:
+        print(f"Ошибка при озвучивании урока темы {topic.id}: {e}")
+        audio = None
+
+    lesson = DailyLessonContent(
+        topic_id=topic.id,
+        lesson_date=lesson_date,
+        lesson_text=lesson_text,
+        task_text=task_text,
+        audio=audio
+    )
+    return lesson, complete
+
+
+async def get_daily_lesson(
+    topic: CachedTopic,
+    lesson_date: date,
+    keep_fallback: bool = True
+) -> DailyLessonContent:
+    """
+    Возвращает урок дня для темы: из памяти, из БД или генерирует его.
+    Параллельные запросы одной темы ждут одну генерацию.
+
+    Args:
+        keep_fallback: Запомнить урок с запасными текстами до конца дня
+            (при подготовке заранее - нет, рассылка попробует сгенерировать снова)
+    """
+    key = (topic.id, lesson_date)
+    lesson = _lessons.get(key)
+    if lesson is not None:
+        return lesson
+
+    async with _locks.setdefault(key, asyncio.Lock()):
+        lesson = _lessons.get(key)
+        if lesson is not None:
+            return lesson
+
+        async with session_maker() as session:
+            lesson = await session.get(DailyLessonContent, (topic.id, lesson_date))
+
+        complete = True
+        if lesson is None:
+            lesson, complete = await _generate_lesson(topic, lesson_date)
+            # Запасные тексты в БД не сохраняем: следующая подготовка попробует снова
+            if complete:
+                try:
+                    async with session_maker() as session:
+                        lesson = await session.merge(lesson)
+                        await session.commit()
+                except Exception as e:
+                    print(f"❌ Ошибка при сохранении урока темы {topic.id}: {e}")
+
+        if complete or keep_fallback:
+            _lessons[key] = lesson
+        return lesson
+
+
+async def pregenerate_daily_lessons(topics: Iterable[CachedTopic], lesson_date: date) -> int:
+    """
+    Готовит уроки дня для всех переданных тем и удаляет устаревшие.
+    Возвращает количество тем.
+    """
+    unique_topics = {topic.id: topic for topic in topics}.values()
+    await asyncio.gather(*(
+        get_daily_lesson(topic, lesson_date, keep_fallback=False) for topic in unique_topics
+    ))
+
+    stale_before = lesson_date - timedelta(days=LESSON_CONTENT_KEEP_DAYS)
+    async with session_maker() as session:
+        await session.execute(delete(DailyLessonContent).where(DailyLessonContent.lesson_date < stale_before))
+        await session.commit()
+    for key in [key for key in _lessons if key[1] < lesson_date]:
+        _lessons.pop(key, None)
+        _locks.pop(key, None)
+
+    return len(unique_topics)
@@ -1,23 +1,55 @@
-import asyncio
 import os
-import json
+import pytz
 from datetime import datetime, time, timedelta
 from typing import Optional
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from dotenv import load_dotenv
+from aiogram.exceptions import TelegramForbiddenError
 
-from aiogram.types import FSInputFile
-from database.engine import session_maker
-from database.models import User, Topic, MessageHistory
-from sqlalchemy import select, update
+from database.engine import engine, session_maker
+from database.partitions import ensure_message_history_partitions
+from database.models import User, MessageHistory, MessageKind
+from database.topic_catalog import topic_catalog
+from sqlalchemy import select, update, func, and_, or_
 from ai.ai import openai_client
-from speech.whisper_engine import generate_speech, save_audio_to_file
+from ai.governor import background_job
+from handlers.sending_data import (
+    send_voice_reply, save_bot_message, get_next_topic_for_user, get_next_topics_for_users,
+    user_messages_between
+)
+from database.retention import (
+    compact_message_history, MESSAGE_RETENTION_ENABLED, MESSAGE_RETENTION_TIME
+)
 from text.text import scheduled_lesson_text, homework_reminder_text, buttons_info_text
 from kbds.inline import get_lesson_buttons_keyboard
+from scheduler.fanout import fan_out, BroadcastStatus, BroadcastRateLimiter
+from scheduler.run_state import (
+    start_runs, find_missed_runs, last_fire_time, to_utc, BROADCAST_MISFIRE_GRACE_SECONDS
+)
+from scheduler.sharding import ShardCoordinator, SCHEDULER_REBALANCE_SECONDS
+from scheduler.lesson_content import (
+    get_daily_lesson, pregenerate_daily_lessons,
+    LESSON_PREGENERATE_ENABLED, LESSON_PREGENERATE_LEAD_MINUTES
+)
 
 load_dotenv()
 
+# Рассылки по расписанию, пропущенное срабатывание которых выполняется при запуске бота
+CATCH_UP_JOB_IDS = ("daily_lesson", "weekly_homework", "new_week_topic")
+
+# Ученик в активном диалоге, если писал не раньше стольких секунд назад и урок не завершён
+ACTIVE_DIALOG_SECONDS = 600
+# Сколько последних сообщений проверять на завершение урока
+ACTIVE_DIALOG_MESSAGES = 3
+# Сколько прошлых вопросов на закрепление передавать в OpenAI, чтобы они не повторялись
+PREVIOUS_QUESTIONS_LIMIT = 5
+# По скольку учеников загружать данные для вопроса на закрепление одним запросом
+REINFORCEMENT_BATCH_SIZE = 1000
+# За сколько дней читать историю для вопроса на закрепление (остальные месячные
+# секции message_history запрос не затрагивает)
+REINFORCEMENT_LOOKBACK_DAYS = 14
+
 class LessonScheduler:
     """
     Планировщик для автоматических уроков английского языка
@@ -25,7 +57,18 @@ class LessonScheduler:
     
     def __init__(self, bot):
         self.bot = bot
-        self.scheduler = AsyncIOScheduler()
+        # Опоздавший запуск (event loop был занят) выполняется один раз, если опоздание
+        # не больше BROADCAST_MISFIRE_GRACE_SECONDS
+        self.scheduler = AsyncIOScheduler(job_defaults={
+            "coalesce": True,
+            "misfire_grace_time": BROADCAST_MISFIRE_GRACE_SECONDS,
+        })
+        
+        # Лимиты Telegram для рассылок (ответы ученикам вне рассылок не ограничиваются)
+        self.bot.session.middleware(BroadcastRateLimiter())
+        
+        # Шарды учеников этого процесса (при нескольких процессах бота)
+        self.shards = ShardCoordinator()
         
         # Получаем настройки из переменных окружения
         self.timezone = os.getenv("TIMEZONE", "Asia/Shanghai")  # UTC+8
@@ -46,6 +89,10 @@ class LessonScheduler:
         """
         print(f"🚀 Запуск планировщика уроков...")
         
+        # Забираем свою долю шардов учеников до первых рассылок
+        await self.shards.rebalance()
+        print(f"🔀 Шарды учеников: {self.shards.format()}")
+        
         if self.test_mode:
             print(f"🧪 ТЕСТОВЫЙ РЕЖИМ: каждые {self.test_interval_minutes} минут")
             # Добавляем только задачу для закрепления материала (каждые N минут)
@@ -75,6 +122,22 @@ class LessonScheduler:
                 replace_existing=True
             )
             
+            # Подготовка урока дня для всех тем заранее, до рассылки
+            if LESSON_PREGENERATE_ENABLED:
+                pregenerate_hour, pregenerate_minute = self._pregenerate_time()
+                self.scheduler.add_job(
+                    self.pregenerate_daily_lessons,
+                    CronTrigger(
+                        day_of_week='mon-fri',
+                        hour=pregenerate_hour,
+                        minute=pregenerate_minute,
+                        timezone=self.timezone
+                    ),
+                    id="daily_lesson_pregenerate",
+                    name=f"Подготовка урока дня (за {LESSON_PREGENERATE_LEAD_MINUTES} мин до урока)",
+                    replace_existing=True
+                )
+            
             # Добавляем задачу для закрепления материала (каждые N минут)
             self.scheduler.add_job(
                 self.send_reinforcement_question,
@@ -113,9 +176,46 @@ class LessonScheduler:
                 replace_existing=True
             )
         
+        # Добавляем задачу для создания секций message_history на следующие месяцы (ежедневно)
+        self.scheduler.add_job(
+            self.create_message_history_partitions,
+            CronTrigger(hour=3, minute=0, timezone=self.timezone),
+            id="message_history_partitions",
+            name="Создание секций истории сообщений на следующие месяцы",
+            replace_existing=True
+        )
+        
+        # Добавляем задачу для архивации старой истории сообщений (ежедневно ночью)
+        if MESSAGE_RETENTION_ENABLED:
+            retention_hour, retention_minute = map(int, MESSAGE_RETENTION_TIME.split(":"))
+            self.scheduler.add_job(
+                self.compact_message_history,
+                CronTrigger(
+                    hour=retention_hour,
+                    minute=retention_minute,
+                    timezone=self.timezone
+                ),
+                id="message_retention",
+                name=f"Архивация старой истории сообщений ({MESSAGE_RETENTION_TIME})",
+                replace_existing=True
+            )
+        
+        # Перераспределение шардов между процессами бота
+        self.scheduler.add_job(
+            self.rebalance_shards,
+            'interval',
+            seconds=SCHEDULER_REBALANCE_SECONDS,
+            id="shard_rebalance",
+            name="Перераспределение шардов учеников между процессами",
+            replace_existing=True
+        )
+        
         # Запускаем планировщик
         self.scheduler.start()
         print("✅ Планировщик запущен!")
+        
+        # Рассылки, которые должны были пройти, пока бот не работал
+        await self.run_missed_broadcasts()
     
     async def stop(self):
         """
@@ -124,398 +224,555 @@ class LessonScheduler:
         if self.scheduler.running:
             self.scheduler.shutdown()
             print("🛑 Планировщик остановлен!")
+        # Шарды сразу переходят к остальным процессам
+        await self.shards.close()
     
-    async def send_lesson_reminder(self):
+    async def rebalance_shards(self):
+        """
+        Перераспределяет шарды учеников между процессами бота. По полученным шардам
+        (например, от остановившегося процесса) выполняются их незавершённые рассылки
+        """
+        acquired = await self.shards.rebalance()
+        if acquired:
+            print(f"🔀 Получены шарды {sorted(acquired)}, свои: {self.shards.format()}")
+            await self.run_missed_broadcasts(acquired)
+
+    async def run_missed_broadcasts(self, shards=None):
+        """
+        Запускает один раз рассылки, последнее срабатывание которых было пропущено
+        или прервано перезапуском бота (не далее BROADCAST_MISFIRE_GRACE_SECONDS назад)
+        """
+        shards = self.shards.owned if shards is None else shards
+        if not shards:
+            return
+        jobs = [job for job in map(self.scheduler.get_job, CATCH_UP_JOB_IDS) if job is not None]
+        try:
+            missed = await find_missed_runs(jobs, shards)
+        except Exception as e:
+            print(f"❌ Ошибка при проверке пропущенных рассылок: {e}")
+            return
+        
+        for job, scheduled_for in missed:
+            print(f"⏰ Пропущенная рассылка {job.id} ({scheduled_for:%d.%m %H:%M} UTC) будет выполнена сейчас")
+            self.scheduler.add_job(
+                job.func,
+                kwargs={"scheduled_for": scheduled_for},
+                id=f"{job.id}_missed",
+                name=f"{job.name} (пропущенный запуск)",
+                replace_existing=True
+            )
+
+    def _scheduled_for(self, job_id: str) -> datetime:
+        """
+        Время текущего запуска задачи по расписанию (наивное UTC)
+        """
+        job = self.scheduler.get_job(job_id)
+        fire_time = last_fire_time(job.trigger) if job else None
+        return to_utc(fire_time) if fire_time else datetime.utcnow().replace(second=0, microsecond=0)
+
+    async def _start_run(self, job_id: str, scheduled_for: Optional[datetime]):
+        """
+        Начинает (или возобновляет после перезапуска) запуск рассылки по шардам процесса.
+        Возвращает None, если этот запуск уже выполнен
+        """
+        if not self.shards.owned:
+            print(f"⏭️ Рассылка {job_id}: у процесса нет шардов учеников")
+            return None
+        run = await start_runs(
+            job_id, scheduled_for or self._scheduled_for(job_id), self.shards.owned, self.shards.shard_of
+        )
+        if run is None:
+            print(f"⏭️ Рассылка {job_id} на это время уже выполнена")
+        return run
+
+    def _lesson_date(self):
+        """
+        Сегодняшняя дата в часовом поясе планировщика (день урока)
+        """
+        return datetime.now(pytz.timezone(self.timezone)).date()
+
+    def _lesson_day_bounds(self):
+        """
+        Начало и конец сегодняшнего дня урока (часовой пояс планировщика)
+        в наивном UTC, как время сообщений в БД
+        """
+        tz = pytz.timezone(self.timezone)
+        today = self._lesson_date()
+        start = tz.localize(datetime.combine(today, time.min))
+        end = tz.localize(datetime.combine(today + timedelta(days=1), time.min))
+        return to_utc(start), to_utc(end)
+
+    def _pregenerate_time(self):
+        """
+        Время подготовки урока: за LESSON_PREGENERATE_LEAD_MINUTES до урока,
+        но не раньше полуночи того же дня
+        """
+        lesson_minutes = self.lesson_time_obj.hour * 60 + self.lesson_time_obj.minute
+        pregenerate_minutes = max(0, lesson_minutes - LESSON_PREGENERATE_LEAD_MINUTES)
+        return divmod(pregenerate_minutes, 60)
+
+    @background_job
+    async def pregenerate_daily_lessons(self):
+        """
+        Готовит урок дня для следующих тем всех учеников
+        """
+        if not self.shards.is_leader:
+            return
+        try:
+            print(f"🧑‍🍳 Подготовка урока дня в {datetime.now()}")
+            _, next_topics = await self._load_users(with_next_topics=True)
+            count = await pregenerate_daily_lessons(next_topics.values(), self._lesson_date())
+            print(f"✅ Урок дня подготовлен для {count} тем")
+        except Exception as e:
+            print(f"❌ Ошибка при подготовке урока дня: {e}")
+
+    async def _load_users(self, with_next_topics: bool = False, shards=None):
+        """
+        Загружает всех пользователей (или только пользователей шардов shards)
+        и, при необходимости, их следующие темы одной короткой сессией -
+        дальше рассылка идёт без неё
+        """
+        async with session_maker() as session:
+            query = select(User).where(User.id.isnot(None))
+            if shards is not None:
+                query = query.where((User.id % self.shards.shards).in_(sorted(shards)))
+            result = await session.execute(query)
+            users = result.scalars().all()
+            
+            next_topics = {}
+            if with_next_topics:
+                # Следующие темы для всех пользователей одним запросом
+                next_topics = await get_next_topics_for_users(session, [user.id for user in users])
+        return users, next_topics
+
+    async def _is_in_active_dialog(self, session, user_id: int) -> bool:
+        """
+        Проверяет, не находится ли пользователь в активном диалоге
+        """
+        # Получаем последние сообщения пользователя
+        # (вопросы на закрепление не считаются активностью ученика)
+        last_messages_result = await session.execute(
+            select(MessageHistory)
+            .where(
+                MessageHistory.user_id == user_id,
+                MessageHistory.kind != MessageKind.REINFORCEMENT_QUESTION
+            )
+            .order_by(MessageHistory.timestamp.desc())
+            .limit(3)  # Получаем последние 3 сообщения
+        )
+        last_messages = last_messages_result.scalars().all()
+        return self._dialog_is_active(user_id, [(msg.timestamp, msg.kind) for msg in last_messages])
+
+    def _dialog_is_active(self, user_id: int, last_messages) -> bool:
+        """
+        Проверяет по последним сообщениям пользователя (время, тип; от новых к старым),
+        не находится ли он в активном диалоге
+        """
+        if last_messages:
+            last_timestamp = last_messages[0][0]
+            # Время сообщений в БД - UTC
+            time_diff = datetime.utcnow() - last_timestamp
+            
+            # Проверяем, есть ли завершающее сообщение от бота
+            has_ending_message = any(kind == MessageKind.ENDING for _, kind in last_messages)
+            
+            # Если последнее сообщение было менее 10 минут назад И нет завершающего сообщения, пропускаем пользователя
+            if time_diff.total_seconds() < ACTIVE_DIALOG_SECONDS and not has_ending_message:
+                print(f"⏭️ Пользователь {user_id} находится в активном диалоге (последнее сообщение {time_diff.total_seconds():.0f} сек назад)")
+                return True
+        return False
+
+    async def _get_reinforcement_context(self, session, user_ids):
+        """
+        Данные для вопроса на закрепление сразу для всех пользователей, одним запросом
+        на пачку учеников (оконные функции вместо нескольких запросов на каждого):
+        последние сообщения (кроме вопросов на закрепление) для проверки активного диалога,
+        занимался ли ученик сегодня и последние вопросы на закрепление.
+        Читаются только сообщения за REINFORCEMENT_LOOKBACK_DAYS дней.
+
+        Returns:
+            Словарь {user_id: {"last_messages": [(время, тип)], "studied_today": bool, "questions": [текст]}}
+        """
+        context = {
+            user_id: {"last_messages": [], "studied_today": False, "questions": []}
+            for user_id in user_ids
+        }
+        today, tomorrow = self._lesson_day_bounds()
+        since = datetime.utcnow() - timedelta(days=REINFORCEMENT_LOOKBACK_DAYS)
+        
+        is_question = MessageHistory.kind == MessageKind.REINFORCEMENT_QUESTION
+        is_service = MessageHistory.kind.in_(MessageKind.SERVICE)
+        
+        for start in range(0, len(user_ids), REINFORCEMENT_BATCH_SIZE):
+            batch = user_ids[start:start + REINFORCEMENT_BATCH_SIZE]
+            # Номер сообщения среди вопросов / остальных сообщений пользователя
+            # и среди служебных / учебных (от новых к старым)
+            ranked = (
+                select(
+                    MessageHistory.user_id,
+                    MessageHistory.timestamp,
+                    MessageHistory.kind,
+                    MessageHistory.question_text,
+                    func.row_number().over(
+                        partition_by=(MessageHistory.user_id, is_question),
+                        order_by=MessageHistory.timestamp.desc()
+                    ).label("recent_rank"),
+                    func.row_number().over(
+                        partition_by=(MessageHistory.user_id, is_service),
+                        order_by=MessageHistory.timestamp.desc()
+                    ).label("study_rank"),
+                )
+                .where(
+                    MessageHistory.user_id.in_(batch),
+                    MessageHistory.timestamp >= since
+                )
+                .subquery()
+            )
+            result = await session.execute(
+                select(ranked)
+                .where(or_(
+                    and_(ranked.c.kind == MessageKind.REINFORCEMENT_QUESTION,
+                         ranked.c.recent_rank <= PREVIOUS_QUESTIONS_LIMIT),
+                    and_(ranked.c.kind != MessageKind.REINFORCEMENT_QUESTION,
+                         ranked.c.recent_rank <= ACTIVE_DIALOG_MESSAGES),
+                    and_(ranked.c.kind.notin_(MessageKind.SERVICE), ranked.c.study_rank == 1),
+                ))
+                .order_by(ranked.c.user_id, ranked.c.timestamp.desc())
+            )
+            
+            for row in result:
+                user_context = context[row.user_id]
+                if row.kind == MessageKind.REINFORCEMENT_QUESTION:
+                    if row.recent_rank <= PREVIOUS_QUESTIONS_LIMIT and row.question_text:
+                        user_context["questions"].append(row.question_text)
+                elif row.recent_rank <= ACTIVE_DIALOG_MESSAGES:
+                    user_context["last_messages"].append((row.timestamp, row.kind))
+                # Последнее учебное сообщение пользователя - сегодня
+                if row.kind not in MessageKind.SERVICE and row.study_rank == 1:
+                    user_context["studied_today"] = today <= row.timestamp < tomorrow
+        return context
+
+    @background_job
+    async def send_lesson_reminder(self, scheduled_for: Optional[datetime] = None):
         """
         Отправляет напоминание о начале урока с голосовым сообщением
         """
         try:
             print(f"📚 Отправка напоминания о уроке в {datetime.now()}")
             
-            # Получаем всех активных пользователей
-            async with session_maker() as session:
-                result = await session.execute(
-                    select(User).where(User.id.isnot(None))
+            # Пока идёт рассылка, шарды процесса не переходят к другим процессам
+            async with self.shards.hold():
+                run = await self._start_run("daily_lesson", scheduled_for)
+                if run is None:
+                    return
+            
+                # Получаем всех активных пользователей
+                users, next_topics = await self._load_users(with_next_topics=True, shards=run.shards)
+            
+                summary = await fan_out(
+                    "Ежедневный урок",
+                    users,
+                    lambda user: self._send_lesson_to_user(user, next_topics.get(user.id)),
+                    run=run
                 )
-                users = result.scalars().all()
-                
-                for user in users:
-                    try:
-                        # Проверяем, не находится ли пользователь в активном диалоге
-                        # Получаем последние сообщения пользователя
-                        last_messages_result = await session.execute(
-                            select(MessageHistory)
-                            .where(MessageHistory.user_id == user.id)
-                            .order_by(MessageHistory.timestamp.desc())
-                            .limit(3)  # Получаем последние 3 сообщения
-                        )
-                        last_messages = last_messages_result.scalars().all()
-                        
-                        if last_messages:
-                            last_message = last_messages[0]
-                            time_diff = datetime.now() - last_message.timestamp
-                            
-                            # Проверяем, есть ли завершающее сообщение от бота
-                            has_ending_message = False
-                            for msg in last_messages:
-                                if (msg.role == 'bot' and 
-                                    any(phrase in msg.content.lower() for phrase in [
-                                        'пора закончить разговор',
-                                        'кажется, пора закончить',
-                                        'закончить разговор',
-                                        'всегда можешь вернуться',
-                                        '🏁'
-                                    ])):
-                                    has_ending_message = True
-                                    break
-                            
-                            # Если последнее сообщение было менее 10 минут назад И нет завершающего сообщения, пропускаем пользователя
-                            if time_diff.total_seconds() < 600 and not has_ending_message:  # 10 минут = 600 секунд
-                                print(f"⏭️ Пользователь {user.id} находится в активном диалоге (последнее сообщение {time_diff.total_seconds():.0f} сек назад)")
-                                continue
-                        
-                        # Получаем следующую тему для пользователя
-                        next_topic = await self._get_next_topic_for_user(session, user)
-                        
-                        if next_topic:
-                            # Генерируем персонализированное сообщение через OpenAI
-                            try:
-                                lesson_text = await openai_client.generate_lesson_start_message(
-                                    topic_title=next_topic.title,
-                                    topic_description=next_topic.description
-                                )
-                            except Exception as e:
-                                print(f"Ошибка при генерации сообщения через OpenAI: {e}")
-                                # Fallback сообщение
-                                lesson_text = f"Hello! 👋 My name is Marcus. Ready to learn about {next_topic.title}? Let's start our English lesson! (Привет! Готов изучать тему '{next_topic.title}'? Начинаем урок английского!)"
-                            
-                            # Генерируем задание для урока
-                            try:
-                                topic_tasks = json.loads(next_topic.tasks) if next_topic.tasks else []
-                                task_text = await openai_client.generate_lesson_task(
-                                    topic_title=next_topic.title,
-                                    topic_description=next_topic.description,
-                                    topic_tasks=topic_tasks
-                                )
-                            except Exception as e:
-                                print(f"Ошибка при генерации задания через OpenAI: {e}")
-                                # Fallback задание
-                                if topic_tasks and len(topic_tasks) > 0:
-                                    task_text = topic_tasks[0]
-                                else:
-                                    task_text = f"Расскажи о теме '{next_topic.title}' на английском языке"
-                            
-                            # Устанавливаем тему как текущую для пользователя
-                            user.current_topic_id = next_topic.id
-                            await session.commit()
-                        else:
-                            # Если все темы пройдены
-                            lesson_text = "🎉 Congratulations! You've completed all topics! You're doing great! (Поздравляю! Вы изучили все темы! Вы отлично справляетесь!)"
-                        
-                        try:
-                            audio_bytes = await generate_speech(lesson_text)
-                            if audio_bytes:
-                                # Сохраняем аудио в файл
-                                audio_path = await save_audio_to_file(audio_bytes, f"lesson_reminder_{user.id}.mp3")
-                                if audio_path:
-                                    # Отправляем голосовое сообщение
-                                    await self.bot.send_voice(
-                                        chat_id=user.id,
-                                        voice=FSInputFile(audio_path),
-                                        caption=lesson_text
-                                    )
-                                    # Удаляем временный файл
-                                    try:
-                                        os.unlink(audio_path)
-                                    except:
-                                        pass
-                                else:
-                                    # Если не удалось сохранить аудио, отправляем только текст
-                                    await self.bot.send_message(
-                                        chat_id=user.id,
-                                        text=lesson_text
-                                    )
-                            else:
-                                # Если не удалось сгенерировать аудио, отправляем только текст
-                                await self.bot.send_message(
-                                    chat_id=user.id,
-                                    text=lesson_text
-                                )
-                        except Exception as e:
-                            print(f"Ошибка при генерации голосового сообщения для пользователя {user.id}: {e}")
-                            # Fallback на текстовое сообщение
-                            await self.bot.send_message(
-                                chat_id=user.id,
-                                text=lesson_text
-                            )
-                        
-                        # Отправляем второе сообщение с заданием
-                        from text.text import lesson_task_text
-                        if next_topic:
-                            task_message = lesson_task_text.format(task_text=task_text)
-                            await self.bot.send_message(
-                                chat_id=user.id,
-                                text=task_message
-                            )
-                        
-                        print(f"✅ Напоминание отправлено пользователю {user.id}")
-                        
-                        # Небольшая задержка между сообщениями
-                        await asyncio.sleep(0.1)
-                        
-                    except Exception as e:
-                        print(f"❌ Ошибка отправки пользователю {user.id}: {e}")
+                await run.finish(summary)
                         
         except Exception as e:
             print(f"❌ Ошибка в send_lesson_reminder: {e}")
 
-    async def send_reinforcement_question(self):
+    async def _send_lesson_to_user(self, user, next_topic) -> str:
+        """
+        Отправляет напоминание о начале урока одному пользователю
+        """
+        async with session_maker() as session:
+            if await self._is_in_active_dialog(session, user.id):
+                return BroadcastStatus.SKIPPED
+        
+        lesson_audio = None
+        if next_topic:
+            # Урок дня для темы готовится заранее (один раз для всех учеников на этой теме)
+            lesson = await get_daily_lesson(next_topic, self._lesson_date())
+            lesson_text = lesson.lesson_text
+            task_text = lesson.task_text
+            lesson_audio = lesson.audio
+            
+            # Устанавливаем тему как текущую для пользователя
+            async with session_maker() as session:
+                await session.execute(
+                    update(User)
+                    .where(User.id == user.id)
+                    .values(current_topic_id=next_topic.id)
+                )
+                await session.commit()
+        else:
+            # Если все темы пройдены
+            lesson_text = "🎉 Congratulations! You've completed all topics! You're doing great! (Поздравляю! Вы изучили все темы! Вы отлично справляетесь!)"
+        
+        try:
+            # Отправляем голосовое сообщение
+            voice_sent = await send_voice_reply(
+                self.bot, user.id, lesson_text, caption=lesson_text, audio=lesson_audio
+            )
+            if not voice_sent:
+                # Если не удалось сгенерировать аудио, отправляем только текст
+                await self.bot.send_message(
+                    chat_id=user.id,
+                    text=lesson_text
+                )
+        except TelegramForbiddenError:
+            raise
+        except Exception as e:
+            print(f"Ошибка при генерации голосового сообщения для пользователя {user.id}: {e}")
+            # Fallback на текстовое сообщение
+            await self.bot.send_message(
+                chat_id=user.id,
+                text=lesson_text
+            )
+        
+        # Отправляем второе сообщение с заданием
+        from text.text import lesson_task_text
+        if next_topic:
+            task_message = lesson_task_text.format(task_text=task_text)
+            await self.bot.send_message(
+                chat_id=user.id,
+                text=task_message
+            )
+        
+        print(f"✅ Напоминание отправлено пользователю {user.id}")
+        return BroadcastStatus.SENT
+
+    @background_job
+    async def send_reinforcement_question(self, scheduled_for: Optional[datetime] = None):
         """
         Отправляет вопрос на закрепление материала, пройденного сегодня
         """
         try:
             print(f"🔍 Отправка вопроса на закрепление в {datetime.now()}")
             
-            # Получаем всех активных пользователей
-            async with session_maker() as session:
-                result = await session.execute(
-                    select(User).where(User.id.isnot(None))
-                )
-                users = result.scalars().all()
+            # Пока идёт рассылка, шарды процесса не переходят к другим процессам
+            async with self.shards.hold():
+                run = await self._start_run("reinforcement_question", scheduled_for)
+                if run is None:
+                    return
+            
+                # Получаем всех активных пользователей
+                users, _ = await self._load_users(shards=run.shards)
                 
-                for user in users:
-                    try:
-                        # Проверяем, не находится ли пользователь в активном диалоге
-                        # Получаем последние сообщения пользователя
-                        last_messages_result = await session.execute(
-                            select(MessageHistory)
-                            .where(MessageHistory.user_id == user.id)
-                            .order_by(MessageHistory.timestamp.desc())
-                            .limit(3)  # Получаем последние 3 сообщения
-                        )
-                        last_messages = last_messages_result.scalars().all()
-                        
-                        if last_messages:
-                            last_message = last_messages[0]
-                            time_diff = datetime.now() - last_message.timestamp
-                            
-                            # Проверяем, есть ли завершающее сообщение от бота
-                            has_ending_message = False
-                            for msg in last_messages:
-                                if (msg.role == 'bot' and 
-                                    any(phrase in msg.content.lower() for phrase in [
-                                        'пора закончить разговор',
-                                        'кажется, пора закончить',
-                                        'закончить разговор',
-                                        'всегда можешь вернуться',
-                                        '🏁'
-                                    ])):
-                                    has_ending_message = True
-                                    break
-                            
-                            # Если последнее сообщение было менее 10 минут назад И нет завершающего сообщения, пропускаем пользователя
-                            if time_diff.total_seconds() < 600 and not has_ending_message:  # 10 минут = 600 секунд
-                                print(f"⏭️ Пользователь {user.id} находится в активном диалоге (последнее сообщение {time_diff.total_seconds():.0f} сек назад)")
-                                continue
-                        
-                        # Получаем тему, которую пользователь изучал сегодня
-                        today_topic = await self._get_today_topic_for_user(session, user)
-                        
-                        if today_topic:
-                            # Генерируем простой вопрос на закрепление
-                            try:
-                                question = await self._generate_reinforcement_question(today_topic)
-                            except Exception as e:
-                                print(f"Ошибка при генерации вопроса через OpenAI: {e}")
-                                # Fallback вопрос
-                                question = f"What do you think about {today_topic.title}?"
-                            
-                            # Отправляем вопрос
-                            await self.bot.send_message(
-                                chat_id=user.id,
-                                text=f"💭 Вопрос на закрепление материала:\n\n{question}\n\nОтправьте текстовый ответ!")
-                            
-                            print(f"✅ Вопрос на закрепление отправлен пользователю {user.id}")
-                        else:
-                            # Если пользователь не изучал тему сегодня, пропускаем
-                            print(f"⏭️ Пользователь {user.id} не изучал тему сегодня")
-                        
-                        # Небольшая задержка между сообщениями
-                        await asyncio.sleep(0.1)
-                        
-                    except Exception as e:
-                        print(f"❌ Ошибка отправки вопроса пользователю {user.id}: {e}")
+                # Последние сообщения и прошлые вопросы всех пользователей - пачками, без запросов на каждого
+                async with session_maker() as session:
+                    contexts = await self._get_reinforcement_context(session, [user.id for user in users])
+            
+                summary = await fan_out(
+                    "Вопрос на закрепление",
+                    users,
+                    lambda user: self._send_reinforcement_to_user(user, contexts[user.id]),
+                    run=run
+                )
+                await run.finish(summary)
                         
         except Exception as e:
             print(f"❌ Ошибка в send_reinforcement_question: {e}")
 
-    async def send_weekly_homework(self):
+    async def _send_reinforcement_to_user(self, user, context) -> str:
+        """
+        Отправляет вопрос на закрепление одному пользователю
+        (context - данные пользователя из _get_reinforcement_context)
+        """
+        if self._dialog_is_active(user.id, context["last_messages"]):
+            return BroadcastStatus.SKIPPED
+        
+        # Тема, которую пользователь изучал сегодня - текущая (из каталога тем, без запроса)
+        today_topic = await topic_catalog.get(user.current_topic_id) if context["studied_today"] else None
+        
+        if not today_topic:
+            # Если пользователь не изучал тему сегодня, пропускаем
+            print(f"⏭️ Пользователь {user.id} не изучал тему сегодня")
+            return BroadcastStatus.SKIPPED
+        
+        previous_questions = context["questions"]
+        
+        # Генерируем простой вопрос на закрепление
+        try:
+            question = await self._generate_reinforcement_question(today_topic, previous_questions)
+        except Exception as e:
+            print(f"Ошибка при генерации вопроса через OpenAI: {e}")
+            # Fallback вопрос
+            question = f"What do you think about {today_topic.title}?"
+        
+        # Отправляем вопрос
+        question_message = f"💭 Вопрос на закрепление материала:\n\n{question}\n\nОтправьте текстовый ответ!"
+        await self.bot.send_message(
+            chat_id=user.id,
+            text=question_message)
+        
+        async with session_maker() as session:
+            await save_bot_message(
+                session, user.id, question_message,
+                MessageKind.REINFORCEMENT_QUESTION, question_text=question
+            )
+        
+        print(f"✅ Вопрос на закрепление отправлен пользователю {user.id}")
+        return BroadcastStatus.SENT
+
+    @background_job
+    async def send_weekly_homework(self, scheduled_for: Optional[datetime] = None):
         """
         Отправляет еженедельное домашнее задание (пятница)
         """
         try:
             print(f"📝 Отправка еженедельного домашнего задания в {datetime.now()}")
             
-            # Получаем всех активных пользователей
-            async with session_maker() as session:
-                result = await session.execute(
-                    select(User).where(User.id.isnot(None))
+            # Пока идёт рассылка, шарды процесса не переходят к другим процессам
+            async with self.shards.hold():
+                run = await self._start_run("weekly_homework", scheduled_for)
+                if run is None:
+                    return
+            
+                # Получаем всех активных пользователей
+                users, _ = await self._load_users(shards=run.shards)
+            
+                summary = await fan_out(
+                    "Еженедельное домашнее задание", users, self._send_weekly_homework_to_user, run=run
                 )
-                users = result.scalars().all()
-                
-                for user in users:
-                    try:
-                        # Получаем тему, которую пользователь изучал на этой неделе
-                        weekly_topic = await self._get_weekly_topic_for_user(session, user)
-                        
-                        if weekly_topic:
-                            # Генерируем домашнее задание
-                            try:
-                                homework_text = await openai_client.generate_homework(
-                                    current_topic={
-                                        "title": weekly_topic.title,
-                                        "description": weekly_topic.description,
-                                        "tasks": json.loads(weekly_topic.tasks) if weekly_topic.tasks else []
-                                    },
-                                    conversation_history=[]  # Пустая история для еженедельного ДЗ
-                                )
-                            except Exception as e:
-                                print(f"Ошибка при генерации домашнего задания через OpenAI: {e}")
-                                # Fallback домашнее задание
-                                homework_text = f"Напишите небольшое эссе (5-7 предложений) на тему '{weekly_topic.title}'. Используйте изученные слова и грамматические конструкции."
-                            
-                            # Отправляем домашнее задание
-                            from text.text import homework_assigned_text
-                            homework_message = homework_assigned_text.format(homework_text=homework_text)
-                            await self.bot.send_message(
-                                chat_id=user.id,
-                                text=homework_message
-                            )
-                            
-                            print(f"✅ Еженедельное домашнее задание отправлено пользователю {user.id}")
-                        else:
-                            # Если пользователь не изучал тему на этой неделе
-                            await self.bot.send_message(
-                                chat_id=user.id,
-                                text="📚 На этой неделе вы не изучали новые темы. Отдохните и подготовьтесь к следующей неделе! 😊"
-                            )
-                        
-                        # Небольшая задержка между сообщениями
-                        await asyncio.sleep(0.1)
-                        
-                    except Exception as e:
-                        print(f"❌ Ошибка отправки домашнего задания пользователю {user.id}: {e}")
+                await run.finish(summary)
                         
         except Exception as e:
             print(f"❌ Ошибка в send_weekly_homework: {e}")
 
-    async def start_new_week_topic(self):
+    async def _send_weekly_homework_to_user(self, user) -> str:
+        """
+        Отправляет еженедельное домашнее задание одному пользователю
+        """
+        # Получаем тему, которую пользователь изучал на этой неделе
+        async with session_maker() as session:
+            weekly_topic = await self._get_weekly_topic_for_user(session, user)
+        
+        if not weekly_topic:
+            # Если пользователь не изучал тему на этой неделе
+            await self.bot.send_message(
+                chat_id=user.id,
+                text="📚 На этой неделе вы не изучали новые темы. Отдохните и подготовьтесь к следующей неделе! 😊"
+            )
+            return BroadcastStatus.SENT
+        
+        # Генерируем домашнее задание
+        try:
+            homework_text = await openai_client.generate_homework(
+                current_topic=weekly_topic.as_dict(),
+                conversation_history=[]  # Пустая история для еженедельного ДЗ
+            )
+        except Exception as e:
+            print(f"Ошибка при генерации домашнего задания через OpenAI: {e}")
+            # Fallback домашнее задание
+            homework_text = f"Напишите небольшое эссе (5-7 предложений) на тему '{weekly_topic.title}'. Используйте изученные слова и грамматические конструкции."
+        
+        # Отправляем домашнее задание
+        from text.text import homework_assigned_text
+        homework_message = homework_assigned_text.format(homework_text=homework_text)
+        await self.bot.send_message(
+            chat_id=user.id,
+            text=homework_message
+        )
+        
+        print(f"✅ Еженедельное домашнее задание отправлено пользователю {user.id}")
+        return BroadcastStatus.SENT
+
+    @background_job
+    async def start_new_week_topic(self, scheduled_for: Optional[datetime] = None):
         """
         Переходит к новой теме в начале недели (понедельник)
         """
         try:
             print(f"🔄 Переход к новой теме в {datetime.now()}")
             
-            # Получаем всех активных пользователей
-            async with session_maker() as session:
-                result = await session.execute(
-                    select(User).where(User.id.isnot(None))
+            # Пока идёт рассылка, шарды процесса не переходят к другим процессам
+            async with self.shards.hold():
+                run = await self._start_run("new_week_topic", scheduled_for)
+                if run is None:
+                    return
+            
+                # Получаем всех активных пользователей
+                users, next_topics = await self._load_users(with_next_topics=True, shards=run.shards)
+            
+                summary = await fan_out(
+                    "Новая тема недели",
+                    users,
+                    lambda user: self._start_new_week_topic_for_user(user, next_topics.get(user.id)),
+                    run=run
                 )
-                users = result.scalars().all()
-                
-                for user in users:
-                    try:
-                        # Получаем следующую тему для пользователя
-                        next_topic = await self._get_next_topic_for_user(session, user)
-                        
-                        if next_topic:
-                            # Устанавливаем новую тему как текущую
-                            await session.execute(
-                                update(User)
-                                .where(User.id == user.id)
-                                .values(current_topic_id=next_topic.id)
-                            )
-                            await session.commit()
-                            
-                            # Отправляем сообщение о новой теме
-                            message = f"🎯 Новая неделя - новая тема! На этой неделе мы будем изучать: **{next_topic.title}**\n\n{next_topic.description}\n\nГотовы начать? Отправьте голосовое сообщение!"
-                            
-                            await self.bot.send_message(
-                                chat_id=user.id,
-                                text=message
-                            )
-                            
-                            print(f"✅ Новая тема установлена для пользователя {user.id}: {next_topic.title}")
-                        else:
-                            # Если все темы пройдены
-                            await self.bot.send_message(
-                                chat_id=user.id,
-                                text="🎉 Поздравляю! Вы изучили все доступные темы! Вы отлично справляетесь! 😊"
-                            )
-                        
-                        # Небольшая задержка между сообщениями
-                        await asyncio.sleep(0.1)
-                        
-                    except Exception as e:
-                        print(f"❌ Ошибка установки новой темы для пользователя {user.id}: {e}")
+                await run.finish(summary)
                         
         except Exception as e:
             print(f"❌ Ошибка в start_new_week_topic: {e}")
 
-    async def _get_next_topic_for_user(self, session, user):
+    async def _start_new_week_topic_for_user(self, user, next_topic) -> str:
         """
-        Получает следующую непройденную тему для пользователя
+        Устанавливает новую тему недели одному пользователю
         """
-        try:
-            # Получаем список пройденных тем
-            progress_str = str(user.progress) if user.progress else "[]"
-            completed_topics = json.loads(progress_str)
-            
-            # Ищем непройденную тему
-            result = await session.execute(
-                select(Topic)
-                .where(Topic.id.notin_(completed_topics))
-                .order_by(Topic.id)
-                .limit(1)
+        if not next_topic:
+            # Если все темы пройдены
+            await self.bot.send_message(
+                chat_id=user.id,
+                text="🎉 Поздравляю! Вы изучили все доступные темы! Вы отлично справляетесь! 😊"
             )
-            
-            return result.scalar_one_or_none()
-            
+            return BroadcastStatus.SENT
+        
+        # Устанавливаем новую тему как текущую
+        async with session_maker() as session:
+            await session.execute(
+                update(User)
+                .where(User.id == user.id)
+                .values(current_topic_id=next_topic.id)
+            )
+            await session.commit()
+        
+        # Отправляем сообщение о новой теме
+        message = f"🎯 Новая неделя - новая тема! На этой неделе мы будем изучать: **{next_topic.title}**\n\n{next_topic.description}\n\nГотовы начать? Отправьте голосовое сообщение!"
+        
+        await self.bot.send_message(
+            chat_id=user.id,
+            text=message
+        )
+        
+        print(f"✅ Новая тема установлена для пользователя {user.id}: {next_topic.title}")
+        return BroadcastStatus.SENT
+
+    async def create_message_history_partitions(self):
+        """
+        Заранее создаёт секции message_history на следующие месяцы
+        """
+        if not self.shards.is_leader:
+            return
+        try:
+            async with engine.begin() as conn:
+                partitions = await ensure_message_history_partitions(conn)
+            if partitions:
+                print(f"✅ Секции истории сообщений на месте: {', '.join(partitions)}")
         except Exception as e:
-            print(f"Ошибка при получении следующей темы для пользователя {user.id}: {e}")
-            return None
+            print(f"❌ Ошибка при создании секций истории сообщений: {e}")
 
-    async def _get_today_topic_for_user(self, session, user):
+    async def compact_message_history(self):
         """
-        Получает тему, которую пользователь изучал сегодня
+        Переносит старые сообщения из message_history в архив
         """
+        if not self.shards.is_leader:
+            return
         try:
-            # Получаем сообщения пользователя за сегодня
-            today = datetime.now().date()
-            result = await session.execute(
-                select(MessageHistory)
-                .where(
-                    MessageHistory.user_id == user.id,
-                    MessageHistory.timestamp >= today
-                )
-                .order_by(MessageHistory.timestamp.desc())
-                .limit(10)
-            )
-            
-            today_messages = result.scalars().all()
-            
-            if today_messages:
-                # Если есть сообщения за сегодня, возвращаем текущую тему
-                if user.current_topic_id:
-                    topic_result = await session.execute(
-                        select(Topic).where(Topic.id == user.current_topic_id)
-                    )
-                    return topic_result.scalar_one_or_none()
-            
-            return None
+            print(f"🗄️ Архивация истории сообщений в {datetime.now()}")
+            users, archived = await compact_message_history()
+            print(f"✅ Архивация завершена: пользователей {users}, сообщений перенесено {archived}")
+        except Exception as e:
+            print(f"❌ Ошибка при архивации истории сообщений: {e}")
+
+    async def _get_next_topic_for_user(self, session, user):
+        """
+        Получает следующую непройденную тему для пользователя
+        """
+        try:
+            return await get_next_topic_for_user(session, user.id)
             
         except Exception as e:
-            print(f"Ошибка при получении темы за сегодня для пользователя {user.id}: {e}")
+            print(f"Ошибка при получении следующей темы для пользователя {user.id}: {e}")
             return None
 
     async def _get_weekly_topic_for_user(self, session, user):
@@ -525,15 +782,12 @@ class LessonScheduler:
         try:
             # Получаем начало недели (понедельник)
             today = datetime.now().date()
-            start_of_week = today - timedelta(days=today.weekday())
+            start_of_week = datetime.combine(today - timedelta(days=today.weekday()), time.min)
             
             # Получаем сообщения пользователя за эту неделю
             result = await session.execute(
-                select(MessageHistory)
-                .where(
-                    MessageHistory.user_id == user.id,
-                    MessageHistory.timestamp >= start_of_week
-                )
+                user_messages_between(user.id, start_of_week, start_of_week + timedelta(days=7))
+                .where(MessageHistory.kind.notin_(MessageKind.SERVICE))
                 .order_by(MessageHistory.timestamp.desc())
                 .limit(20)
             )
@@ -542,11 +796,7 @@ class LessonScheduler:
             
             if weekly_messages:
                 # Если есть сообщения за неделю, возвращаем текущую тему
-                if user.current_topic_id:
-                    topic_result = await session.execute(
-                        select(Topic).where(Topic.id == user.current_topic_id)
-                    )
-                    return topic_result.scalar_one_or_none()
+                return await topic_catalog.get(user.current_topic_id)
             
             return None
             
@@ -554,7 +804,7 @@ class LessonScheduler:
             print(f"Ошибка при получении темы за неделю для пользователя {user.id}: {e}")
             return None
 
-    async def _generate_reinforcement_question(self, topic):
+    async def _generate_reinforcement_question(self, topic, previous_questions: Optional[list] = None):
         """
         Генерирует простой вопрос на закрепление материала
         """
@@ -584,12 +834,17 @@ class LessonScheduler:
             Вопрос должен быть простым и мотивировать ученика к размышлению.
             """
             
+            if previous_questions:
+                user_prompt += "\nНе повторяй вопросы, которые уже задавались:\n" + "\n".join(
+                    f"- {question}" for question in previous_questions
+                )
+            
             messages = [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
             ]
             
-            response = await openai_client.client.chat.completions.create(
+            response = await openai_client.create_chat_completion(
                 model="gpt-4o-mini",
                 messages=messages,
                 max_tokens=50,
@@ -612,29 +867,9 @@ class LessonScheduler:
             test_text = "🧪 Hello! This is a test message from the lesson scheduler. Everything is working correctly!"
             
             try:
-                audio_bytes = await generate_speech(test_text)
-                if audio_bytes:
-                    # Сохраняем аудио в файл
-                    audio_path = await save_audio_to_file(audio_bytes, f"test_message_{user_id}.mp3")
-                    if audio_path:
-                        # Отправляем голосовое сообщение
-                        await self.bot.send_voice(
-                            chat_id=user_id,
-                            voice=FSInputFile(audio_path),
-                            caption=test_text
-                        )
-                        # Удаляем временный файл
-                        try:
-                            os.unlink(audio_path)
-                        except:
-                            pass
-                    else:
-                        # Если не удалось сохранить аудио, отправляем только текст
-                        await self.bot.send_message(
-                            chat_id=user_id,
-                            text=test_text
-                        )
-                else:
+                # Отправляем голосовое сообщение
+                voice_sent = await send_voice_reply(self.bot, user_id, test_text, caption=test_text)
+                if not voice_sent:
                     # Если не удалось сгенерировать аудио, отправляем только текст
                     await self.bot.send_message(
                         chat_id=user_id,
@@ -0,0 +1,269 @@
+"""
+Состояние запусков рассылок в БД: переживает перезапуск бота.
+
+Каждый запуск задачи рассылки по расписанию - строки в scheduled_runs
+(job_id + время по расписанию + шард учеников, см. scheduler/sharding.py). Результат по каждому ученику пишется в broadcast_ledger
+сразу после обработки. Если бот перезапустился посреди рассылки, повторный запуск того же
+(job_id, scheduled_for, shard) пропускает учеников, уже получивших сообщение (или пропущенных,
+или заблокировавших бота), и продолжает с остальных. Ученики с ошибкой обрабатываются снова.
+
+Расписание задач по-прежнему задаётся в коде и переменных окружения: после запуска
+планировщик проверяет, не было ли пропущено последнее срабатывание задачи рассылки
+(бот не работал) не далее BROADCAST_MISFIRE_GRACE_SECONDS назад, и если запуск
+не завершён, выполняет его один раз.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, Optional, Set
+
+import pytz
+from dotenv import load_dotenv
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
+
+from database.engine import session_maker
+from database.models import ScheduledRun, BroadcastDelivery
+from scheduler.fanout import BroadcastStatus, FanOutSummary
+
+load_dotenv()
+
+# Насколько поздно (сек) ещё можно выполнить пропущенную рассылку
+BROADCAST_MISFIRE_GRACE_SECONDS = int(os.getenv("BROADCAST_MISFIRE_GRACE_SECONDS", "3600"))
+# Сколько дней хранить журнал рассылок
+BROADCAST_LEDGER_KEEP_DAYS = int(os.getenv("BROADCAST_LEDGER_KEEP_DAYS", "30"))
+
+RUN_RUNNING = "running"
+RUN_COMPLETED = "completed"
+
+# Ученики с этими результатами при возобновлении рассылки не обрабатываются повторно
+FINAL_STATUSES = (BroadcastStatus.SENT, BroadcastStatus.SKIPPED, BroadcastStatus.BLOCKED)
+
+# Насколько далеко в прошлое искать последнее срабатывание расписания
+LAST_FIRE_LOOKBACK = timedelta(days=8)
+
+
+def to_utc(moment: datetime) -> datetime:
+    """
+    Время срабатывания планировщика (с часовым поясом) -> наивное UTC, как в БД.
+    """
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def last_fire_time(trigger, now: Optional[datetime] = None) -> Optional[datetime]:
+    """
+    Последнее срабатывание триггера APScheduler не позже now (или None).
+    """
+    now = now or datetime.now(pytz.utc)
+    previous = None
+    fire_time = trigger.get_next_fire_time(None, now - LAST_FIRE_LOOKBACK)
+    while fire_time is not None and fire_time <= now:
+        previous = fire_time
+        fire_time = trigger.get_next_fire_time(fire_time, fire_time + timedelta(seconds=1))
+    return previous
+
+
+class BroadcastRun:
+    """
+    Запуск рассылки: кому уже отправлено и запись результатов в журнал.
+    run_id None - журнал недоступен, рассылка идёт без него.
+    """
+
+    def __init__(self, run_id: Optional[int], job_id: str, scheduled_for: datetime,
+                 done: Optional[Set[int]] = None, shard: int = 0):
+        self.run_id = run_id
+        self.job_id = job_id
+        self.scheduled_for = scheduled_for
+        self.shard = shard
+        self.done: Set[int] = done or set()
+
+    async def record(self, user_id: int, status: str, error: Optional[BaseException] = None) -> None:
+        """
+        Записывает результат обработки ученика.
+        """
+        if self.run_id is None:
+            return
+        try:
+            async with session_maker() as session:
+                await session.merge(BroadcastDelivery(
+                    run_id=self.run_id,
+                    user_id=user_id,
+                    status=status,
+                    error=str(error) if error is not None else None,
+                    updated_at=datetime.utcnow()
+                ))
+                await session.commit()
+        except Exception as e:
+            print(f"❌ Ошибка при записи в журнал рассылки {self.job_id} (пользователь {user_id}): {e}")
+
+    async def finish(self, summary: Optional[FanOutSummary] = None) -> None:
+        """
+        Отмечает запуск завершённым.
+        """
+        if self.run_id is None:
+            return
+        try:
+            async with session_maker() as session:
+                await session.execute(
+                    update(ScheduledRun)
+                    .where(ScheduledRun.id == self.run_id)
+                    .values(
+                        status=RUN_COMPLETED,
+                        finished_at=datetime.utcnow(),
+                        summary=summary.format() if summary else None
+                    )
+                )
+                await session.commit()
+        except Exception as e:
+            print(f"❌ Ошибка при завершении запуска {self.job_id} (шард {self.shard}): {e}")
+
+
+class ShardedRun:
+    """
+    Запуск рассылки по нескольким шардам учеников: по BroadcastRun на шард.
+    Для fan_out выглядит как один запуск.
+    """
+
+    def __init__(self, runs: Dict[int, BroadcastRun], shard_of: Callable[[int], int]):
+        self.runs = runs
+        self.shard_of = shard_of
+        self.done: Set[int] = set().union(*(run.done for run in runs.values()))
+
+    @property
+    def shards(self) -> Set[int]:
+        return set(self.runs)
+
+    async def record(self, user_id: int, status: str, error: Optional[BaseException] = None) -> None:
+        run = self.runs.get(self.shard_of(user_id))
+        if run is not None:
+            await run.record(user_id, status, error)
+
+    async def finish(self, summary: Optional[FanOutSummary] = None) -> None:
+        """
+        Отмечает запуски всех шардов завершёнными и удаляет устаревшие записи журнала.
+        """
+        for run in self.runs.values():
+            await run.finish(summary)
+        try:
+            await delete_old_runs()
+        except Exception as e:
+            print(f"❌ Ошибка при очистке журнала рассылок: {e}")
+
+
+async def _get_run(session, job_id: str, scheduled_for: datetime, shard: int = 0) -> Optional[ScheduledRun]:
+    result = await session.execute(
+        select(ScheduledRun).where(
+            ScheduledRun.job_id == job_id,
+            ScheduledRun.scheduled_for == scheduled_for,
+            ScheduledRun.shard == shard
+        )
+    )
+    return result.scalar_one_or_none()
+
+
+async def start_run(job_id: str, scheduled_for: datetime, shard: int = 0) -> Optional[BroadcastRun]:
+    """
+    Начинает или возобновляет запуск рассылки для шарда учеников.
+
+    Args:
+        job_id: ID задачи планировщика
+        scheduled_for: Время запуска по расписанию (наивное UTC)
+        shard: Шард учеников
+
+    Returns:
+        None, если этот запуск уже завершён
+    """
+    scheduled_for = to_utc(scheduled_for)
+    try:
+        async with session_maker() as session:
+            run = await _get_run(session, job_id, scheduled_for, shard)
+            if run is None:
+                session.add(ScheduledRun(
+                    job_id=job_id, scheduled_for=scheduled_for, shard=shard, status=RUN_RUNNING
+                ))
+                try:
+                    await session.commit()
+                except IntegrityError:
+                    # Запуск одновременно создан другим процессом
+                    await session.rollback()
+                run = await _get_run(session, job_id, scheduled_for, shard)
+
+            if run.status == RUN_COMPLETED:
+                return None
+
+            result = await session.execute(
+                select(BroadcastDelivery.user_id).where(
+                    BroadcastDelivery.run_id == run.id,
+                    BroadcastDelivery.status.in_(FINAL_STATUSES)
+                )
+            )
+            done = set(result.scalars().all())
+            return BroadcastRun(run.id, job_id, scheduled_for, done, shard)
+    except Exception as e:
+        print(f"❌ Журнал рассылки {job_id} недоступен, рассылка идёт без него: {e}")
+        return BroadcastRun(None, job_id, scheduled_for, shard=shard)
+
+
+async def start_runs(job_id: str, scheduled_for: datetime, shards: Iterable[int],
+                     shard_of: Callable[[int], int]) -> Optional[ShardedRun]:
+    """
+    Начинает или возобновляет запуск рассылки для шардов процесса.
+
+    Returns:
+        None, если запуск уже завершён для всех шардов
+    """
+    runs = {}
+    for shard in sorted(shards):
+        run = await start_run(job_id, scheduled_for, shard)
+        if run is not None:
+            runs[shard] = run
+    if not runs:
+        return None
+    return ShardedRun(runs, shard_of)
+
+
+async def find_missed_runs(jobs: Iterable, shards: Iterable[int] = (0,), now: Optional[datetime] = None,
+                           grace_seconds: int = BROADCAST_MISFIRE_GRACE_SECONDS):
+    """
+    Задачи, последнее срабатывание которых было не далее grace_seconds назад
+    и не завершено хотя бы для одного из shards (бот не работал или перезапустился
+    посреди рассылки).
+
+    Args:
+        jobs: Задачи APScheduler
+        shards: Шарды учеников этого процесса
+
+    Returns:
+        Список (задача, время срабатывания в наивном UTC)
+    """
+    now = now or datetime.now(pytz.utc)
+    shards = set(shards)
+    missed = []
+    async with session_maker() as session:
+        for job in jobs:
+            fire_time = last_fire_time(job.trigger, now)
+            if fire_time is None or (now - fire_time).total_seconds() > grace_seconds:
+                continue
+            result = await session.execute(
+                select(ScheduledRun.shard).where(
+                    ScheduledRun.job_id == job.id,
+                    ScheduledRun.scheduled_for == to_utc(fire_time),
+                    ScheduledRun.status == RUN_COMPLETED
+                )
+            )
+            if shards - set(result.scalars().all()):
+                missed.append((job, to_utc(fire_time)))
+    return missed
+
+
+async def delete_old_runs(keep_days: int = BROADCAST_LEDGER_KEEP_DAYS) -> None:
+    """
+    Удаляет запуски старше keep_days дней вместе с журналом.
+    """
+    stale_before = datetime.utcnow() - timedelta(days=keep_days)
+    stale_runs = select(ScheduledRun.id).where(ScheduledRun.scheduled_for < stale_before)
+    async with session_maker() as session:
+        await session.execute(delete(BroadcastDelivery).where(BroadcastDelivery.run_id.in_(stale_runs)))
+        await session.execute(delete(ScheduledRun).where(ScheduledRun.scheduled_for < stale_before))
+        await session.commit()
@@ -0,0 +1,185 @@
+"""
+Распределение рассылок между несколькими процессами бота (docker-compose up --scale).
+
+Ученики делятся на SCHEDULER_SHARDS шардов по user_id % SCHEDULER_SHARDS. Шардом владеет
+процесс, удерживающий advisory-блокировку PostgreSQL (SHARD_LOCK_CLASS, шард) на своём
+отдельном соединении; каждая рассылка обрабатывает только учеников своих шардов, поэтому
+процессы не отправляют одно и то же дважды, а время рассылки делится между ними.
+
+Каждый процесс также занимает слот участника (MEMBER_LOCK_CLASS, слот). Число занятых
+слотов - число живых процессов: раз в SCHEDULER_REBALANCE_SECONDS процесс отпускает
+шарды сверх своей доли и забирает свободные. Если процесс умер, PostgreSQL снимает
+его блокировки вместе с соединением, и шарды переходят к остальным. Процесс в слоте 0 -
+ведущий: только он выполняет общие задачи (секции, архивация, подготовка урока).
+
+Соединение с блокировками берётся из отдельного движка без пула (NullPool): оно не занимает
+место в пуле обработчиков, а при закрытии действительно закрывается и снимает блокировки
+(соединение, возвращённое в пул, сохранило бы их).
+
+Вне PostgreSQL (SQLite для отладки) процесс один и владеет всеми шардами.
+"""
+import math
+import os
+from contextlib import asynccontextmanager
+from typing import Optional, Set
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.pool import NullPool
+
+from database.engine import engine, create_db_engine
+
+load_dotenv()
+
+# На сколько шардов делить учеников (больше, чем процессов бота)
+SCHEDULER_SHARDS = max(1, int(os.getenv("SCHEDULER_SHARDS", "8")))
+# Как часто перераспределять шарды между процессами (сек)
+SCHEDULER_REBALANCE_SECONDS = int(os.getenv("SCHEDULER_REBALANCE_SECONDS", "30"))
+# Максимальное число процессов бота
+SCHEDULER_MAX_WORKERS = 64
+
+# Первые ключи advisory-блокировок (второй ключ - номер шарда или слота)
+SHARD_LOCK_CLASS = 734001
+MEMBER_LOCK_CLASS = 734002
+
+
+class ShardCoordinator:
+    """
+    Шарды учеников, которыми владеет этот процесс.
+    """
+
+    def __init__(self, shards: int = SCHEDULER_SHARDS):
+        self.shards = shards
+        self.enabled = engine.dialect.name == "postgresql"
+        # Отдельный движок без пула только для соединения с блокировками
+        self._engine = create_db_engine(poolclass=NullPool) if self.enabled else None
+        self.owned: Set[int] = set()
+        self.slot: Optional[int] = None
+        self._conn = None
+        self._busy = 0
+
+    @property
+    def is_leader(self) -> bool:
+        return not self.enabled or self.slot == 0
+
+    def shard_of(self, user_id: int) -> int:
+        return user_id % self.shards
+
+    @asynccontextmanager
+    async def hold(self):
+        """
+        Пока идёт рассылка, процесс не отпускает свои шарды.
+        """
+        self._busy += 1
+        try:
+            yield
+        finally:
+            self._busy -= 1
+
+    async def _try_lock(self, lock_class: int, key: int) -> bool:
+        result = await self._conn.execute(
+            text("SELECT pg_try_advisory_lock(:lock_class, :key)"),
+            {"lock_class": lock_class, "key": key}
+        )
+        return bool(result.scalar_one())
+
+    async def _unlock(self, lock_class: int, key: int) -> None:
+        await self._conn.execute(
+            text("SELECT pg_advisory_unlock(:lock_class, :key)"),
+            {"lock_class": lock_class, "key": key}
+        )
+
+    async def _count_members(self) -> int:
+        result = await self._conn.execute(
+            text(
+                "SELECT count(*) FROM pg_locks "
+                "WHERE locktype = 'advisory' AND classid = :lock_class AND granted "
+                "AND database = (SELECT oid FROM pg_database WHERE datname = current_database())"
+            ),
+            {"lock_class": MEMBER_LOCK_CLASS}
+        )
+        return result.scalar_one()
+
+    async def _take_slot(self) -> None:
+        """
+        Занимает наименьший свободный слот участника (слот 0 - ведущий).
+        """
+        for slot in range(self.slot if self.slot is not None else SCHEDULER_MAX_WORKERS):
+            if await self._try_lock(MEMBER_LOCK_CLASS, slot):
+                if self.slot is not None:
+                    await self._unlock(MEMBER_LOCK_CLASS, self.slot)
+                self.slot = slot
+                return
+
+    async def rebalance(self) -> Set[int]:
+        """
+        Приводит число своих шардов к доле процесса: отпускает лишние, забирает свободные.
+
+        Returns:
+            Шарды, полученные этим вызовом
+        """
+        if not self.enabled:
+            acquired = set(range(self.shards)) - self.owned
+            self.owned |= acquired
+            return acquired
+
+        acquired = set()
+        try:
+            if self._conn is None:
+                # Блокировки живут, пока открыто это соединение
+                self._conn = await self._engine.connect()
+            await self._take_slot()
+            if self.slot is None:
+                print(f"⚠️ Нет свободного слота: запущено больше {SCHEDULER_MAX_WORKERS} процессов бота")
+                await self._conn.commit()
+                return acquired
+
+            target = math.ceil(self.shards / max(1, await self._count_members()))
+
+            if len(self.owned) > target and not self._busy:
+                for shard in sorted(self.owned, reverse=True)[:len(self.owned) - target]:
+                    await self._unlock(SHARD_LOCK_CLASS, shard)
+                    self.owned.discard(shard)
+                print(f"🔀 Шарды отданы другим процессам, свои: {sorted(self.owned)}")
+
+            for shard in range(self.shards):
+                if len(self.owned) >= target:
+                    break
+                if shard not in self.owned and await self._try_lock(SHARD_LOCK_CLASS, shard):
+                    self.owned.add(shard)
+                    acquired.add(shard)
+
+            # Advisory-блокировки уровня сессии переживают завершение транзакции
+            await self._conn.commit()
+        except Exception as e:
+            print(f"❌ Ошибка при распределении шардов: {e}")
+            await self.close()
+        return acquired
+
+    async def close(self) -> None:
+        """
+        Отпускает все шарды: снимает блокировки и закрывает соединение.
+        """
+        self.owned = set()
+        self.slot = None
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                await conn.rollback()
+                await conn.execute(text("SELECT pg_advisory_unlock_all()"))
+                await conn.close()
+            except Exception as e:
+                # Соединение неисправно - закрываем его, не возвращая в пул:
+                # PostgreSQL снимет блокировки вместе с сессией
+                print(f"⚠️ Ошибка при закрытии соединения шардов: {e}")
+                try:
+                    await conn.invalidate()
+                except Exception:
+                    pass
+
+    def format(self) -> str:
+        """
+        Шарды процесса в виде текста для команды /status.
+        """
+        role = "ведущий" if self.is_leader else f"слот {self.slot}"
+        return f"{len(self.owned)} из {self.shards} ({role}): {sorted(self.owned)}"
@@ -0,0 +1,189 @@
+"""
+Кэш озвученных фраз (TTS).
+
+Бот часто озвучивает одни и те же тексты: приветствия уроков, fallback-фразы,
+напоминания. Кэш хранит аудио по ключу - хэшу от (нормализованный текст, модель, голос):
+1) в памяти - LRU на TTS_CACHE_MEMORY_ITEMS записей;
+2) на диске - файлы <ключ>.mp3 в папке кэша, самые старые удаляются
+   когда размер папки превышает лимит.
+
+Аудио из кэша отправляется повторно, поэтому его file_id Telegram запоминается
+в реестре голосовых (database/voice_uploads.py): фраза не синтезируется
+и не загружается заново.
+"""
+import hashlib
+import logging
+import os
+import re
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Имя файла кэша - sha256 ключа в hex
+CACHE_KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class TTSCache:
+    """
+    Двухуровневый (память + диск) кэш аудио, адресуемый по содержимому.
+    """
+
+    def __init__(self, cache_dir: Path, memory_items: int = 256, disk_max_bytes: int = 200 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self.disk_max_bytes = disk_max_bytes
+
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._disk_bytes: Optional[int] = None  # Считается лениво при первой записи
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """
+        Нормализует текст, чтобы одинаковые по смыслу фразы давали один ключ
+        """
+        text = unicodedata.normalize("NFC", text)
+        return " ".join(text.split())
+
+    @classmethod
+    def make_key(cls, text: str, model: str, voice: str) -> str:
+        """
+        Возвращает ключ кэша для текста, модели и голоса TTS
+        """
+        payload = "\x1f".join([cls.normalize_text(text), model, voice])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Ищет аудио сначала в памяти, затем на диске.
+
+        Returns:
+            Байты аудио или None, если ключа нет в кэше
+        """
+        audio_bytes = self._memory.get(key)
+        if audio_bytes is not None:
+            self._memory.move_to_end(key)
+            return audio_bytes
+
+        path = self._audio_path(key)
+        try:
+            audio_bytes = path.read_bytes()
+        except OSError:
+            return None
+
+        # Обновляем время доступа, чтобы файл не удалился первым при очистке
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self._remember_in_memory(key, audio_bytes)
+        return audio_bytes
+
+    def put(self, key: str, audio_bytes: bytes) -> None:
+        """
+        Сохраняет аудио в память и на диск
+        """
+        if not audio_bytes:
+            return
+
+        self._remember_in_memory(key, audio_bytes)
+
+        path = self._audio_path(key)
+        if path.exists():
+            return
+
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_bytes(audio_bytes)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось сохранить аудио в кэш {path}: {e}")
+            return
+
+        if self._disk_bytes is None:
+            self._disk_bytes = self._scan_disk_bytes()
+        else:
+            self._disk_bytes += len(audio_bytes)
+
+        if self._disk_bytes > self.disk_max_bytes:
+            self._evict_disk()
+
+    def clear(self) -> None:
+        """
+        Очищает кэш в памяти и на диске
+        """
+        self._memory.clear()
+        for path in self.cache_dir.glob("*.mp3"):
+            try:
+                path.unlink()
+            except OSError as e:
+                logger.warning(f"⚠️ Не удалось удалить файл кэша {path}: {e}")
+        self._disk_bytes = None
+
+    def cleanup_temp_files(self) -> None:
+        """
+        Удаляет из папки кэша временные файлы: недописанные *.tmp, mp3,
+        не принадлежащие кэшу (голосовые старых версий бота), и *.file_id
+        прежней версии кэша. Кэш не трогает.
+        """
+        for path in self.cache_dir.glob("*"):
+            if path.suffix in (".tmp", ".file_id") or (path.suffix == ".mp3" and not CACHE_KEY_RE.match(path.stem)):
+                try:
+                    path.unlink()
+                    logger.info(f"🗑️ Удалён временный файл: {path}")
+                except OSError as e:
+                    logger.warning(f"⚠️ Не удалось удалить файл {path}: {e}")
+        self._disk_bytes = None
+
+    def _remember_in_memory(self, key: str, audio_bytes: bytes) -> None:
+        self._memory[key] = audio_bytes
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _audio_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.mp3"
+
+    def _scan_disk_bytes(self) -> int:
+        total = 0
+        for path in self.cache_dir.glob("*.mp3"):
+            try:
+                total += path.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    def _evict_disk(self) -> None:
+        """
+        Удаляет самые давно использованные файлы, пока кэш не уложится
+        в 90% лимита (запас, чтобы не чистить на каждой записи)
+        """
+        files = []
+        for path in self.cache_dir.glob("*.mp3"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = int(self.disk_max_bytes * 0.9)
+
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                path.unlink()
+                total -= size
+                logger.info(f"🗑️ Удалён файл из кэша TTS: {path.name}")
+            except OSError as e:
+                logger.warning(f"⚠️ Не удалось удалить файл кэша {path}: {e}")
+                continue
+            self._memory.pop(path.stem, None)
+
+        self._disk_bytes = total
@@ -1,29 +1,66 @@
 import asyncio
 import json
 import os
+import re
 import tempfile
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import Optional, List, AsyncIterator, Union, BinaryIO
+from dotenv import load_dotenv
 
 from ai.ai import openai_client
+from speech.tts_cache import TTSCache
+
+load_dotenv()
 
 # Настройка логгера
 logger = logging.getLogger(__name__)
 
-# Папка для временных аудио файлов
+# Папка кэша озвученных фраз
 VOICE_CACHE_DIR = Path(__file__).parent / "voice_cache"
 VOICE_CACHE_DIR.mkdir(exist_ok=True)
 
+# Кэш озвучки: одинаковый текст не синтезируется повторно
+TTS_CACHE_ENABLED = os.getenv("TTS_CACHE_ENABLED", "true").lower() == "true"
+
+# Сколько аудио держать в памяти (LRU)
+TTS_CACHE_MEMORY_ITEMS = int(os.getenv("TTS_CACHE_MEMORY_ITEMS", "256"))
+
+# Максимальный размер кэша на диске (МБ), при превышении удаляются самые старые файлы
+TTS_CACHE_DISK_MB = int(os.getenv("TTS_CACHE_DISK_MB", "200"))
+
+tts_cache = TTSCache(
+    VOICE_CACHE_DIR,
+    memory_items=TTS_CACHE_MEMORY_ITEMS,
+    disk_max_bytes=TTS_CACHE_DISK_MB * 1024 * 1024
+)
+
 # Режим разработки (без OpenAI API)
 DEV_MODE = False  # Измените на True для тестирования без OpenAI API
 
-async def transcribe_audio(audio_path: str) -> str:
+# Озвучивание по предложениям: текст режется на предложения, которые
+# синтезируются параллельно, а не одним запросом к TTS
+TTS_CHUNKED = os.getenv("TTS_CHUNKED", "false").lower() == "true"
+
+# Сколько предложений синтезируется одновременно
+TTS_CHUNK_WORKERS = int(os.getenv("TTS_CHUNK_WORKERS", "3"))
+
+# Как отправлять озвученные предложения: single - одним голосовым (аудио склеивается),
+# multi - отдельным голосовым на каждое предложение
+TTS_VOICE_SEND_MODE = os.getenv("TTS_VOICE_SEND_MODE", "single").lower()
+
+# Слишком короткие предложения склеиваются с соседними, чтобы не плодить запросы
+TTS_MIN_CHUNK_CHARS = 40
+
+# Конец предложения: знак препинания (и закрывающие скобки/кавычки), за которым идёт пробел
+SENTENCE_END_RE = re.compile(r'(?:(?<=[.!?…])|(?<=[.!?…][)"»\']))\s+|\n+')
+
+async def transcribe_audio(audio: Union[str, bytes, BinaryIO]) -> str:
     """
-    Транскрибирует аудио файл в текст с помощью OpenAI Whisper.
+    Транскрибирует аудио в текст с помощью OpenAI Whisper.
     
     Args:
-        audio_path: Путь к аудио файлу
+        audio: Путь к аудио файлу, байты аудио или именованный буфер в памяти
         
     Returns:
         Транскрибированный текст
@@ -36,7 +73,7 @@ async def transcribe_audio(audio_path: str) -> str:
     
     try:
         # Используем OpenAI Whisper для транскрибации
-        transcribed_text = await openai_client.transcribe_audio(audio_path)
+        transcribed_text = await openai_client.transcribe_audio(audio)
         
         if not transcribed_text.strip():
             transcribed_text = "Hello, teacher! I am ready for the English lesson."
@@ -48,12 +85,13 @@ async def transcribe_audio(audio_path: str) -> str:
         logger.error(f"❌ Ошибка при транскрибации: {e}")
         return "Hello, teacher! I am ready for the English lesson."
 
-async def generate_speech(text: str) -> bytes:
+async def generate_speech(text: str, chunked: Optional[bool] = None) -> bytes:
     """
     Генерирует речь из текста с помощью OpenAI TTS.
     
     Args:
         text: Текст для озвучивания
+        chunked: Озвучивать по предложениям (по умолчанию - TTS_CHUNKED)
         
     Returns:
         Байты аудио файла
@@ -64,10 +102,27 @@ async def generate_speech(text: str) -> bytes:
         logger.info("🔧 Режим разработки: заглушка для TTS")
         return b""
     
+    if chunked is None:
+        chunked = TTS_CHUNKED
+    
+    if chunked:
+        # mp3-фрагменты можно склеивать подряд - плееры проигрывают их как один файл
+        return b"".join(await generate_speech_chunks(text))
+    
+    cache_key = get_tts_cache_key(text) if TTS_CACHE_ENABLED else None
+    if cache_key:
+        audio_bytes = tts_cache.get(cache_key)
+        if audio_bytes:
+            logger.info(f"✅ Речь взята из кэша для текста: '{text[:50]}...'")
+            return audio_bytes
+    
     try:
         # Используем OpenAI TTS для генерации речи
         audio_bytes = await openai_client.generate_speech(text)
         
+        if cache_key and audio_bytes:
+            tts_cache.put(cache_key, audio_bytes)
+        
         logger.info(f"✅ Сгенерирована речь для текста: '{text[:50]}...'")
         return audio_bytes
         
@@ -75,6 +130,173 @@ async def generate_speech(text: str) -> bytes:
         logger.error(f"❌ Ошибка при генерации речи: {e}")
         return b""
 
+def get_tts_cache_key(text: str) -> str:
+    """
+    Возвращает ключ кэша озвучки для текста с текущими моделью и голосом TTS.
+    """
+    return TTSCache.make_key(text, openai_client.tts_model, openai_client.tts_voice)
+
+def split_into_sentences(text: str) -> List[str]:
+    """
+    Делит текст на фрагменты по границам предложений для озвучивания.
+    Короткие предложения склеиваются, пока фрагмент не наберёт TTS_MIN_CHUNK_CHARS.
+    
+    Args:
+        text: Текст для озвучивания
+        
+    Returns:
+        Список фрагментов в исходном порядке
+    """
+    chunks = []
+    current = ""
+    
+    for sentence in SENTENCE_END_RE.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        current = f"{current} {sentence}".strip()
+        if len(current) >= TTS_MIN_CHUNK_CHARS:
+            chunks.append(current)
+            current = ""
+    
+    if current:
+        if chunks and len(current) < TTS_MIN_CHUNK_CHARS:
+            chunks[-1] = f"{chunks[-1]} {current}"
+        else:
+            chunks.append(current)
+    
+    return chunks
+
+
+class SpeechPipeline:
+    """
+    Конвейер озвучивания по предложениям.
+    
+    Текст подаётся через feed() - целиком или по мере генерации (стриминг).
+    Каждое законченное предложение сразу уходит в TTS, одновременно
+    синтезируется не больше TTS_CHUNK_WORKERS фрагментов. Готовое аудио
+    забирается по порядку через iter_audio() или целиком через finish().
+    """
+    
+    def __init__(self, workers: int = TTS_CHUNK_WORKERS):
+        self._semaphore = asyncio.Semaphore(max(1, workers))
+        self._tasks: List[asyncio.Task] = []
+        self._consumed = 0  # Сколько символов текста уже отдано в TTS
+        self._voiced = ""  # Начало текста, уже отданное в TTS (text[:_consumed])
+        self._pending = ""  # Законченные, но слишком короткие предложения
+    
+    def feed(self, text: str) -> None:
+        """
+        Принимает накопленный на текущий момент текст ответа и запускает
+        озвучивание предложений, которые уже точно закончились.
+        """
+        tail = text[self._consumed:]
+        
+        # Ищем последнюю границу предложения в ещё не озвученной части
+        last_end = None
+        for match in SENTENCE_END_RE.finditer(tail):
+            last_end = match.end()
+        if last_end is None:
+            return
+        
+        self._consumed += last_end
+        self._voiced = text[:self._consumed]
+        self._pending = f"{self._pending} {tail[:last_end]}".strip()
+        if len(self._pending) >= TTS_MIN_CHUNK_CHARS:
+            for chunk in split_into_sentences(self._pending):
+                self._schedule(chunk)
+            self._pending = ""
+    
+    async def follow(self, text_stream: AsyncIterator[str]) -> AsyncIterator[str]:
+        """
+        Пропускает поток накопленного текста дальше, попутно озвучивая
+        законченные предложения (для потоковых ответов).
+        """
+        async for text in text_stream:
+            self.feed(text)
+            yield text
+    
+    async def iter_audio(self, final_text: str) -> AsyncIterator[bytes]:
+        """
+        Досылает в TTS остаток текста и отдаёт аудио фрагментов по порядку,
+        как только очередной фрагмент готов.
+        
+        Если итоговый текст не продолжает озвученный (например, поток оборвался
+        и вместо ответа пришёл fallback-текст), озвучивание начинается заново.
+        
+        Args:
+            final_text: Итоговый текст ответа
+        """
+        if not final_text.startswith(self._voiced):
+            self.cancel()
+            self._consumed = 0
+            self._voiced = ""
+            self._pending = ""
+        
+        rest = f"{self._pending} {final_text[self._consumed:]}".strip()
+        self._consumed = len(final_text)
+        self._voiced = final_text
+        self._pending = ""
+        for chunk in split_into_sentences(rest):
+            self._schedule(chunk)
+        
+        try:
+            for task in self._tasks:
+                audio_bytes = await task
+                if audio_bytes:
+                    yield audio_bytes
+        finally:
+            for task in self._tasks:
+                task.cancel()
+    
+    async def finish(self, final_text: str) -> List[bytes]:
+        """
+        Дожидается озвучивания всех фрагментов.
+        
+        Returns:
+            Список аудио фрагментов в порядке предложений
+        """
+        return [audio_bytes async for audio_bytes in self.iter_audio(final_text)]
+    
+    def cancel(self) -> None:
+        """
+        Отменяет озвучивание (например, если готовое аудио нашлось в кэше).
+        """
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+    
+    def _schedule(self, chunk: str) -> None:
+        self._tasks.append(asyncio.create_task(self._synthesize(chunk)))
+    
+    async def _synthesize(self, chunk: str) -> bytes:
+        async with self._semaphore:
+            return await generate_speech(chunk, chunked=False)
+
+
+def create_speech_pipeline() -> Optional[SpeechPipeline]:
+    """
+    Создаёт конвейер озвучивания, если включено озвучивание по предложениям.
+    
+    Returns:
+        SpeechPipeline или None, если текст озвучивается одним запросом
+    """
+    if TTS_CHUNKED or TTS_VOICE_SEND_MODE == "multi":
+        return SpeechPipeline()
+    return None
+
+async def generate_speech_chunks(text: str) -> List[bytes]:
+    """
+    Озвучивает текст по предложениям (параллельно, с ограничением TTS_CHUNK_WORKERS).
+    
+    Args:
+        text: Текст для озвучивания
+        
+    Returns:
+        Список аудио фрагментов в порядке предложений
+    """
+    return await SpeechPipeline().finish(text)
+
 async def save_audio_to_file(audio_bytes: bytes, filename: str) -> str:
     """
     Сохраняет аудио байты в файл.
@@ -118,15 +340,10 @@ def get_voice_cache_dir() -> Path:
 
 def cleanup_temp_files():
     """
-    Очищает временные файлы в кэше.
+    Очищает временные файлы в папке кэша (сам кэш озвучки сохраняется).
     """
     try:
-        for file_path in VOICE_CACHE_DIR.glob("*.mp3"):
-            try:
-                file_path.unlink()
-                logger.info(f"🗑️ Удалён временный файл: {file_path}")
-            except Exception as e:
-                logger.warning(f"⚠️ Не удалось удалить файл {file_path}: {e}")
+        tts_cache.cleanup_temp_files()
     except Exception as e:
         logger.error(f"❌ Ошибка при очистке временных файлов: {e}")
 
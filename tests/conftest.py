@@ -0,0 +1,12 @@
+# Тесты работают с отдельной базой SQLite (нужны pytest и aiosqlite):
+#   pip install pytest aiosqlite
+#   python -m pytest tests
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# DB_URL читается при импорте database.engine, поэтому задаётся до импорта модулей бота
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(prefix="english_bot_tests_"), "test.db")
+os.environ["DB_URL"] = f"sqlite+aiosqlite:///{TEST_DB_PATH}"
@@ -0,0 +1,205 @@
+"""
+Голосовая итерация урока (handle_voice_message) не держит соединение с БД,
+пока ждёт Whisper и OpenAI: сессия отпускает его после чтения и берёт снова
+только для записи диалога.
+
+OpenAI, TTS и Telegram заменены заглушками, база - SQLite с маленьким пулом.
+"""
+import asyncio
+import io
+from types import SimpleNamespace
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from tests.conftest import TEST_DB_PATH
+from database.engine import create_db, create_db_engine, engine as app_engine
+from database.models import MessageHistory, Topic, User
+from database.topic_catalog import topic_catalog
+from middlewares.db import LazySession
+import handlers.user_private as user_private
+
+# Пул меньше числа одновременных итераций
+POOL_SIZE = 2
+TURNS = 8
+# Длительность "запроса к OpenAI" в заглушках (сек)
+SLOW = 0.2
+
+
+class FakeBot:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+
+    async def download(self, voice):
+        # Буфер голосового помнит, чья это итерация (заглушке Whisper нужен user_id)
+        buffer = io.BytesIO(b"ogg")
+        buffer.user_id = self.user_id
+        return buffer
+
+    async def send_message(self, *args, **kwargs):
+        pass
+
+
+def make_message(user_id: int):
+    answers = []
+
+    async def answer(text, **kwargs):
+        answers.append(text)
+
+    message = SimpleNamespace(
+        from_user=SimpleNamespace(id=user_id),
+        voice=SimpleNamespace(file_id=f"voice-{user_id}"),
+        bot=FakeBot(user_id),
+        answer=answer,
+    )
+    return message, answers
+
+
+async def seed(user_ids):
+    await create_db()
+    async with app_engine.begin() as conn:
+        if (await conn.execute(select(Topic.id).where(Topic.id == 1))).first() is None:
+            await conn.execute(insert(Topic), [{"id": 1, "title": "Greetings", "description": "Hello", "tasks": "[]"}])
+        await conn.execute(insert(User), [{"id": user_id, "progress": "[]", "current_topic_id": 1} for user_id in user_ids])
+    await topic_catalog.load()
+    # Каждый тест живёт в своём event loop - соединения основного движка не переиспользуем
+    await app_engine.dispose()
+
+
+async def no_waiting_timer(*args, **kwargs):
+    pass
+
+
+def patch_external_io(monkeypatch, sessions, pool, observed):
+    """
+    Заглушки Whisper, OpenAI и TTS запоминают, держала ли сессия итерации
+    соединение во время вызова и сколько соединений было занято в пуле.
+    """
+    def observe(stage: str, user_id: int):
+        observed.append((
+            stage,
+            sessions[user_id].is_created and sessions[user_id].session.in_transaction(),
+            pool.checkedout(),
+        ))
+
+    async def transcribe_audio(voice_buffer):
+        user_id = voice_buffer.user_id
+        observe("whisper", user_id)
+        await asyncio.sleep(SLOW)
+        return f"My name is {user_id}"
+
+    async def generate_intelligent_response(user_message, conversation_history, current_topic=None):
+        user_id = int(user_message.rsplit(" ", 1)[1])
+        observe("chat", user_id)
+        await asyncio.sleep(SLOW)
+        return "Nice to meet you!", {"is_correct": True, "feedback": "👍", "correct_answer": "", "explanation": ""}
+
+    async def send_voice_reply(bot, chat_id, text, caption=None, speech_pipeline=None, audio=None):
+        observe("tts", chat_id)
+        await asyncio.sleep(SLOW)
+        return True
+
+    monkeypatch.setattr(user_private, "transcribe_audio", transcribe_audio)
+    monkeypatch.setattr(user_private.openai_client, "response_mode", "sequential")
+    monkeypatch.setattr(user_private.openai_client, "generate_intelligent_response", generate_intelligent_response)
+    monkeypatch.setattr(user_private, "send_voice_reply", send_voice_reply)
+    monkeypatch.setattr(user_private, "create_speech_pipeline", lambda: None)
+    monkeypatch.setattr(user_private, "STREAM_REPLIES", False)
+    # Таймер напоминания ждёт ответа пользователя минутами - в тесте не нужен
+    monkeypatch.setattr(user_private, "set_waiting_timer", no_waiting_timer)
+
+
+def test_voice_turns_release_connection_during_openai(monkeypatch):
+    user_ids = [1000 + i for i in range(TURNS)]
+
+    async def run():
+        await seed(user_ids)
+
+        pool_engine = create_db_engine(
+            f"sqlite+aiosqlite:///{TEST_DB_PATH}",
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=POOL_SIZE,
+            max_overflow=0,
+            # Итерация, державшая бы соединение все 3 вызова, не дождалась бы его
+            pool_timeout=SLOW,
+        )
+        pool = pool_engine.sync_engine.pool
+        pool_sessions = async_sessionmaker(bind=pool_engine, class_=AsyncSession, expire_on_commit=False)
+
+        sessions = {}
+        observed = []
+        patch_external_io(monkeypatch, sessions, pool, observed)
+        storage = MemoryStorage()
+
+        async def turn(user_id: int):
+            message, answers = make_message(user_id)
+            state = FSMContext(storage=storage, key=StorageKey(bot_id=1, chat_id=user_id, user_id=user_id))
+            session = sessions[user_id] = LazySession(pool_sessions)
+            try:
+                await user_private.handle_voice_message(message, state, session)
+            finally:
+                await session.close()
+            return answers
+
+        results = await asyncio.gather(*(turn(user_id) for user_id in user_ids))
+
+        async with app_engine.connect() as conn:
+            saved = (await conn.execute(
+                select(func.count()).select_from(MessageHistory).where(MessageHistory.user_id.in_(user_ids))
+            )).scalar_one()
+        await app_engine.dispose()
+        await pool_engine.dispose()
+        return results, observed, saved
+
+    results, observed, saved = asyncio.run(run())
+
+    assert {stage for stage, _, _ in observed} == {"whisper", "chat", "tts"}
+    assert len(observed) == 3 * TURNS
+    # Во время Whisper, OpenAI и TTS сессия итерации не держит соединение
+    assert not any(holding for _, holding, _ in observed), observed
+    assert max(checked_out for _, _, checked_out in observed) <= POOL_SIZE
+    # Все итерации дошли до ответа и записали диалог (вопрос + ответ)
+    assert all(any("Обратная связь" in text for text in answers) for answers in results)
+    assert saved == 2 * TURNS
+
+
+def test_turn_holds_no_connection_while_waiting_for_openai(monkeypatch):
+    """
+    Одна итерация: во время Whisper и генерации ответа пул полностью свободен.
+    """
+    user_id = 2000
+
+    async def run():
+        await seed([user_id])
+
+        pool_engine = create_db_engine(
+            f"sqlite+aiosqlite:///{TEST_DB_PATH}",
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=1,
+            max_overflow=0,
+        )
+        pool = pool_engine.sync_engine.pool
+        pool_sessions = async_sessionmaker(bind=pool_engine, class_=AsyncSession, expire_on_commit=False)
+
+        sessions = {}
+        observed = []
+        patch_external_io(monkeypatch, sessions, pool, observed)
+
+        message, _ = make_message(user_id)
+        state = FSMContext(storage=MemoryStorage(), key=StorageKey(bot_id=1, chat_id=user_id, user_id=user_id))
+        session = sessions[user_id] = LazySession(pool_sessions)
+        try:
+            await user_private.handle_voice_message(message, state, session)
+        finally:
+            await session.close()
+        await pool_engine.dispose()
+        return observed
+
+    observed = asyncio.run(run())
+
+    assert [stage for stage, _, _ in observed] == ["whisper", "chat", "tts"]
+    assert all(checked_out == 0 for _, _, checked_out in observed), observed
@@ -6,8 +6,8 @@
 import asyncio
 import json
 from database.engine import session_maker
-from database.models import Topic, User, MessageHistory, Homework
-from sqlalchemy import select
+from database.models import Topic, User, MessageHistory, Homework, UserTopicProgress
+from sqlalchemy import select, func
 
 async def view_database():
     """Просмотр содержимого базы данных"""
@@ -46,8 +46,10 @@ async def view_database():
                 print(f"\nID: {user.id}")
                 print(f"   Текущая тема: {user.current_topic_id or 'Не выбрана'}")
                 print(f"   Последний урок: {user.last_lesson_date or 'Нет'}")
-                progress = json.loads(user.progress) if user.progress else []
-                print(f"   Пройденные темы: {len(progress)} из {len(topics)}")
+                completed_count = (await session.execute(
+                    select(func.count()).select_from(UserTopicProgress).where(UserTopicProgress.user_id == user.id)
+                )).scalar_one()
+                print(f"   Пройденные темы: {completed_count} из {len(topics)}")
                 print(f"   Создан: {user.created_at}")
         
         # 3. История сообщений (последние 10)